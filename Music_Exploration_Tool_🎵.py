@@ -8,7 +8,24 @@ in a visual way on a larger scale than typical music analysis.
 # IMPORTS
 import streamlit as st
 
-from methods import create_df, clean_df, get_playlist, get_spotipy_info, load_df, save_df, save_master_df
+from jobs import DONE, FAILED, INTERRUPTED
+from master_store import MASTER_STORE_PATH
+from methods import (ANALYSIS_WORKERS, LibraryOverlay, get_job_queue, get_master_store, get_track_cache,
+                     load_library, save_master_df, show_metrics_panel)
+from os.path import isdir
+
+
+def use_library(file_path: str, version: int, compact_schema: bool):
+    """Make a library the data of this session, in the compact schema if it was chosen.
+    The library is shared with every other session that loaded it, and this session only keeps its own changes."""
+    library, bytes_saved = load_library(file_path, version, compact_schema)
+    if compact_schema:
+        st.caption(f"Compact schema saved {bytes_saved / 1024 ** 2:.2f} MB of memory.")
+    st.session_state.library = LibraryOverlay(library, (file_path, version, compact_schema))
+    if "library" in st.session_state:
+        st.success("Data imported successfully!")
+    else:
+        st.error("Something must have gone wrong. Please check the fields again.")
 
 
 # Page and app config
@@ -23,10 +40,11 @@ with st.form("import_data"):
     import_existing = st.radio(label="Import existing dataframe?",
                                options=["Yes, import pickled dataframe",
                                         "No, fetch new data from Spotify API"])
+    compact_schema = st.checkbox(label="Use compact schema (uses less memory, leaves out track URLs)")
     st.write("")
     st.write("Existing dataframe import settings:")
-    open_path = st.text_input(label="File path for dataframe",
-                              value="./pickles/spotify_master_df.pkl")
+    open_path = st.text_input(label="File path for dataframe or master store",
+                              value=MASTER_STORE_PATH)
     st.write(""
              "")
     st.write("Spotify API settings:")
@@ -43,19 +61,57 @@ with st.form("import_data"):
                                 placeholder="Please paste your Spotify User Secret here")
     playlist_id = st.text_input(label="Playlist ID or URL",
                                 placeholder="e.g. 3j1iDQdjbP8tUcNbe4BVhz")
+    max_workers = st.number_input(label="Concurrent Spotify API requests",
+                                  min_value=1,
+                                  max_value=32,
+                                  value=ANALYSIS_WORKERS)
     submitted_import = st.form_submit_button("Import data")
     if submitted_import:
+        st.session_state.compact_schema = compact_schema
         if import_existing == "No, fetch new data from Spotify API":
-            sp = get_spotipy_info(user_cid, user_secret)
-            playlist_df = create_df(sp, get_playlist(sp, playlist_id))
-            df_clean = clean_df(playlist_df)
-            fp = save_df(df_clean)
+            # Playlists are imported in the background, so that the app stays usable during long imports
+            st.session_state.import_job = get_job_queue().submit(user_cid, user_secret, playlist_id, max_workers)
+            st.info("The playlist is being imported in the background. Its progress is shown below.")
         else:
             fp = open_path
-            df_clean = load_df(fp)
-        save_master_df(df_clean)
-        st.session_state.df = df_clean
-        if "df" in st.session_state:
-            st.success("Data imported successfully!")
-        else:
-            st.error("Something must have gone wrong. Please check the fields again.")
+            # Anything loaded from a master store is already in it
+            if not isdir(fp):
+                save_master_df(load_library(fp)[0])
+            use_library(fp, get_master_store().version if isdir(fp) else None, compact_schema)
+
+# IMPORT JOBS
+job_queue = get_job_queue()
+jobs = job_queue.jobs()
+if jobs:
+    st.subheader("Import jobs")
+    # Jobs run on a background thread, so refreshing only reads their latest checkpoint
+    st.button("Refresh status")
+    for job in jobs[:5]:
+        done, total = job["next_offset"], job["total"]
+        st.progress(min(done / total, 1.0) if total else 0.0,
+                    text=f"Playlist {job['playlist_id']}: {job['status']}, "
+                         f"{done} of {total if total is not None else '?'} tracks")
+        if job["status"] == DONE:
+            st.caption(f"{job['tracks']} tracks imported, {job['failed']} left out, "
+                       f"{job['retries']} rate-limit retries.")
+            # The job started by this session is loaded as soon as it is done
+            if st.session_state.get("import_job") == job["id"]:
+                del st.session_state.import_job
+                if job["file_path"]:
+                    use_library(job["file_path"], None, st.session_state.get("compact_schema", False))
+            elif job["file_path"] and st.button("Load", key=f"load_{job['id']}"):
+                use_library(job["file_path"], None, st.session_state.get("compact_schema", False))
+        elif job["status"] == FAILED:
+            st.error(f"Import failed: {job['error']}")
+            if job["cid"] in job_queue.clients and st.button("Retry", key=f"retry_{job['id']}"):
+                job_queue.retry(job["id"])
+                st.experimental_rerun()
+        elif job["status"] == INTERRUPTED:
+            st.caption("Interrupted by a restart. It will resume from the last page fetched "
+                       "the next time a playlist is imported with the same Spotify CID.")
+    cache_stats = get_track_cache().stats()
+    st.caption("Track cache hit rate: " + ", ".join(f"{kind} {stats['hit_rate']:.0%}"
+                                                    for kind, stats in cache_stats.items()))
+
+# PERFORMANCE METRICS
+show_metrics_panel()
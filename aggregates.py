@@ -0,0 +1,401 @@
+"""
+Aggregates (Music Exploration Tool)
+Author: Yvonne Teo
+Description: This script keeps the count, sum, minimum, maximum and a quantile sketch of every feature per cluster,
+artist and mood, updated as tracks are added, edited or replaced, so that summaries cost as much as the number of
+groups instead of the number of tracks.
+"""
+
+# IMPORTS
+import numpy as np
+import pandas as pd
+
+from feature_matrix import to_float32
+from master_store import USER_COLUMNS
+from moods import MOOD_BITS, MOOD_MASK, moods_to_masks
+from summaries import HISTOGRAM_BINS, MAX_OUTLIERS
+
+# DEFINITIONS
+GROUPINGS = ["all", "cluster", "artist", "mood"]
+# Most artists have a few tracks each, so their sketches would take more memory than their values
+SKETCH_GROUPINGS = ["all", "cluster", "mood"]
+# Name of the only group of the "all" grouping
+ALL_TRACKS = "All tracks"
+# Quantiles read from a sketch are within this relative error of the true value
+RELATIVE_ACCURACY = 0.01
+# Values closer to zero than this are counted as zero, and larger magnitudes are counted in the outermost bins
+MIN_MAGNITUDE = 1e-3
+MAX_MAGNITUDE = 1e8
+# Layers of aggregates stacked on each other before they are merged into one
+MAX_DEPTH = 8
+
+# Sketch bins hold the values whose magnitude is between two consecutive powers of gamma, in increasing order of value:
+# negative values, zero, then positive values
+_GAMMA = (1 + RELATIVE_ACCURACY) / (1 - RELATIVE_ACCURACY)
+_MIN_KEY = int(np.floor(np.log(MIN_MAGNITUDE) / np.log(_GAMMA)))
+_MAX_KEY = int(np.ceil(np.log(MAX_MAGNITUDE) / np.log(_GAMMA)))
+_N_KEYS = _MAX_KEY - _MIN_KEY + 1
+SKETCH_BINS = 2 * _N_KEYS + 1
+_KEYS = np.arange(_MIN_KEY, _MAX_KEY + 1)
+# Value each bin stands for, and the bounds of the values in it
+BIN_VALUES = np.concatenate([-(2 * _GAMMA ** _KEYS / (_GAMMA + 1))[::-1], [0.0], 2 * _GAMMA ** _KEYS / (_GAMMA + 1)])
+_UPPER = np.where(_KEYS == _MAX_KEY, np.inf, _GAMMA ** _KEYS)
+_LOWER = np.where(_KEYS == _MIN_KEY, MIN_MAGNITUDE, _GAMMA ** (_KEYS - 1))
+BIN_LOWER = np.concatenate([-_UPPER[::-1], [-MIN_MAGNITUDE], _LOWER])
+BIN_UPPER = np.concatenate([-_LOWER[::-1], [MIN_MAGNITUDE], _UPPER])
+
+
+def sketch_bins(values: np.ndarray) -> np.ndarray:
+    """Get the sketch bin of every value, or -1 for missing values."""
+    values = np.asarray(values, dtype=np.float32)
+    magnitudes = np.abs(values)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        keys = np.ceil(np.log(magnitudes) * np.float32(1 / np.log(_GAMMA)))
+    keys = np.clip(np.nan_to_num(keys, nan=_MIN_KEY, posinf=_MAX_KEY, neginf=_MIN_KEY), _MIN_KEY, _MAX_KEY)
+    keys = keys.astype(np.int32)
+    bins = np.where(values > 0, _N_KEYS + 1 + keys - _MIN_KEY, _MAX_KEY - keys)
+    bins[magnitudes < MIN_MAGNITUDE] = _N_KEYS
+    bins[np.isnan(values)] = -1
+    return bins.astype(np.int32)
+
+
+def sketch_quantiles(sketch: np.ndarray, quantiles: list, minimum: float, maximum: float) -> np.ndarray:
+    """Read quantiles from the bin counts of a sketch, within the minimum and maximum of its values."""
+    cumulative = np.cumsum(sketch)
+    if len(cumulative) == 0 or cumulative[-1] <= 0:
+        return np.full(len(quantiles), np.nan)
+    ranks = np.asarray(quantiles, dtype=np.float64) * (cumulative[-1] - 1)
+    return np.clip(BIN_VALUES[np.searchsorted(cumulative, ranks, side="right")], minimum, maximum)
+
+
+def aggregate_frame(dataframe: pd.DataFrame, features: list) -> pd.DataFrame:
+    """Get what aggregates are computed from, indexed by track id: the artist, the cluster as a number, the mood
+    bitmask, and the features as float32. Aggregates always take values from this frame, so that the values taken away
+    from a group when a track changes are exactly the values that were added for it."""
+    columns = dataframe.columns
+    frame = pd.DataFrame(index=pd.Index(dataframe["id"].to_numpy(), name="id"))
+    frame["artist"] = dataframe["artist"].fillna("").astype(str).to_numpy() if "artist" in columns else ""
+    frame["cluster"] = (pd.to_numeric(dataframe["cluster"], errors="coerce").astype(np.float64).to_numpy()
+                        if "cluster" in columns else np.nan)
+    if MOOD_MASK in columns:
+        frame[MOOD_MASK] = dataframe[MOOD_MASK].to_numpy(dtype=np.uint32)
+    else:
+        frame[MOOD_MASK] = moods_to_masks(dataframe["moods"]) if "moods" in columns else np.uint32(0)
+    values = to_float32(dataframe.reindex(columns=features), features)
+    return pd.concat([frame, pd.DataFrame(values, index=frame.index, columns=features)], axis=1)
+
+
+def grouping_rows(tracks: pd.DataFrame, grouping: str) -> list:
+    """Get the row positions of the tracks in an aggregate frame that are in a group of a grouping, and the group of
+    each, in chunks of (rows, keys), where keys is a single group for a chunk in one group. Tracks without a cluster or
+    artist are left out, and tracks with several moods are in each of their groups, with one chunk per mood."""
+    if grouping == "all":
+        return [(np.arange(len(tracks)), ALL_TRACKS)]
+    if grouping == "cluster":
+        clusters = tracks["cluster"].to_numpy()
+        rows = np.flatnonzero(~np.isnan(clusters))
+        return [(rows, clusters[rows].astype(np.int64))]
+    if grouping == "artist":
+        artists = tracks["artist"].to_numpy(dtype=object)
+        rows = np.flatnonzero(artists != "")
+        return [(rows, artists[rows])]
+    masks = tracks[MOOD_MASK].to_numpy(dtype=np.uint32)
+    chunks = [(np.flatnonzero(masks & bit), mood) for mood, bit in MOOD_BITS.items()]
+    return [(rows, mood) for rows, mood in chunks if len(rows)]
+
+
+class GroupAggregates:
+    """Count, sum, and optionally a sketch, minimum and maximum of every feature in each group of one grouping, and the
+    number of tracks in each group. Groups are added as their first tracks arrive. Counts, sums and sketches go down
+    as tracks are taken away, but minimums and maximums keep the values ever added, and are narrowed to the outermost
+    bins of the sketch that still have values when they are read. Without a sketch they couldn't be narrowed, so
+    they aren't kept."""
+
+    def __init__(self, n_features: int, sketch: bool):
+        self.keys = []
+        self.positions = {}
+        self.tracks = np.zeros(0, dtype=np.int64)
+        self.count = np.zeros((0, n_features), dtype=np.int64)
+        self.total = np.zeros((0, n_features))
+        self.minimum = np.zeros((0, n_features))
+        self.maximum = np.zeros((0, n_features))
+        self.sketch = np.zeros((0, n_features, SKETCH_BINS), dtype=np.int32) if sketch else None
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def _group_positions(self, keys: list) -> np.ndarray:
+        """Get the position of each group, adding the groups that are new."""
+        new_keys = [key for key in keys if key not in self.positions]
+        if new_keys:
+            for key in new_keys:
+                self.positions[key] = len(self.keys)
+                self.keys.append(key)
+            n_new, n_features = len(new_keys), self.count.shape[1]
+            self.tracks = np.concatenate([self.tracks, np.zeros(n_new, dtype=np.int64)])
+            self.count = np.concatenate([self.count, np.zeros((n_new, n_features), dtype=np.int64)])
+            self.total = np.concatenate([self.total, np.zeros((n_new, n_features))])
+            self.minimum = np.concatenate([self.minimum, np.full((n_new, n_features), np.inf)])
+            self.maximum = np.concatenate([self.maximum, np.full((n_new, n_features), -np.inf)])
+            if self.sketch is not None:
+                self.sketch = np.concatenate([self.sketch,
+                                              np.zeros((n_new, n_features, SKETCH_BINS), dtype=np.int32)])
+        return np.array([self.positions[key] for key in keys], dtype=np.int64)
+
+    def add(self, keys: np.ndarray, values: np.ndarray, bins: np.ndarray, sign: int = 1):
+        """Add the feature values of tracks, and their sketch bins, to the group in `keys` of each track, or to `keys`
+        if it is a single group, or take them away if `sign` is -1. Missing values are left out."""
+        if len(values) == 0:
+            return
+        if np.ndim(keys) == 0:
+            codes, uniques = np.zeros(len(values), dtype=np.int64), [keys]
+        else:
+            codes, uniques = pd.factorize(keys)
+        at = self._group_positions(list(uniques))
+        # Tracks are sorted by group, so that every group is a run of rows reduced at once
+        if len(uniques) > 1 and (codes[1:] < codes[:-1]).any():
+            order = np.argsort(codes, kind="stable")
+            codes, values, bins = codes[order], values[order], bins[order]
+        # Features are read one at a time, so each is made contiguous
+        values, bins = np.asfortranarray(values), np.asfortranarray(bins)
+        starts = np.flatnonzero(np.concatenate([[True], codes[1:] != codes[:-1]]))
+        self.tracks[at] += sign * np.diff(np.append(starts, len(codes)))
+        for i in range(values.shape[1]):
+            column = values[:, i]
+            known = ~np.isnan(column)
+            self.count[at, i] += sign * np.add.reduceat(known, starts, dtype=np.int64)
+            self.total[at, i] += sign * np.add.reduceat(np.where(known, column, 0), starts, dtype=np.float64)
+            if sign > 0 and self.sketch is not None:
+                self.minimum[at, i] = np.fmin(self.minimum[at, i], np.fmin.reduceat(column, starts))
+                self.maximum[at, i] = np.fmax(self.maximum[at, i], np.fmax.reduceat(column, starts))
+            if self.sketch is not None:
+                counts = np.bincount(codes[known] * SKETCH_BINS + bins[known, i], minlength=len(at) * SKETCH_BINS)
+                self.sketch[at, i] += (sign * counts).reshape(len(at), SKETCH_BINS).astype(np.int32)
+
+    @classmethod
+    def merge(cls, parts: list, features: list = None) -> "GroupAggregates":
+        """Merge the groups of one grouping across layers of aggregates, for the given feature positions or every
+        feature. Layers without the feature kept as a sketch merge without a sketch."""
+        features = list(range(parts[0].count.shape[1])) if features is None else list(features)
+        sketch = all(part.sketch is not None for part in parts)
+        merged = cls(len(features), sketch)
+        if len(parts) == 1:
+            part = parts[0]
+            merged.keys, merged.positions, merged.tracks = part.keys, part.positions, part.tracks
+            merged.count, merged.total = part.count[:, features], part.total[:, features]
+            merged.minimum, merged.maximum = part.minimum[:, features], part.maximum[:, features]
+            merged.sketch = part.sketch[:, features] if sketch else None
+            return merged
+        codes, uniques = pd.factorize(pd.Series([key for part in parts for key in part.keys], dtype=object))
+        merged._group_positions(list(uniques))
+        np.add.at(merged.tracks, codes, np.concatenate([part.tracks for part in parts]))
+        np.add.at(merged.count, codes, np.concatenate([part.count[:, features] for part in parts]))
+        np.add.at(merged.total, codes, np.concatenate([part.total[:, features] for part in parts]))
+        np.fmin.at(merged.minimum, codes, np.concatenate([part.minimum[:, features] for part in parts]))
+        np.fmax.at(merged.maximum, codes, np.concatenate([part.maximum[:, features] for part in parts]))
+        if sketch:
+            np.add.at(merged.sketch, codes, np.concatenate([part.sketch[:, features] for part in parts]))
+        return merged
+
+    def bounds(self) -> tuple:
+        """Get the minimum and maximum of every feature in each group, narrowed by the sketch. Features without values
+        in a group, and groups without a sketch, have missing bounds."""
+        minimum, maximum = self.minimum.copy(), self.maximum.copy()
+        if self.sketch is not None:
+            filled = self.sketch > 0
+            lowest = np.where(filled.any(axis=2), filled.argmax(axis=2), 0)
+            highest = np.where(filled.any(axis=2), SKETCH_BINS - 1 - filled[:, :, ::-1].argmax(axis=2), 0)
+            minimum = np.maximum(minimum, BIN_LOWER[lowest])
+            maximum = np.minimum(maximum, BIN_UPPER[highest])
+        empty = (self.count <= 0) | (self.sketch is None)
+        minimum[empty] = np.nan
+        maximum[empty] = np.nan
+        return minimum, maximum
+
+
+class FeatureAggregates:
+    """Aggregates of the features of a set of tracks, in each of `GROUPINGS`. Aggregates can be a layer on top of base
+    aggregates, which are then never changed: the edits of a session, or a write to the master dataset, only add and
+    take away the changed tracks in a new layer, and a group is merged across the layers when it is read. A grouping
+    that was rebuilt in a layer, like clusters after clustering again, is not read from the layers below it."""
+
+    def __init__(self, features: list, base: "FeatureAggregates" = None):
+        self.features = list(features)
+        self.base = base
+        self.depth = base.depth + 1 if base is not None else 0
+        self.groupings = {grouping: GroupAggregates(len(self.features), grouping in SKETCH_GROUPINGS)
+                          for grouping in GROUPINGS}
+        self.replaced = set()
+
+    @classmethod
+    def from_frame(cls, dataframe: pd.DataFrame, features: list) -> "FeatureAggregates":
+        """Aggregate the features of every track in a dataframe."""
+        aggregates = cls(features)
+        aggregates.add_tracks(aggregate_frame(dataframe, features))
+        return aggregates
+
+    def add_tracks(self, tracks: pd.DataFrame, sign: int = 1, groupings: list = GROUPINGS):
+        """Add the tracks of an aggregate frame to their groups, or take them away if `sign` is -1."""
+        values = tracks[self.features].to_numpy(dtype=np.float32)
+        bins = sketch_bins(values)
+        for grouping in groupings:
+            for rows, keys in grouping_rows(tracks, grouping):
+                self.groupings[grouping].add(keys, values[rows], bins[rows], sign)
+
+    def update_tracks(self, old_tracks: pd.DataFrame, new_tracks: pd.DataFrame):
+        """Replace tracks, taking away their old values and adding their new ones."""
+        self.add_tracks(old_tracks, -1)
+        self.add_tracks(new_tracks)
+
+    def rebuild(self, grouping: str, tracks: pd.DataFrame):
+        """Aggregate a grouping of every track again in this layer, ignoring the layers below for that grouping."""
+        self.groupings[grouping] = GroupAggregates(len(self.features), grouping in SKETCH_GROUPINGS)
+        self.add_tracks(tracks, groupings=[grouping])
+        self.replaced.add(grouping)
+
+    def _layers(self, grouping: str) -> list:
+        layers, aggregates = [], self
+        while aggregates is not None:
+            layers.append(aggregates.groupings[grouping])
+            if grouping in aggregates.replaced:
+                break
+            aggregates = aggregates.base
+        return layers
+
+    def merged(self, grouping: str, features: list = None) -> GroupAggregates:
+        """Get the groups of a grouping merged across the layers, for the given features or every feature."""
+        positions = None if features is None else [self.features.index(feature) for feature in features]
+        return GroupAggregates.merge(self._layers(grouping), positions)
+
+    def group(self, grouping: str, key, features: list = None) -> GroupAggregates:
+        """Get one group of a grouping merged across the layers, which is empty if no track is in it."""
+        positions = None if features is None else [self.features.index(feature) for feature in features]
+        parts = []
+        for layer in self._layers(grouping):
+            part = GroupAggregates.merge([layer], positions)
+            if key in part.positions:
+                i = part.positions[key]
+                part.keys, part.positions, part.tracks = [key], {key: 0}, part.tracks[i:i + 1]
+                part.count, part.total = part.count[i:i + 1], part.total[i:i + 1]
+                part.minimum, part.maximum = part.minimum[i:i + 1], part.maximum[i:i + 1]
+                part.sketch = part.sketch[i:i + 1] if part.sketch is not None else None
+                parts.append(part)
+        if not parts:
+            empty = GroupAggregates(len(positions) if positions is not None else len(self.features),
+                                    grouping in SKETCH_GROUPINGS)
+            empty._group_positions([key])
+            return empty
+        return GroupAggregates.merge(parts)
+
+    def flatten(self) -> "FeatureAggregates":
+        """Get the same aggregates in a single layer."""
+        flat = FeatureAggregates(self.features)
+        for grouping in GROUPINGS:
+            merged = self.merged(grouping)
+            # Groups left empty by taken away tracks are dropped
+            kept = np.flatnonzero(merged.tracks > 0)
+            group = GroupAggregates(len(self.features), merged.sketch is not None)
+            group._group_positions([merged.keys[i] for i in kept])
+            group.tracks, group.count, group.total = merged.tracks[kept], merged.count[kept], merged.total[kept]
+            group.minimum, group.maximum = merged.minimum[kept], merged.maximum[kept]
+            group.sketch = merged.sketch[kept] if merged.sketch is not None else None
+            flat.groupings[grouping] = group
+        return flat
+
+    def table(self, grouping: str, feature: str) -> pd.DataFrame:
+        """Summarise a feature in every group of a grouping that has tracks: the number of tracks and of values, the
+        mean, and the minimum, maximum and median where the grouping keeps sketches."""
+        merged = self.merged(grouping, [feature])
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = merged.total[:, 0] / merged.count[:, 0]
+        table = pd.DataFrame({"tracks": merged.tracks, "values": merged.count[:, 0], "mean": mean},
+                             index=pd.Index(merged.keys, name=grouping))
+        if merged.sketch is not None:
+            minimum, maximum = merged.bounds()
+            table["min"], table["max"] = minimum[:, 0], maximum[:, 0]
+            table["median"] = [sketch_quantiles(merged.sketch[i, 0], [0.5], minimum[i, 0], maximum[i, 0])[0]
+                               for i in range(len(merged))]
+        return table[table["tracks"] > 0]
+
+    def histogram(self, grouping: str, key, feature: str, bins: int = HISTOGRAM_BINS) -> dict:
+        """Count the values of a feature in a group in equal-width bins, as `histogram_summary` does, from its
+        sketch. Each sketch bin is counted in the bin of the value it stands for."""
+        group = self.group(grouping, key, [feature])
+        minimum, maximum = group.bounds()
+        sketch = group.sketch[0, 0]
+        filled = sketch > 0
+        if not filled.any():
+            return {"counts": np.zeros(bins, dtype=np.int64), "edges": np.linspace(0, 1, bins + 1)}
+        values = np.clip(BIN_VALUES[filled], minimum[0, 0], maximum[0, 0])
+        counts, edges = np.histogram(values, bins=bins, range=(minimum[0, 0], maximum[0, 0]), weights=sketch[filled])
+        return {"counts": counts.astype(np.int64), "edges": edges}
+
+    def box(self, grouping: str, key, feature: str, max_outliers: int = MAX_OUTLIERS) -> dict:
+        """Get the quartiles, whiskers, mean and outliers of a feature in a group, as `box_summary` does, from its
+        sketch. Outliers are the values that outlying sketch bins stand for, at most `max_outliers` of them."""
+        group = self.group(grouping, key, [feature])
+        minimum, maximum = group.bounds()
+        sketch = group.sketch[0, 0]
+        if group.count[0, 0] <= 0:
+            return {"q1": np.nan, "median": np.nan, "q3": np.nan, "lowerfence": np.nan, "upperfence": np.nan,
+                    "mean": np.nan, "outliers": np.empty(0), "n_outliers": 0}
+        q1, median, q3 = sketch_quantiles(sketch, [0.25, 0.5, 0.75], minimum[0, 0], maximum[0, 0])
+        iqr = q3 - q1
+        filled = sketch > 0
+        values = np.clip(BIN_VALUES, minimum[0, 0], maximum[0, 0])
+        inside = filled & (values >= q1 - 1.5 * iqr) & (values <= q3 + 1.5 * iqr)
+        outside = filled & ~inside
+        outliers = values[outside]
+        if len(outliers) > max_outliers:
+            outliers = outliers[np.linspace(0, len(outliers) - 1, max_outliers).astype(np.int64)]
+        return {
+            "q1": q1,
+            "median": median,
+            "q3": q3,
+            "lowerfence": values[inside].min() if inside.any() else q1,
+            "upperfence": values[inside].max() if inside.any() else q3,
+            "mean": group.total[0, 0] / group.count[0, 0],
+            "outliers": outliers,
+            "n_outliers": int(sketch[outside].sum()),
+        }
+
+
+def upsert_tracks(aggregates: FeatureAggregates, tracks: pd.DataFrame, dataframe: pd.DataFrame,
+                  clear_empty: bool = False) -> tuple:
+    """Upsert the rows of a dataframe by track id the way `MasterStore.upsert` does, where missing values, and empty
+    values of the user columns unless `clear_empty`, keep the existing value. A new layer on top of the given
+    aggregates takes away the old values of the upserted tracks and adds their new ones; the given aggregates are left
+    unchanged.
+    `tracks` is the aggregate frame of every track counted so far. Returns the new aggregates and aggregate frame."""
+    dataframe = dataframe.drop_duplicates("id", keep="last")
+    new = aggregate_frame(dataframe, aggregates.features)
+    # Which values of each upserted track keep the existing value
+    sources = {"artist": "artist", "cluster": "cluster", MOOD_MASK: "moods", **{f: f for f in aggregates.features}}
+    keep_old = pd.DataFrame(index=new.index)
+    for col, source in sources.items():
+        if source not in dataframe.columns:
+            keep_old[col] = True
+            continue
+        values = dataframe[source]
+        empty = values.isna()
+        if source in USER_COLUMNS and not clear_empty:
+            empty |= values.astype(str) == ""
+        keep_old[col] = empty.to_numpy()
+
+    # The index of the aggregate frame keeps its lookup table, as long as no tracks are added
+    positions = tracks.index.get_indexer(new.index)
+    existing = positions >= 0
+    old = tracks.iloc[positions[existing]]
+    updated = new[existing][tracks.columns].where(~keep_old[existing][tracks.columns], old).astype(tracks.dtypes)
+    added = new[~existing][tracks.columns]
+
+    layer = FeatureAggregates(aggregates.features, base=aggregates)
+    layer.update_tracks(old, pd.concat([updated, added]))
+    for i, col in enumerate(tracks.columns):
+        if not updated[col].equals(old[col]):
+            tracks.iloc[positions[existing], i] = updated[col].to_numpy()
+    if len(added):
+        tracks = pd.concat([tracks, added])
+    if layer.depth > MAX_DEPTH:
+        layer = layer.flatten()
+    return layer, tracks
@@ -0,0 +1,266 @@
+"""
+Analysis store (Music Exploration Tool)
+Author: Yvonne Teo
+Description: This script keeps the bars, beats, segments and tatums of each audio analysis as compact float32 arrays,
+and derives timbre, chroma and rhythm features from them for clustering.
+"""
+
+# IMPORTS
+import json
+import os
+import shutil
+import threading
+
+import numpy as np
+import pandas as pd
+
+from locks import FileLock
+
+# DEFINITIONS
+ANALYSIS_STORE_PATH = "./pickles/analysis_store"
+MANIFEST = "manifest.json"
+# Chunks are merged into one once there are more than this
+MAX_CHUNKS = 16
+# Values kept for each item of every analysis array, in column order
+INTERVAL_FIELDS = ["start", "duration", "confidence"]
+SEGMENT_FIELDS = INTERVAL_FIELDS + ["loudness_start", "loudness_max", "loudness_max_time", "loudness_end"]
+ARRAY_FIELDS = {
+    "bars": INTERVAL_FIELDS,
+    "beats": INTERVAL_FIELDS,
+    "tatums": INTERVAL_FIELDS,
+    # Segments also hold their 12 pitch and 12 timbre values after the fields above
+    "segments": SEGMENT_FIELDS,
+}
+PITCH_CLASSES = ["C", "C#", "D", "D#", "E", "F", "F#", "G", "G#", "A", "A#", "B"]
+# Features derived from the arrays, which can be used for clustering
+analysis_cols = ([f"timbre_mean_{i}" for i in range(12)]
+                 + [f"timbre_var_{i}" for i in range(12)]
+                 + [f"chroma_{pitch_class}" for pitch_class in PITCH_CLASSES]
+                 + ["beat_regularity"])
+
+
+def analysis_arrays(analysis: dict) -> dict:
+    """Convert the bars, beats, segments and tatums of an audio analysis to float32 arrays, one row per item.
+    Values missing from an item are stored as NaN."""
+    arrays = {}
+    for kind, fields in ARRAY_FIELDS.items():
+        items = analysis.get(kind) or []
+        width = len(fields) + (24 if kind == "segments" else 0)
+        if kind == "segments":
+            rows = [[item.get(field, np.nan) for field in fields]
+                    + list(item.get("pitches") or [np.nan] * 12) + list(item.get("timbre") or [np.nan] * 12)
+                    for item in items]
+        else:
+            rows = [[item.get(field, np.nan) for field in fields] for item in items]
+        arrays[kind] = np.array(rows, dtype=np.float32).reshape(len(rows), width)
+    return arrays
+
+
+def _track_sums(values: np.ndarray, offsets: np.ndarray) -> np.ndarray:
+    """Sum the rows of each track, where the rows of track i are `values[offsets[i]:offsets[i + 1]]`."""
+    counts = np.diff(offsets)
+    sums = np.zeros((len(counts),) + values.shape[1:], dtype=np.float64)
+    filled = counts > 0
+    if filled.any():
+        sums[filled] = np.add.reduceat(values.astype(np.float64), offsets[:-1][filled], axis=0)
+    return sums
+
+
+def derive_features(values: dict, offsets: dict) -> np.ndarray:
+    """Derive `analysis_cols` for every track of a chunk at once.
+    Timbre and chroma are averaged over segments weighted by their duration; beat regularity is
+    1 minus the coefficient of variation of beat durations. Tracks without the arrays get NaN."""
+    segments, segment_offsets = values["segments"], offsets["segments"]
+    weights = np.nan_to_num(segments[:, 1:2]).astype(np.float64)
+    pitches = segments[:, len(SEGMENT_FIELDS):len(SEGMENT_FIELDS) + 12]
+    timbre = segments[:, len(SEGMENT_FIELDS) + 12:]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        total_weight = _track_sums(weights, segment_offsets)
+        timbre_mean = _track_sums(weights * timbre, segment_offsets) / total_weight
+        deviation = timbre - np.repeat(timbre_mean, np.diff(segment_offsets), axis=0)
+        timbre_var = _track_sums(weights * deviation ** 2, segment_offsets) / total_weight
+        chroma = _track_sums(weights * pitches, segment_offsets) / total_weight
+
+        beats, beat_offsets = values["beats"][:, 1:2], offsets["beats"]
+        beat_counts = np.diff(beat_offsets)[:, None]
+        beat_mean = _track_sums(beats, beat_offsets) / beat_counts
+        beat_var = _track_sums(beats.astype(np.float64) ** 2, beat_offsets) / beat_counts - beat_mean ** 2
+        beat_regularity = np.clip(1 - np.sqrt(np.maximum(beat_var, 0)) / beat_mean, 0, 1)
+    return np.hstack([timbre_mean, timbre_var, chroma, beat_regularity]).astype(np.float32)
+
+
+class AnalysisStore:
+    """Audio analysis arrays stored in chunks, each a directory with one .npy file per array kind.
+    The rows of every track are concatenated, with an offsets array giving where each track starts, so a
+    chunk can be memory-mapped and sliced by track id. Each chunk also stores the derived features of its
+    tracks. When a track is stored more than once, the latest chunk wins, and chunks are merged into one once there
+    are more than `MAX_CHUNKS`. Chunks are written under a lock on the
+    store directory, and the manifest is read again before every read and write, so that other processes, like the
+    command-line importer, can write to the same store."""
+
+    def __init__(self, path: str = ANALYSIS_STORE_PATH):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.manifest = {"next_chunk": 0, "chunks": []}
+        self._manifest_stat = None
+        self.lock = threading.RLock()
+        self.file_lock = FileLock(path)
+        self._index = None
+        self._derived = None
+        self._chunk_starts = None
+        self._read_manifest()
+
+    def _read_manifest(self):
+        """Read the manifest again if another process replaced it since it was last read, dropping what was loaded
+        from the old chunks."""
+        manifest_path = os.path.join(self.path, MANIFEST)
+        try:
+            stat = os.stat(manifest_path)
+        except FileNotFoundError:
+            return
+        if (stat.st_ino, stat.st_mtime_ns, stat.st_size) != self._manifest_stat:
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+            if manifest["chunks"] != self.manifest["chunks"]:
+                self._index = None
+                self._derived = None
+            self.manifest = manifest
+            self._manifest_stat = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    def _write_manifest(self):
+        tmp_path = os.path.join(self.path, MANIFEST + ".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(self.manifest, f)
+        os.replace(tmp_path, os.path.join(self.path, MANIFEST))
+        stat = os.stat(os.path.join(self.path, MANIFEST))
+        self._manifest_stat = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    @property
+    def index(self) -> pd.DataFrame:
+        """Chunk number and row of the latest stored arrays of each track id."""
+        with self.lock:
+            return self._load_index()
+
+    def _load_index(self) -> pd.DataFrame:
+        self._read_manifest()
+        if self._index is None:
+            parts = [pd.DataFrame({"chunk": i, "row": np.arange(len(ids))}, index=ids)
+                     for i, ids in enumerate(self._chunk_ids(chunk) for chunk in self.manifest["chunks"])]
+            index = pd.concat(parts) if parts else pd.DataFrame({"chunk": [], "row": []}, dtype=np.int64)
+            self._index = index[~index.index.duplicated(keep="last")]
+        return self._index
+
+    def _chunk_path(self, chunk: str, name: str) -> str:
+        return os.path.join(self.path, chunk, f"{name}.npy")
+
+    def _chunk_ids(self, chunk: str) -> np.ndarray:
+        return np.load(self._chunk_path(chunk, "ids"), allow_pickle=False)
+
+    def missing(self, track_ids: list) -> list:
+        """Get the track ids that have no stored arrays."""
+        present = pd.Index(track_ids).isin(self.index.index)
+        return [track_id for track_id, found in zip(track_ids, present) if not found]
+
+    def put_many(self, analyses: dict):
+        """Store the arrays of many tracks, keyed by track id, as one new chunk.
+        Values are dictionaries of arrays, as returned by `analysis_arrays`."""
+        if not analyses:
+            return
+        track_ids = list(analyses)
+        values, offsets = {}, {}
+        for kind in ARRAY_FIELDS:
+            arrays = [analyses[track_id][kind] for track_id in track_ids]
+            offsets[kind] = np.concatenate([[0], np.cumsum([len(array) for array in arrays])]).astype(np.int64)
+            values[kind] = np.concatenate(arrays).astype(np.float32)
+        with self.lock, self.file_lock:
+            self._read_manifest()
+            self.manifest["chunks"].append(self._write_chunk(track_ids, values, offsets,
+                                                             derive_features(values, offsets)))
+            self._write_manifest()
+            self._index = None
+            self._derived = None
+            if len(self.manifest["chunks"]) > MAX_CHUNKS:
+                self.compact()
+
+    def _write_chunk(self, track_ids: list, values: dict, offsets: dict, derived: np.ndarray) -> str:
+        """Write the arrays of some tracks as a new chunk, and get its name. Called with the store locked."""
+        chunk = f"chunk-{self.manifest['next_chunk']:06d}"
+        self.manifest["next_chunk"] += 1
+        # A chunk left behind by a write that was interrupted before its manifest was written is overwritten
+        os.makedirs(os.path.join(self.path, chunk), exist_ok=True)
+        np.save(self._chunk_path(chunk, "ids"), np.array(track_ids, dtype=str))
+        for kind in ARRAY_FIELDS:
+            np.save(self._chunk_path(chunk, kind), values[kind])
+            np.save(self._chunk_path(chunk, f"{kind}_offsets"), offsets[kind])
+        np.save(self._chunk_path(chunk, "derived"), derived)
+        return chunk
+
+    def compact(self):
+        """Merge every chunk into a single chunk with the latest arrays of each track id."""
+        with self.lock, self.file_lock:
+            index = self._load_index()
+            old_chunks = self.manifest["chunks"]
+            if len(old_chunks) <= 1:
+                return
+            track_ids, derived = [], []
+            values, lengths, offsets = {kind: [] for kind in ARRAY_FIELDS}, {kind: [] for kind in ARRAY_FIELDS}, {}
+            for chunk_number, chunk in enumerate(old_chunks):
+                # Tracks stored again in a later chunk are left out
+                rows = index[index["chunk"] == chunk_number].sort_values("row")
+                if rows.empty:
+                    continue
+                kept = np.zeros(len(self._chunk_ids(chunk)), dtype=bool)
+                kept[rows["row"].to_numpy(dtype=np.int64)] = True
+                track_ids.extend(rows.index)
+                for kind in ARRAY_FIELDS:
+                    counts = np.diff(np.load(self._chunk_path(chunk, f"{kind}_offsets")))
+                    values[kind].append(np.load(self._chunk_path(chunk, kind))[np.repeat(kept, counts)])
+                    lengths[kind].append(counts[kept])
+                derived.append(np.load(self._chunk_path(chunk, "derived"))[kept])
+            for kind in ARRAY_FIELDS:
+                offsets[kind] = np.concatenate([[0], np.cumsum(np.concatenate(lengths[kind]))]).astype(np.int64)
+                values[kind] = np.concatenate(values[kind])
+            self.manifest["chunks"] = [self._write_chunk(track_ids, values, offsets, np.concatenate(derived))]
+            self._write_manifest()
+            self._index = None
+            self._derived = None
+        for chunk in old_chunks:
+            shutil.rmtree(os.path.join(self.path, chunk), ignore_errors=True)
+
+    def get(self, track_id: str) -> dict:
+        """Get the arrays of one track, read from the memory-mapped chunk. Returns None if none are stored."""
+        with self.lock:
+            index = self._load_index()
+            if track_id not in index.index:
+                return None
+            chunk_number, row = index.loc[track_id, ["chunk", "row"]]
+            chunk = self.manifest["chunks"][chunk_number]
+        arrays = {}
+        for kind in ARRAY_FIELDS:
+            offsets = np.load(self._chunk_path(chunk, f"{kind}_offsets"), mmap_mode="r")
+            values = np.load(self._chunk_path(chunk, kind), mmap_mode="r")
+            arrays[kind] = np.asarray(values[offsets[row]:offsets[row + 1]])
+        return arrays
+
+    def derived(self, track_ids, columns: list = None) -> np.ndarray:
+        """Get derived features of the given tracks as float32, with NaN for tracks without stored arrays."""
+        with self.lock:
+            self._read_manifest()
+            if self._derived is None:
+                chunks = [np.load(self._chunk_path(chunk, "derived")) for chunk in self.manifest["chunks"]]
+                self._derived = (np.concatenate(chunks) if chunks
+                                 else np.empty((0, len(analysis_cols)), dtype=np.float32))
+                chunk_lengths = [len(chunk) for chunk in chunks]
+                self._chunk_starts = np.concatenate([[0], np.cumsum(chunk_lengths)]).astype(np.int64)
+            derived, chunk_starts, index = self._derived, self._chunk_starts, self._load_index()
+        positions = index.index.get_indexer(np.asarray(track_ids))
+        found = positions >= 0
+        rows = (chunk_starts[index["chunk"].to_numpy(dtype=np.int64)[positions[found]]]
+                + index["row"].to_numpy(dtype=np.int64)[positions[found]])
+        column_positions = [analysis_cols.index(column) for column in (columns or analysis_cols)]
+        features = np.full((len(positions), len(column_positions)), np.nan, dtype=np.float32)
+        features[found] = derived[np.ix_(rows, column_positions)]
+        return features
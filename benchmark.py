@@ -0,0 +1,252 @@
+"""
+Benchmark (Music Exploration Tool)
+Author: Yvonne Teo
+Description: This script times ingestion, master store writes and loads, clustering and figure building on synthetic
+libraries, and records the results so that regressions between versions can be caught.
+
+Usage: python benchmark.py [--sizes 1000 100000 1000000] [--results ./benchmarks/results.jsonl]
+Ingestion goes through the stub Spotify client, with its latency and rate limiting, for at most --ingest-tracks
+tracks, and is timed once per distinct number of tracks. Every other stage uses a synthetic library of the full size.
+Each result is compared with the median of the earlier runs of the same stage, size and rows, with the same settings
+and label, in the results file; the exit code is 1 if any stage is slower than --threshold times that median (and by
+more than 10 ms), and 0 otherwise.
+"""
+
+# IMPORTS
+import argparse
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+import numpy as np
+import pandas as pd
+import sklearn
+
+# Cached functions are defined and cleared outside a Streamlit app, which Streamlit warns about every time. Its loggers
+# get their level reset once its config is loaded, so the warnings are filtered out before the tool is imported
+for logger in ("streamlit.runtime.caching.cache_data_api", "streamlit.runtime.caching.cache_resource_api"):
+    logging.getLogger(logger).addFilter(lambda record: record.levelno >= logging.ERROR)
+
+from aggregates import ALL_TRACKS, FeatureAggregates, aggregate_frame, upsert_tracks
+from analysis_store import AnalysisStore
+from clustering import assign_clusters, fit_incremental, fit_kmeans, scale_features
+from core import PREAGGREGATE_MIN_ROWS, feature_cols, stream_create_df, visual_cols
+from feature_matrix import build_feature_matrix, load_feature_matrix
+from fetcher import TokenBucket
+from figures import box_figure, histogram_figure
+from master_store import MasterStore
+from moods import MOOD_MASK, MoodIndex, track_moods
+from stub_spotify import StubSpotify, synthetic_library
+
+# DEFINITIONS
+DEFAULT_SIZES = [1_000, 100_000, 1_000_000]
+RESULTS_PATH = "./benchmarks/results.jsonl"
+# Tracks fetched through the stub Spotify client, at most. Generating the stub's audio analyses takes most of the time
+INGEST_TRACKS = 1_000
+# Earlier runs of a stage whose median is the baseline
+BASELINE_RUNS = 5
+REGRESSION_THRESHOLD = 1.25
+# Slowdowns smaller than this many seconds are noise, whatever their ratio
+REGRESSION_MIN_SECONDS = 0.01
+# Share of the library changed by the incremental master store write
+UPDATE_SHARE = 0.01
+N_CLUSTERS = 5
+# Moods queried by the mood stages, which tag each track with about a quarter of all moods
+QUERY_MOODS = ["chill", "dark"]
+# Settings stored with every result, which must match for earlier runs to count towards its baseline
+BASELINE_SETTINGS = ["ingest_tracks", "latency", "rate_limit_every", "retry_after", "rate", "workers", "repeat",
+                     "label"]
+
+
+def git_commit() -> str:
+    """Get the short hash of the current commit, or None outside a git checkout."""
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def time_stage(func, repeat: int = 1) -> tuple:
+    """Run a stage `repeat` times. Returns the fastest time in seconds and the result of the last run."""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def run_size(size: int, args: argparse.Namespace, work_dir: str, ingest: bool = True) -> list:
+    """Run every stage for one library size, ingestion only if `ingest`. Returns (stage, seconds, rows) tuples."""
+    results = []
+
+    def stage(name, func, rows, repeat=args.repeat):
+        seconds, result = time_stage(func, repeat)
+        results.append((name, seconds, rows))
+        print(f"{size:>9} {name:<22} {seconds:>9.3f} s {rows / seconds if seconds else float('inf'):>12,.0f} rows/s",
+              file=sys.stderr, flush=True)
+        return result
+
+    # Ingestion through the stub client, with latency and 429s
+    ingest_tracks = min(size, args.ingest_tracks)
+    if ingest:
+        analysis_store = AnalysisStore(os.path.join(work_dir, f"analysis-{size}"))
+        stage("ingest", lambda: stream_create_df(
+            StubSpotify(n_tracks=ingest_tracks, latency=args.latency, rate_limit_every=args.rate_limit_every,
+                        retry_after=args.retry_after),
+            "benchmark", max_workers=args.workers, bucket=TokenBucket(rate=args.rate, capacity=max(1, int(args.rate))),
+            analysis_store=analysis_store), ingest_tracks, repeat=1)
+
+    library = synthetic_library(size)
+
+    def write_store():
+        new_store = MasterStore(os.path.join(work_dir, f"store-{size}-{uuid.uuid4().hex}"))
+        new_store.upsert(library)
+        return new_store
+
+    store = stage("store_write", write_store, size)
+    updated = library.sample(frac=UPDATE_SHARE, random_state=0)[["id", "moods"]].assign(moods="chill")
+    stage("store_update", lambda: store.upsert(updated), len(updated))
+    stage("store_load", lambda: store.load(), size)
+    stage("store_load_features", lambda: store.load(["id"] + feature_cols), size)
+
+    matrix_path = os.path.join(work_dir, f"matrix-{size}")
+    dataframe = store.load(["id"] + feature_cols)
+    stage("feature_matrix_build", lambda: build_feature_matrix(dataframe, feature_cols, store.version, matrix_path),
+          size)
+    matrix = load_feature_matrix(matrix_path)
+    features = stage("clustering_input", lambda: scale_features(matrix.select(visual_cols), []), size)
+    labels, centroids = stage("kmeans_fit", lambda: fit_kmeans(features, N_CLUSTERS), size)
+    stage("kmeans_incremental", lambda: fit_incremental(features, N_CLUSTERS, centroids), size)
+    stage("kmeans_assign", lambda: assign_clusters(features, centroids), size)
+
+    rng = np.random.default_rng(0)
+    masks = (rng.integers(0, 1 << len(track_moods), size) & rng.integers(0, 1 << len(track_moods), size))
+    mood_index = stage("mood_index_build", lambda: MoodIndex(masks), size)
+    stage("mood_query", lambda: mood_index.positions(QUERY_MOODS), size)
+    stage("mood_crosstab", lambda: mood_index.crosstab(labels), size)
+
+    # Aggregates of the library with the moods and clusters above, updated with the rows of the incremental write.
+    # Upserting the same rows again leaves the aggregate frame as it is, so every run does the same work
+    tracks = aggregate_frame(library.assign(**{MOOD_MASK: masks, "cluster": labels}), feature_cols)
+
+    def build_aggregates():
+        built = FeatureAggregates(feature_cols)
+        built.add_tracks(tracks)
+        return built
+
+    aggregates = stage("aggregates_build", build_aggregates, size)
+    stage("aggregates_upsert", lambda: upsert_tracks(aggregates, tracks, updated), len(updated))
+    stage("aggregates_summary", lambda: ([aggregates.box("all", ALL_TRACKS, column) for column in visual_cols[:5]],
+                                         aggregates.table("artist", visual_cols[0])), size)
+
+    # Figures are cached by Streamlit, so the cache is cleared before every run
+    preaggregate = size >= PREAGGREGATE_MIN_ROWS
+    columns = visual_cols[:5]
+    values = matrix.select(columns)
+
+    def build(builder, *builder_args):
+        builder.clear()
+        return builder(*builder_args)
+
+    histogram = stage("histogram_figure", lambda: build(histogram_figure, values, columns, preaggregate), size)
+    stage("box_figure", lambda: build(box_figure, values, columns, preaggregate), size)
+    stage("figure_json", lambda: histogram.to_json(), size)
+    return results
+
+
+def load_results(path: str) -> list:
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def baseline_key(record: dict) -> tuple:
+    """Get what a result is compared on: its stage, size and rows, and the settings of its run."""
+    settings = record.get("settings") or {}
+    return (record["stage"], record["size"], record["rows"],
+            tuple((name, settings.get(name)) for name in BASELINE_SETTINGS))
+
+
+def baseline(previous: list, record: dict) -> float:
+    """Get the median time of the latest earlier runs with the same baseline key as a result, or None if there are
+    none."""
+    key = baseline_key(record)
+    times = [earlier["seconds"] for earlier in previous if baseline_key(earlier) == key]
+    return float(np.median(times[-BASELINE_RUNS:])) if times else None
+
+
+def parse_args(argv: list = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark the music exploration tool on synthetic libraries.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES, help="library sizes in tracks")
+    parser.add_argument("--ingest-tracks", type=int, default=INGEST_TRACKS,
+                        help="most tracks fetched through the stub Spotify client")
+    parser.add_argument("--latency", type=float, default=0.005, help="seconds of latency per stub Spotify call")
+    parser.add_argument("--rate-limit-every", type=int, default=50,
+                        help="answer every n-th stub Spotify call with a 429 (0 for never)")
+    parser.add_argument("--retry-after", type=float, default=0.05, help="Retry-After of the stub's 429s in seconds")
+    parser.add_argument("--rate", type=float, default=1000.0, help="requests per second allowed by the rate limiter")
+    parser.add_argument("--workers", type=int, default=8, help="audio analysis requests in flight")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="runs per stage except ingestion, of which the fastest is recorded")
+    parser.add_argument("--results", default=RESULTS_PATH, help="JSON lines file the results are appended to")
+    parser.add_argument("--label", default="", help="label stored with the results, e.g. the machine")
+    parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD,
+                        help="slowdown against the median of earlier runs that counts as a regression")
+    return parser.parse_args(argv)
+
+
+def main(argv: list = None) -> int:
+    args = parse_args(argv)
+    previous = load_results(args.results)
+    run = {
+        "run": uuid.uuid4().hex,
+        "timestamp": time.time(),
+        "commit": git_commit(),
+        "label": args.label,
+        "settings": {name: getattr(args, name) for name in BASELINE_SETTINGS},
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "pandas": pd.__version__,
+        "sklearn": sklearn.__version__,
+    }
+    records = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        ingested = set()
+        for size in args.sizes:
+            # Sizes above --ingest-tracks all ingest the same number of tracks, so that is only timed once
+            ingest_tracks = min(size, args.ingest_tracks)
+            for stage, seconds, rows in run_size(size, args, work_dir, ingest_tracks not in ingested):
+                records.append({**run, "size": size, "stage": stage, "seconds": seconds, "rows": rows})
+            ingested.add(ingest_tracks)
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.results)), exist_ok=True)
+    with open(args.results, "a") as f:
+        for record in records:
+            f.write(json.dumps(record) + "\n")
+
+    regressions = 0
+    print(f"{'size':>9} {'stage':<22} {'seconds':>9} {'baseline':>9} {'ratio':>6}")
+    for record in records:
+        base = baseline(previous, record)
+        ratio = record["seconds"] / base if base else None
+        regressed = ratio is not None and ratio > args.threshold and record["seconds"] - base > REGRESSION_MIN_SECONDS
+        regressions += regressed
+        print(f"{record['size']:>9} {record['stage']:<22} {record['seconds']:>9.3f} "
+              f"{base if base is not None else float('nan'):>9.3f} {ratio if ratio is not None else float('nan'):>6.2f}"
+              f"{'  REGRESSION' if regressed else ''}")
+    print(f"Results appended to {args.results} (commit {run['commit']}); {regressions} regressions.")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
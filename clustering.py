@@ -0,0 +1,222 @@
+"""
+Clustering (Music Exploration Tool)
+Author: Yvonne Teo
+Description: This script includes the methods used to cluster tracks, either from scratch or incrementally from
+existing centroids.
+"""
+
+# IMPORTS
+import hashlib
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+import types
+
+import numpy as np
+
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+from metrics import metrics
+from sklearn.cluster import KMeans, MiniBatchKMeans
+from sklearn.metrics import pairwise_distances_argmin, silhouette_score
+from threadpoolctl import threadpool_limits
+
+# DEFINITIONS
+RANDOM_STATE = 42
+# Rows per partial_fit call of incremental clustering
+BATCH_SIZE = 4096
+# Numbers of clusters fitted by a sweep
+SWEEP_CLUSTERS = range(3, 10)
+# Tracks sampled to compute the silhouette score, which is quadratic in the number of tracks
+SILHOUETTE_SAMPLE = 5000
+# Size cap of the clustering result cache
+CACHE_MAX_ENTRIES = 64
+CACHE_MAX_BYTES = 256 * 1024 ** 2
+
+
+def feature_ranges(features: np.ndarray, scaled_positions: list) -> np.ndarray:
+    """Get the minimum and maximum of the given columns of a feature matrix, as a 2 x columns array."""
+    if not scaled_positions or len(features) == 0:
+        return np.zeros((2, len(scaled_positions)), dtype=np.float64)
+    columns = features[:, scaled_positions]
+    return np.vstack([np.nanmin(columns, axis=0), np.nanmax(columns, axis=0)]).astype(np.float64)
+
+
+def scale_features(features: np.ndarray, scaled_positions: list, ranges: np.ndarray = None) -> np.ndarray:
+    """Scale the given columns of a feature matrix to the range 0 to 1, or by the minimums and maximums in `ranges`
+    from `feature_ranges`, so that tracks are scaled the same way as the tracks that centroids were fitted to.
+    The matrix is copied first if it is read-only, e.g. memory-mapped."""
+    if not features.flags.writeable:
+        features = features.copy()
+    if scaled_positions:
+        if ranges is None:
+            ranges = feature_ranges(features, scaled_positions)
+        minimum, maximum = ranges
+        # Columns with a single value are scaled to 0, as `minmax_scale` does
+        spread = np.where(maximum > minimum, maximum - minimum, 1.0)
+        features[:, scaled_positions] = (features[:, scaled_positions] - minimum) / spread
+    return features
+
+
+@metrics.timed("kmeans_fit")
+def fit_kmeans(features: np.ndarray, n_clusters: int, random_state: int = RANDOM_STATE) -> tuple:
+    """Cluster tracks from scratch with k-means. Returns the labels and the centroids."""
+    kmeans = KMeans(n_clusters=n_clusters, random_state=random_state)
+    kmeans.fit(features)
+    return kmeans.labels_, kmeans.cluster_centers_
+
+
+@metrics.timed("kmeans_partial_fit")
+def fit_incremental(features: np.ndarray, n_clusters: int, init_centroids: np.ndarray = None,
+                    batch_size: int = BATCH_SIZE, random_state: int = RANDOM_STATE) -> tuple:
+    """Cluster tracks with mini-batch k-means, fed to `partial_fit` one batch at a time.
+    When `init_centroids` is given, clustering warm-starts from them instead of from scratch.
+    Returns the labels and the centroids."""
+    if init_centroids is not None:
+        kmeans = MiniBatchKMeans(n_clusters=n_clusters, init=np.asarray(init_centroids, dtype=features.dtype),
+                                 n_init=1, batch_size=batch_size, random_state=random_state)
+    else:
+        kmeans = MiniBatchKMeans(n_clusters=n_clusters, n_init=3, batch_size=batch_size, random_state=random_state)
+    # Shuffle the batches, so that tracks from the same playlist are not all in one batch
+    order = np.random.default_rng(random_state).permutation(len(features))
+    for start in range(0, len(features), batch_size):
+        batch = features[np.sort(order[start:start + batch_size])]
+        # The first batch has to hold at least one track per cluster
+        if start == 0 and len(batch) < n_clusters:
+            batch = features
+        kmeans.partial_fit(batch)
+    centroids = kmeans.cluster_centers_
+    return assign_clusters(features, centroids), centroids
+
+
+@metrics.timed("kmeans_assign")
+def assign_clusters(features: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    """Assign each track to the nearest existing centroid, without refitting."""
+    return pairwise_distances_argmin(features, np.asarray(centroids, dtype=features.dtype))
+
+
+def _fit_sweep_k(args) -> tuple:
+    """Fit k-means for one number of clusters in a worker process, reading the shared features from disk."""
+    path, n_clusters, random_state = args
+    features = np.load(path, mmap_mode="r")
+    # Each process uses one thread, so that the processes don't compete for cores
+    with threadpool_limits(limits=1):
+        kmeans = KMeans(n_clusters=n_clusters, random_state=random_state)
+        kmeans.fit(features)
+        silhouette = silhouette_score(features, kmeans.labels_, sample_size=min(len(features), SILHOUETTE_SAMPLE),
+                                      random_state=random_state)
+    return n_clusters, kmeans.labels_, kmeans.cluster_centers_, kmeans.inertia_, silhouette
+
+
+@contextmanager
+def _hide_main_module():
+    """Replace the `__main__` module with an empty one while worker processes start.
+    Streamlit runs every page as `__main__`, and spawned processes run the `__main__` module again on startup,
+    which would run the page in each worker. The workers only need this module, which they import by name."""
+    main_module = sys.modules["__main__"]
+    placeholder = types.ModuleType("__main__")
+    sys.modules["__main__"] = placeholder
+    try:
+        yield
+    finally:
+        # Another session may have started a page meanwhile, in which case its module is kept
+        if sys.modules["__main__"] is placeholder:
+            sys.modules["__main__"] = main_module
+
+
+@metrics.timed("kmeans_sweep")
+def sweep_kmeans(features: np.ndarray, cluster_counts=SWEEP_CLUSTERS, max_workers: int = None,
+                 random_state: int = RANDOM_STATE) -> dict:
+    """Fit k-means for every number of clusters in parallel, one process each.
+    The features are written to a temporary file once and memory-mapped by every process.
+    Returns the labels, centroids, inertia and sampled silhouette score for each number of clusters."""
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "features.npy")
+        np.save(path, np.ascontiguousarray(features))
+        # Workers are spawned rather than forked, since forking the app would copy its threads and their locks
+        with ProcessPoolExecutor(max_workers=max_workers or min(len(cluster_counts), os.cpu_count() or 1),
+                                 mp_context=multiprocessing.get_context("spawn")) as executor:
+            # Every task is submitted, and so every worker started, before map returns
+            with _hide_main_module():
+                sweep = executor.map(_fit_sweep_k, [(path, n_clusters, random_state) for n_clusters in cluster_counts])
+            for n_clusters, labels, centroids, inertia, silhouette in sweep:
+                results[n_clusters] = {
+                    "labels": labels,
+                    "centroids": centroids,
+                    "inertia": float(inertia),
+                    "silhouette": float(silhouette),
+                }
+    return results
+
+
+# CLUSTERING RESULT CACHE
+def fingerprint(array: np.ndarray) -> str:
+    """Hash the contents, shape and dtype of an array."""
+    array = np.ascontiguousarray(array)
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(f"{array.shape}{array.dtype}".encode())
+    digest.update(memoryview(array).cast("B"))
+    return digest.hexdigest()
+
+
+def clustering_result(features: np.ndarray, labels: np.ndarray, centroids: np.ndarray) -> dict:
+    """Collect the labels and centroids of a clustering with the size and feature means of each cluster."""
+    labels = np.asarray(labels)
+    n_clusters = len(centroids)
+    counts = np.bincount(labels, minlength=n_clusters)
+    sums = np.zeros((n_clusters, features.shape[1]), dtype=np.float64)
+    np.add.at(sums, labels, features)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        means = sums / counts[:, None]
+    return {"labels": labels, "centroids": np.asarray(centroids), "counts": counts, "means": means}
+
+
+class ClusterCache:
+    """Least recently used cache of clustering results, capped by number of entries and bytes.
+    Keys are built by `key` from a fingerprint of the input features and the clustering parameters."""
+
+    def __init__(self, max_entries: int = CACHE_MAX_ENTRIES, max_bytes: int = CACHE_MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(features_fingerprint: str, feature_names: list, n_clusters: int, mode: str = "full",
+            random_state: int = RANDOM_STATE, init_centroids: np.ndarray = None) -> tuple:
+        """Build a cache key. `init_centroids` are the centroids a warm start or assignment started from."""
+        init = fingerprint(np.asarray(init_centroids)) if init_centroids is not None else None
+        return features_fingerprint, tuple(feature_names), n_clusters, mode, random_state, init
+
+    @staticmethod
+    def _size(result: dict) -> int:
+        return sum(value.nbytes for value in result.values() if isinstance(value, np.ndarray))
+
+    def get(self, key):
+        """Get a cached result, or None if there is none."""
+        with self.lock:
+            result = self.entries.get(key)
+            if result is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return result
+
+    def put(self, key, result: dict):
+        """Cache a result, evicting the least recently used results beyond the size cap."""
+        with self.lock:
+            if key in self.entries:
+                self.nbytes -= self._size(self.entries.pop(key))
+            self.entries[key] = result
+            self.nbytes += self._size(result)
+            while len(self.entries) > 1 and (len(self.entries) > self.max_entries or self.nbytes > self.max_bytes):
+                _, evicted = self.entries.popitem(last=False)
+                self.nbytes -= self._size(evicted)
@@ -0,0 +1,492 @@
+"""
+Core (Music Exploration Tool)
+Author: Yvonne Teo
+Description: This script includes the data methods of the music exploration tool that don't depend on Streamlit, so
+that they can be used by the web app and by batch jobs alike.
+"""
+
+# IMPORTS
+import queue
+import requests
+import spotipy
+import threading
+
+import numpy as np
+import pandas as pd
+
+from analysis_store import AnalysisStore, analysis_arrays
+from contextlib import closing
+from fetcher import FetchReport, TokenBucket, fetch_concurrently, rate_limited_call
+from flatten_json import flatten
+from master_store import MasterStore
+from moods import MOOD_MASK, MoodIndex, moods_to_masks
+from os.path import exists, isdir
+from snapshots import SNAPSHOT_PREFIX, SnapshotStore, is_snapshot_reference, parse_snapshot_reference
+from spotipy.oauth2 import SpotifyClientCredentials
+from track_cache import TrackCache
+from urllib3.util.retry import Retry
+
+# DEFINITIONS
+# Define features that are relevant
+df_columns = [
+    "name",
+    "id",
+    "artist",
+    "tempo",
+    "time_signature",
+    "danceability",
+    "energy",
+    "key",
+    "loudness",
+    "mode",
+    "speechiness",
+    "acousticness",
+    "instrumentalness",
+    "liveness",
+    "valence",
+    "track_num_samples",
+    "track_duration",
+    "track_end_of_fade_in",
+    "track_start_of_fade_out",
+    "track_tempo_confidence",
+    "track_time_signature_confidence",
+    "track_key_confidence",
+    "track_mode_confidence",
+    "duration_ms",
+    "track_href",
+    "analysis_url"
+]
+
+visual_cols = [
+    "danceability",
+    "energy",
+    "speechiness",
+    "acousticness",
+    "instrumentalness",
+    "liveness",
+    "valence",
+    "track_tempo_confidence",
+    "track_time_signature_confidence",
+    "track_key_confidence",
+    "track_mode_confidence",
+]
+
+feature_cols = [
+    "tempo",
+    "time_signature",
+    "danceability",
+    "energy",
+    "speechiness",
+    "acousticness",
+    "instrumentalness",
+    "liveness",
+    "loudness",
+    "valence",
+    "track_num_samples",
+    "track_duration",
+    "track_tempo_confidence",
+    "track_time_signature_confidence",
+    "track_key_confidence",
+    "track_mode_confidence",
+    "duration_ms",
+]
+
+# Smallest dtypes that fit the range of each column, used by the compact schema.
+# Integers are nullable, since tracks whose audio features or analysis could not be fetched have missing values
+compact_dtypes = {
+    "artist": "category",
+    "tempo": "float32",
+    "time_signature": "Int8",
+    "danceability": "float32",
+    "energy": "float32",
+    "key": "Int8",
+    "loudness": "float32",
+    "mode": "Int8",
+    "speechiness": "float32",
+    "acousticness": "float32",
+    "instrumentalness": "float32",
+    "liveness": "float32",
+    "valence": "float32",
+    "track_num_samples": "Int32",
+    "track_duration": "float32",
+    "track_end_of_fade_in": "float32",
+    "track_start_of_fade_out": "float32",
+    "track_tempo_confidence": "float32",
+    "track_time_signature_confidence": "float32",
+    "track_key_confidence": "float32",
+    "track_mode_confidence": "float32",
+    "duration_ms": "Int32",
+    "moods": "category",
+    "cluster": "Int16",
+}
+
+# URLs that can be derived from the track id, so the compact schema does not store them
+url_templates = {
+    "track_href": "https://api.spotify.com/v1/tracks/{}",
+    "analysis_url": "https://api.spotify.com/v1/audio-analysis/{}",
+}
+
+# Plots summarise values on the server by default from this many tracks
+PREAGGREGATE_MIN_ROWS = 5000
+
+# Maximum number of track ids per audio features request
+FEATURES_BATCH_SIZE = 100
+# Number of playlist pages to read ahead while tracks are being processed
+PREFETCH_PAGES = 2
+# Seconds the page reader waits for room in the queue before checking whether it should stop
+PREFETCH_PUT_TIMEOUT = 0.1
+# Number of audio analysis requests kept in flight
+ANALYSIS_WORKERS = 8
+# Master dataframe pickle used before the master store, imported into the store on first use
+LEGACY_MASTER_PATH = "./pickles/spotify_master_df.pkl"
+
+
+# HELPER METHODS
+# GETTING DATA
+def save_df(dataframe: pd.DataFrame, snapshots: SnapshotStore = None) -> str:
+    """Save a dataframe so that it doesn't need to be imported over and over again.
+    It is saved as a snapshot, which only stores the rows changed since the last snapshot. Returns its reference."""
+    snapshot = (snapshots or SnapshotStore()).save(dataframe)
+    return f"{SNAPSHOT_PREFIX}{snapshot['id']}"
+
+
+def load_df(file_path: str, snapshots: SnapshotStore = None) -> pd.DataFrame:
+    """Load a dataframe from a snapshot reference, a pickle, or a master store if the path is a directory."""
+    if is_snapshot_reference(file_path):
+        return restore_df(file_path, snapshots or SnapshotStore())
+    if isdir(file_path):
+        return MasterStore(file_path).load()
+    dataframe = pd.read_pickle(file_path)
+    return dataframe
+
+
+def restore_df(reference: str, snapshots: SnapshotStore) -> pd.DataFrame:
+    """Load a snapshot, replaying the journal up to the entry given in the reference, e.g. "snapshot:3@120"."""
+    snapshot_id, journal_seq = parse_snapshot_reference(reference)
+    dataframe = snapshots.restore(snapshot_id)
+    if journal_seq is not None:
+        apply_track_edits(dataframe, snapshots.journal_edits(snapshots.get(snapshot_id)["journal_seq"], journal_seq))
+    return dataframe
+
+
+def open_master_store(path: str) -> MasterStore:
+    """Open the master store, importing the legacy master dataframe pickle into it the first time."""
+    store = MasterStore(path)
+    if store.is_empty() and exists(LEGACY_MASTER_PATH):
+        store.upsert(pd.read_pickle(LEGACY_MASTER_PATH))
+    return store
+
+
+# Spotipy (Spotify API) Configuration
+def spotify_session() -> requests.Session:
+    """Create the HTTP session of a Spotipy client, which retries server errors but not 429s.
+    urllib3 retries any response with a Retry-After header by default, which would make each worker thread sleep
+    through a 429 on its own, so those are raised to `rate_limited_call` to pause the shared token bucket instead."""
+    session = requests.Session()
+    retry = Retry(total=10,
+                  connect=None,
+                  read=False,
+                  allowed_methods=frozenset(["GET", "POST", "PUT", "DELETE"]),
+                  status=10,
+                  backoff_factor=0.3,
+                  status_forcelist=(500, 502, 503, 504),
+                  respect_retry_after_header=False)
+    adapter = requests.adapters.HTTPAdapter(max_retries=retry)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def make_spotify(user_cid, user_secret) -> spotipy.Spotify:
+    """Create a Spotipy (Spotify API for Python) client from client credentials."""
+    client_credentials_manager = SpotifyClientCredentials(
+        client_id=user_cid, client_secret=user_secret)
+    my_spotipy = spotipy.Spotify(client_credentials_manager=client_credentials_manager,
+                                 requests_session=spotify_session(),
+                                 requests_timeout=10)
+    return my_spotipy
+
+
+# Get Spotify playlist data
+def iter_playlist_pages(sp, playlist_id, bucket: TokenBucket = None, offset: int = 0):
+    """Yield every page of playlist items from `offset` onwards, following the `next` link of each page."""
+    page = rate_limited_call(bucket, sp.playlist_items, playlist_id=playlist_id, offset=offset)
+    while page:
+        yield page
+        page = rate_limited_call(bucket, sp.next, page) if page.get("next") else None
+
+
+# Read Spotify playlist pages in the background
+def prefetch_playlist_pages(sp, playlist_id, bucket: TokenBucket = None, depth: int = PREFETCH_PAGES,
+                            offset: int = 0):
+    """Yield playlist pages as they arrive while later pages are read on a background thread.
+    The thread stops once the pages stop being consumed, whether they were all read or not."""
+    pages = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    done = object()
+
+    def put(item) -> bool:
+        """Put an item in the queue once there is room, unless the consumer stopped first."""
+        while not stop.is_set():
+            try:
+                pages.put(item, timeout=PREFETCH_PUT_TIMEOUT)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def read_pages():
+        try:
+            for page in iter_playlist_pages(sp, playlist_id, bucket, offset):
+                if not put(page):
+                    return
+        except Exception as e:
+            put(e)
+        put(done)
+
+    threading.Thread(target=read_pages, daemon=True).start()
+    try:
+        while True:
+            page = pages.get()
+            if page is done:
+                return
+            if isinstance(page, Exception):
+                raise page
+            yield page
+    finally:
+        # Runs when the consumer stops early too, e.g. when a job is paused or the generator is closed
+        stop.set()
+        while True:
+            try:
+                pages.get_nowait()
+            except queue.Empty:
+                break
+
+
+# Get Spotify playlist dataframe
+def get_artists(track_artist: list) -> str:
+    """Get artists as a string from nested structure."""
+    track_artists = []
+    for artist_list in track_artist:
+        track_artists.append(artist_list["name"])
+    artist = ", ".join(track_artists)
+    return artist
+
+
+# Split track ids into batches the Spotify API accepts
+def chunk_ids(track_ids: list, size: int = FEATURES_BATCH_SIZE) -> list:
+    """Split a list of track ids into chunks of at most `size` ids."""
+    return [track_ids[i:i + size] for i in range(0, len(track_ids), size)]
+
+
+# Get audio features for many track ids through Spotify API
+def get_audio_features_batch(sp, track_ids: list, bucket: TokenBucket = None) -> dict:
+    """Get audio features of many tracks from Spotify API, keyed by track id.
+    Tracks are requested in chunks of up to 100 ids per call."""
+    features = {}
+    for chunk in chunk_ids(track_ids):
+        for track_features in rate_limited_call(bucket, sp.audio_features, tracks=chunk):
+            # Spotify returns None for tracks without audio features
+            if track_features is not None:
+                features[track_features["id"]] = track_features
+    return features
+
+
+# Flatten audio analysis into a single record
+def flatten_analysis(analysis: dict) -> dict:
+    """Drop the large nested arrays from an audio analysis and flatten the rest."""
+    remove_keys = ["bars", "beats", "segments", "tatums", "meta"]
+    for key in remove_keys:
+        analysis.pop(key, None)
+    return flatten(analysis)
+
+
+# Fetch audio analysis, keeping its arrays before flattening it
+def fetch_analysis(sp, track_id, keep_arrays: bool = False) -> tuple:
+    """Get the flat audio analysis of a track from Spotify API, and its arrays as float32 if `keep_arrays` is set."""
+    analysis = sp.audio_analysis(track_id=track_id)
+    arrays = analysis_arrays(analysis) if keep_arrays else None
+    return flatten_analysis(analysis), arrays
+
+
+# Create records from Spotify playlist items
+def build_track_records(sp, items: list, max_workers: int = ANALYSIS_WORKERS, fetch_report: FetchReport = None,
+                        bucket: TokenBucket = None, cache: TrackCache = None,
+                        analysis_store: AnalysisStore = None) -> list:
+    """Build one flat record per track from playlist items.
+    Only tracks missing from the track cache, if one is given, are requested from Spotify API:
+    audio features in batches, and audio analysis with `max_workers` requests
+    in flight. Tracks whose analysis fails are left out and recorded in `fetch_report`.
+    The bars, beats, segments and tatums of fetched analyses are kept in `analysis_store`, if one is given."""
+    # Skip local files and removed tracks, which have no Spotify id
+    tracks = [item["track"] for item in items
+              if item.get("track") and item["track"].get("id")]
+    track_ids = [track["id"] for track in tracks]
+
+    features = cache.get_many("features", track_ids) if cache is not None else {}
+    fetched_features = get_audio_features_batch(sp, [i for i in track_ids if i not in features], bucket)
+    if cache is not None:
+        cache.put_many("features", fetched_features)
+    features.update(fetched_features)
+
+    analysis_ids = [track_id for track_id in track_ids if track_id in features]
+    analyses = cache.get_many("analysis", analysis_ids) if cache is not None else {}
+    # Cached analyses are fetched again once if their arrays were never stored, since the cache only keeps them flat
+    missing_arrays = set(analysis_store.missing(analysis_ids)) if analysis_store is not None else set()
+    # The large analysis arrays are converted to float32 inside each worker, as soon as the payload arrives
+    fetched = fetch_concurrently(
+        lambda track_id: fetch_analysis(sp, track_id, analysis_store is not None),
+        [track_id for track_id in analysis_ids if track_id not in analyses or track_id in missing_arrays],
+        max_workers=max_workers,
+        bucket=bucket,
+        report=fetch_report)
+    fetched_analyses = {track_id: flat for track_id, (flat, _) in fetched.items()}
+    if analysis_store is not None:
+        analysis_store.put_many({track_id: arrays for track_id, (_, arrays) in fetched.items()})
+    if cache is not None:
+        cache.put_many("analysis", fetched_analyses)
+    analyses.update(fetched_analyses)
+
+    records = []
+    for track in tracks:
+        track_id = track["id"]
+        if track_id not in analyses:
+            continue
+        record = dict(features[track_id])
+        record.update(analyses[track_id])
+        record["artist"] = get_artists(track["artists"])
+        record["name"] = track["name"]
+        records.append(record)
+    return records
+
+
+# Create a dataframe from Spotify playlist while its pages are still loading
+def stream_create_df(sp, playlist_id, progress_callback=None, max_workers: int = ANALYSIS_WORKERS,
+                     fetch_report: FetchReport = None, bucket: TokenBucket = None, cache: TrackCache = None,
+                     analysis_store: AnalysisStore = None) -> pd.DataFrame:
+    """Create a dataframe from every page of the Spotify playlist.
+    Tracks on each page are processed as soon as the page arrives, and
+    `progress_callback(done, total)` is called after each page."""
+    records = []
+    # Closing the pages stops the background reader as soon as a page fails, rather than when it is garbage collected
+    with closing(prefetch_playlist_pages(sp, playlist_id, bucket)) as pages:
+        for page in pages:
+            records.extend(build_track_records(sp, page["items"], max_workers, fetch_report, bucket, cache,
+                                               analysis_store))
+            if progress_callback is not None:
+                progress_callback(page["offset"] + len(page["items"]), page["total"])
+    dataframe = pd.DataFrame.from_records(records)
+    return dataframe
+
+
+# Clean dataframe to only take the columns we want
+def clean_df(dataframe: pd.DataFrame) -> pd.DataFrame:
+    """Clean dataframe to only take relevant columns and add relevant columns."""
+    dataframe = dataframe[df_columns].copy()
+    new_columns = ["moods", "notes", "cluster"]
+    for col in new_columns:
+        if col not in dataframe.columns:
+            dataframe[col] = ""
+    return dataframe
+
+
+# Compact dataframe to use less memory per session
+def compact_df(dataframe: pd.DataFrame) -> tuple:
+    """Convert a cleaned dataframe to the compact schema, and get the number of bytes saved.
+    Numbers use the smallest dtype that fits, repeated strings become categoricals,
+    empty clusters become missing values, and URLs are dropped since they can be derived from the id."""
+    compact = dataframe.drop(columns=[col for col in url_templates if col in dataframe.columns])
+    for col, dtype in compact_dtypes.items():
+        if col not in compact.columns:
+            continue
+        if dtype != "category":
+            values = compact[col].replace("", None) if compact[col].dtype == object else compact[col]
+            compact[col] = pd.to_numeric(values, errors="coerce").astype(dtype)
+        else:
+            compact[col] = compact[col].astype(dtype)
+    bytes_saved = dataframe.memory_usage(deep=True).sum() - compact.memory_usage(deep=True).sum()
+    return compact, int(bytes_saved)
+
+
+# Add the URLs left out of the compact schema back to a dataframe
+def add_track_urls(dataframe: pd.DataFrame) -> pd.DataFrame:
+    """Derive the track and audio analysis URLs of each track from its id."""
+    dataframe = dataframe.copy()
+    for col, template in url_templates.items():
+        dataframe[col] = [template.format(track_id) for track_id in dataframe["id"]]
+    return dataframe
+
+
+# Set a value in the rows of a dataframe, whatever the dtype of the column
+def set_track_value(dataframe: pd.DataFrame, rows, col: str, value):
+    """Set a value in the given rows of a column, adding it as a category first if the column is categorical."""
+    if isinstance(dataframe[col].dtype, pd.CategoricalDtype) and value not in dataframe[col].cat.categories:
+        dataframe[col] = dataframe[col].cat.add_categories([value])
+    dataframe.loc[rows, col] = value
+
+
+# Find the tracks to show on a page of the Data page, without sending the whole dataframe to the browser
+def query_tracks(dataframe: pd.DataFrame, search: str = "", moods: list = None, sort_by: str = None,
+                 ascending: bool = True, match_all: bool = True, mood_index: MoodIndex = None) -> np.ndarray:
+    """Get the row positions of the tracks whose name or artist contains `search` and that have every given mood, or
+    any of them if not `match_all`, sorted by a column. Text columns are sorted as strings.
+    Moods are looked up in `mood_index` if given, which must be built from the rows of the dataframe."""
+    keep = np.ones(len(dataframe), dtype=bool)
+    if moods:
+        if mood_index is None:
+            masks = dataframe[MOOD_MASK] if MOOD_MASK in dataframe.columns else moods_to_masks(dataframe["moods"])
+            mood_index = MoodIndex(masks)
+        keep = mood_index.matches(moods, match_all)
+    if search:
+        # Only the tracks with the moods are searched
+        rows = np.flatnonzero(keep)
+        keep[rows] = (dataframe["name"].iloc[rows].astype(str).str.contains(search, case=False, regex=False)
+                      | dataframe["artist"].iloc[rows].astype(str).str.contains(search, case=False,
+                                                                                 regex=False)).to_numpy()
+    positions = np.flatnonzero(keep)
+    if sort_by:
+        values = dataframe[sort_by].iloc[positions].reset_index(drop=True)
+        if values.dtype == object:
+            values = values.astype(str)
+        order = values.sort_values(ascending=ascending, kind="stable", na_position="last").index.to_numpy()
+        positions = positions[order]
+    return positions
+
+
+# Key the cell edits of a page of the Data page by track id
+def edits_by_id(page: pd.DataFrame, edited_rows: dict) -> dict:
+    """Convert edited cells, keyed by row position in the page as `st.data_editor` reports them, to
+    a dictionary of the changed values of each track id."""
+    track_ids = page["id"].to_numpy()
+    return {track_ids[int(row)]: dict(changes) for row, changes in edited_rows.items() if changes}
+
+
+# Apply edits keyed by track id to a dataframe
+def apply_track_edits(dataframe: pd.DataFrame, edits: dict):
+    """Set the edited values of each track id in place, one column at a time. Tracks and columns that aren't in
+    the dataframe are left out. The mood bitmasks of tracks whose moods were edited are updated with them."""
+    by_column = {}
+    for track_id, changes in edits.items():
+        for col, value in changes.items():
+            by_column.setdefault(col, {})[track_id] = value
+    for col, values in by_column.items():
+        if col not in dataframe.columns:
+            continue
+        rows = dataframe["id"].isin(list(values))
+        if not rows.any():
+            continue
+        new_values = dataframe.loc[rows, "id"].map(values)
+        if isinstance(dataframe[col].dtype, pd.CategoricalDtype):
+            new_categories = set(new_values.dropna()) - set(dataframe[col].cat.categories)
+            if new_categories:
+                dataframe[col] = dataframe[col].cat.add_categories(sorted(new_categories, key=str))
+        dataframe.loc[rows, col] = new_values.to_numpy()
+        if col == "moods" and MOOD_MASK in dataframe.columns:
+            dataframe.loc[rows, MOOD_MASK] = moods_to_masks(new_values)
+
+
+# Turn edits keyed by track id into rows for the master store
+def edits_df(edits: dict) -> pd.DataFrame:
+    """Get a dataframe with one row per edited track and only the edited columns, with missing values for the
+    cells that weren't edited, so that upserting it into the master store keeps their stored values."""
+    return pd.DataFrame.from_dict(edits, orient="index").rename_axis("id").reset_index()
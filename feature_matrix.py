@@ -0,0 +1,135 @@
+"""
+Feature matrix (Music Exploration Tool)
+Author: Yvonne Teo
+Description: This script stores the numeric features of the master dataset as a float32 matrix on disk, which is
+memory-mapped so that every session shares one read-only copy.
+"""
+
+# IMPORTS
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from sklearn.decomposition import IncrementalPCA
+
+# DEFINITIONS
+FEATURE_MATRIX_PATH = "./pickles/feature_matrix"
+# Rows converted to float32 at a time while the matrix is written
+WRITE_CHUNK = 100_000
+# Rows fed to the 2-D projection at a time
+PROJECTION_CHUNK = 50_000
+
+
+class FeatureMatrix:
+    """Read-only float32 matrix with one row per track, and the track id of each row."""
+
+    def __init__(self, matrix: np.ndarray, ids: np.ndarray, columns: list, version: int):
+        self.matrix = matrix
+        self.ids = ids
+        self.columns = columns
+        self.version = version
+        self._row_index = None
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @property
+    def row_index(self) -> pd.Index:
+        """Index from track id to row number."""
+        if self._row_index is None:
+            self._row_index = pd.Index(self.ids)
+        return self._row_index
+
+    def column_positions(self, columns: list) -> list:
+        return [self.columns.index(column) for column in columns]
+
+    def select(self, columns: list = None, track_ids=None) -> np.ndarray:
+        """Get the given columns for the given track ids.
+        Returns the memory-mapped matrix itself, without copying, when every row and column is selected."""
+        rows = slice(None)
+        if track_ids is not None:
+            track_ids = np.asarray(track_ids)
+            if not (len(track_ids) == len(self.ids) and (track_ids == self.ids).all()):
+                rows = self.row_index.get_indexer(track_ids)
+                if (rows < 0).any():
+                    raise KeyError("Some track ids are not in the feature matrix.")
+        if columns is None or list(columns) == self.columns:
+            return self.matrix[rows]
+        positions = self.column_positions(columns)
+        if isinstance(rows, slice):
+            return self.matrix[:, positions]
+        return self.matrix[np.ix_(rows, positions)]
+
+
+def to_float32(dataframe: pd.DataFrame, columns: list) -> np.ndarray:
+    """Convert columns of a dataframe to a float32 matrix, treating anything non-numeric as missing."""
+    return dataframe[columns].apply(pd.to_numeric, errors="coerce").to_numpy(dtype=np.float32, na_value=np.nan)
+
+
+def build_feature_matrix(dataframe: pd.DataFrame, columns: list, version: int, path: str = FEATURE_MATRIX_PATH):
+    """Write the given columns of a dataframe as a float32 matrix, with the track ids and columns next to it."""
+    os.makedirs(path, exist_ok=True)
+    matrix = np.lib.format.open_memmap(os.path.join(path, "matrix.tmp.npy"), mode="w+",
+                                       dtype=np.float32, shape=(len(dataframe), len(columns)))
+    for start in range(0, len(dataframe), WRITE_CHUNK):
+        matrix[start:start + WRITE_CHUNK] = to_float32(dataframe.iloc[start:start + WRITE_CHUNK], columns)
+    matrix.flush()
+    del matrix
+    np.save(os.path.join(path, "ids.tmp.npy"), dataframe["id"].to_numpy(dtype=str))
+    os.replace(os.path.join(path, "matrix.tmp.npy"), os.path.join(path, "matrix.npy"))
+    os.replace(os.path.join(path, "ids.tmp.npy"), os.path.join(path, "ids.npy"))
+    with open(os.path.join(path, "meta.json"), "w") as f:
+        json.dump({"version": version, "columns": columns}, f)
+
+
+def load_feature_matrix(path: str = FEATURE_MATRIX_PATH):
+    """Memory-map a feature matrix read-only. Returns None if there is no feature matrix at the path."""
+    meta_path = os.path.join(path, "meta.json")
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path) as f:
+        meta = json.load(f)
+    matrix = np.load(os.path.join(path, "matrix.npy"), mmap_mode="r")
+    ids = np.load(os.path.join(path, "ids.npy"), mmap_mode="r")
+    return FeatureMatrix(matrix, ids, meta["columns"], meta["version"])
+
+
+def build_projection(matrix: FeatureMatrix, path: str = FEATURE_MATRIX_PATH) -> np.ndarray:
+    """Project the standardised feature matrix to 2-D with incremental PCA, one chunk at a time,
+    and save the projection next to the matrix with the version it was built from."""
+    features = matrix.matrix
+    mean = np.nanmean(features, axis=0)
+    std = np.nanstd(features, axis=0)
+    std[std == 0] = 1
+
+    def standardised(start):
+        return np.nan_to_num((features[start:start + PROJECTION_CHUNK] - mean) / std)
+
+    # Every chunk passed to partial_fit needs at least as many rows as components
+    pca = IncrementalPCA(n_components=2)
+    starts = range(0, len(features), PROJECTION_CHUNK)
+    for start in starts:
+        chunk = standardised(start)
+        if len(chunk) >= 2:
+            pca.partial_fit(chunk)
+    projection = np.zeros((len(features), 2), dtype=np.float32)
+    if hasattr(pca, "components_"):
+        for start in starts:
+            projection[start:start + PROJECTION_CHUNK] = pca.transform(standardised(start))
+    np.save(os.path.join(path, "projection.npy"), projection)
+    with open(os.path.join(path, "projection.json"), "w") as f:
+        json.dump({"version": matrix.version}, f)
+    return projection
+
+
+def load_projection(version: int, path: str = FEATURE_MATRIX_PATH):
+    """Load the 2-D projection if it was built from the given version. Returns None otherwise."""
+    meta_path = os.path.join(path, "projection.json")
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path) as f:
+        if json.load(f)["version"] != version:
+            return None
+    return np.load(os.path.join(path, "projection.npy"))
@@ -0,0 +1,149 @@
+"""
+Fetcher (Music Exploration Tool)
+Author: Yvonne Teo
+Description: This script fetches data from the Spotify API concurrently while respecting its rate limits.
+"""
+
+# IMPORTS
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from spotipy import SpotifyException
+
+# DEFINITIONS
+# Number of requests kept in flight by default
+DEFAULT_WORKERS = 8
+# Requests per second handed out by the shared token bucket, and the burst allowed
+DEFAULT_RATE = 20.0
+DEFAULT_BURST = 20
+# Retries for a rate-limited request, and the wait used when Spotify sends no Retry-After header
+MAX_RETRIES = 5
+DEFAULT_RETRY_AFTER = 1.0
+
+
+# RATE LIMITING
+class TokenBucket:
+    """Token bucket shared by every worker thread, so the request rate is limited across all of them."""
+
+    def __init__(self, rate: float = DEFAULT_RATE, capacity: int = DEFAULT_BURST):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a token is available, then take it."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + max(0.0, now - self.updated) * self.rate)
+                self.updated = max(self.updated, now)
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate + max(0.0, self.updated - now)
+            time.sleep(wait)
+
+    def pause(self, seconds: float):
+        """Stop handing out tokens for `seconds`, e.g. after a 429 response."""
+        with self.lock:
+            self.tokens = 0.0
+            self.updated = max(self.updated, time.monotonic() + seconds)
+
+
+def retry_after_seconds(error: SpotifyException) -> float:
+    """Get the number of seconds to wait from the Retry-After header of a 429 response."""
+    headers = error.headers or {}
+    try:
+        return float(headers.get("Retry-After", DEFAULT_RETRY_AFTER))
+    except (TypeError, ValueError):
+        return DEFAULT_RETRY_AFTER
+
+
+# REPORTING
+class FetchReport:
+    """Per-request latencies, retries and errors collected while fetching."""
+
+    def __init__(self):
+        self.latencies = []
+        self.retries = 0
+        self.errors = {}
+        self.lock = threading.Lock()
+
+    def add_latency(self, seconds: float):
+        with self.lock:
+            self.latencies.append(seconds)
+
+    def add_retry(self):
+        with self.lock:
+            self.retries += 1
+
+    def add_error(self, key, error: Exception):
+        with self.lock:
+            self.errors[key] = error
+
+    def summary(self) -> dict:
+        """Summarise the report as request count, retries, errors and latency percentiles in milliseconds."""
+        latencies = sorted(self.latencies)
+
+        def percentile(q):
+            if not latencies:
+                return 0.0
+            return latencies[min(len(latencies) - 1, int(q * len(latencies)))] * 1000
+
+        return {
+            "requests": len(latencies),
+            "retries": self.retries,
+            "errors": len(self.errors),
+            "p50_ms": round(percentile(0.5), 1),
+            "p95_ms": round(percentile(0.95), 1),
+            "max_ms": round(latencies[-1] * 1000, 1) if latencies else 0.0,
+        }
+
+
+# FETCHING
+def rate_limited_call(bucket: TokenBucket, func, *args, report: FetchReport = None, **kwargs):
+    """Call `func` once a token is available, waiting out any 429 responses for every worker."""
+    for attempt in range(MAX_RETRIES + 1):
+        if bucket is not None:
+            bucket.acquire()
+        start = time.perf_counter()
+        try:
+            result = func(*args, **kwargs)
+        except SpotifyException as e:
+            if e.http_status != 429 or attempt == MAX_RETRIES:
+                raise
+            if bucket is not None:
+                bucket.pause(retry_after_seconds(e))
+            else:
+                time.sleep(retry_after_seconds(e))
+            if report is not None:
+                report.add_retry()
+            continue
+        if report is not None:
+            report.add_latency(time.perf_counter() - start)
+        return result
+
+
+def fetch_concurrently(func, keys: list, max_workers: int = DEFAULT_WORKERS, bucket: TokenBucket = None,
+                       report: FetchReport = None) -> dict:
+    """Call `func(key)` for every key with up to `max_workers` requests in flight.
+    Returns the results keyed by key; keys that fail are recorded in the report and left out."""
+    report = report if report is not None else FetchReport()
+    results = {}
+
+    def fetch(key):
+        # Whether the fetch worked is returned rather than looked up in the report, which may be shared across calls
+        try:
+            return key, True, rate_limited_call(bucket, func, key, report=report)
+        except Exception as e:
+            report.add_error(key, e)
+            return key, False, None
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        for key, ok, result in executor.map(fetch, keys):
+            if ok:
+                results[key] = result
+    return results
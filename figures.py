@@ -0,0 +1,189 @@
+"""
+Figures (Music Exploration Tool)
+Author: Yvonne Teo
+Description: This script builds the Plotly figures used across the pages from NumPy arrays. Figures are memoised by
+their inputs, so that a rerun with the same selection doesn't build them again.
+"""
+
+# IMPORTS
+import numpy as np
+import pandas as pd
+import plotly.colors as pc
+import plotly.graph_objects as go
+import plotly.subplots as sp
+import streamlit as st
+
+from methods import get_box_summary, get_histogram_summary
+from metrics import metrics
+
+# DEFINITIONS
+# Track traces drawn on a radar plot at most
+MAX_RADAR_TRACES = 50
+# Figures kept per builder; figures are shared, so pages must not change them after they are built
+FIGURE_CACHE_ENTRIES = 32
+
+
+def show_figure(fig: go.Figure, **kwargs):
+    """Show a figure on the page, timing how long it takes to serialise and send to the browser."""
+    with metrics.timer("plotly_chart"):
+        st.plotly_chart(fig, **kwargs)
+
+
+# VISUALISATIONS
+@metrics.counted("track_radar_figure")
+@st.cache_resource(max_entries=FIGURE_CACHE_ENTRIES)
+@metrics.timed("track_radar_figure", measure_size=True)
+def track_radar_figure(names: list, values: np.ndarray, features: list) -> go.Figure:
+    """Radar plot of features with one trace per track, for at most `MAX_RADAR_TRACES` tracks."""
+    names, values = names[:MAX_RADAR_TRACES], values[:MAX_RADAR_TRACES]
+    # Repeat the first feature at the end to close each shape
+    theta = features + features[:1]
+    closed = np.concatenate([values, values[:, :1]], axis=1)
+    fig = go.Figure(data=[go.Scatterpolar(r=r, theta=theta, fill="toself", opacity=0.5, name=name,
+                                          hovertext=[name] * len(theta))
+                          for name, r in zip(names, closed)])
+    fig.update_layout(polar=dict(radialaxis=dict(visible=True, range=[0, 1])), showlegend=False)
+    fig.update_layout(height=600, width=800)
+    return fig
+
+
+@metrics.counted("histogram_figure")
+@st.cache_resource(max_entries=FIGURE_CACHE_ENTRIES)
+@metrics.timed("histogram_figure", measure_size=True)
+def histogram_figure(values: np.ndarray, columns: list, preaggregate: bool, summaries: list = None) -> go.Figure:
+    """Overlaid histograms with one trace per column, binned on the server when `preaggregate` is set.
+    The bins of each column are taken from `summaries` instead of the values when given, like those of aggregates."""
+    traces = []
+    for i, column in enumerate(columns):
+        if summaries is not None or preaggregate:
+            summary = summaries[i] if summaries is not None else get_histogram_summary(values[:, i])
+            edges = summary["edges"]
+            traces.append(go.Bar(x=(edges[:-1] + edges[1:]) / 2, y=summary["counts"], width=edges[1:] - edges[:-1],
+                                 opacity=0.7, name=column))
+        else:
+            traces.append(go.Histogram(x=values[:, i], opacity=0.7, name=column))
+    fig = go.Figure(data=traces)
+    fig.update_layout(barmode="overlay",
+                      bargap=0.1,
+                      xaxis=dict(title="Value", title_font=dict(size=14)),
+                      yaxis=dict(title="Frequency", title_font=dict(size=14)))
+    return fig
+
+
+@metrics.counted("box_figure")
+@st.cache_resource(max_entries=FIGURE_CACHE_ENTRIES)
+@metrics.timed("box_figure", measure_size=True)
+def box_figure(values: np.ndarray, features: list, preaggregate: bool, summaries: list = None) -> go.Figure:
+    """Box plots with one box per feature, computed on the server when `preaggregate` is set.
+    The statistics of each feature are taken from `summaries` instead of the values when given."""
+    fig = go.Figure()
+    colors = pc.qualitative.Plotly
+    for i, feature in enumerate(features):
+        color = colors[i % len(colors)]
+        if summaries is not None or preaggregate:
+            # Box statistics computed on the server, with a sample of the outliers drawn as points
+            summary = summaries[i] if summaries is not None else get_box_summary(values[:, i])
+            fig.add_trace(go.Box(x=[feature], q1=[summary["q1"]], median=[summary["median"]], q3=[summary["q3"]],
+                                 lowerfence=[summary["lowerfence"]], upperfence=[summary["upperfence"]],
+                                 mean=[summary["mean"]], name=feature, marker_color=color))
+            fig.add_trace(go.Scatter(x=[feature] * len(summary["outliers"]), y=summary["outliers"], mode="markers",
+                                     name=f"{feature} outliers ({summary['n_outliers']} in total)",
+                                     showlegend=False, marker_color=color))
+        else:
+            fig.add_trace(go.Box(y=values[:, i], name=feature, boxpoints="all", jitter=0.3, marker_color=color))
+    fig.update_layout(title="Box Plots of Selected Features",
+                      yaxis_title="Feature",
+                      xaxis_title="Value",
+                      violinmode="group",
+                      showlegend=True)
+    return fig
+
+
+# CLUSTERING
+@metrics.counted("cluster_radar_figure")
+@st.cache_resource(max_entries=FIGURE_CACHE_ENTRIES)
+@metrics.timed("cluster_radar_figure", measure_size=True)
+def cluster_radar_figure(df_mean: pd.DataFrame, clusters: list, features: list) -> go.Figure:
+    """Radar plot of the mean features of each selected cluster."""
+    fig = go.Figure()
+    colors = pc.qualitative.Plotly
+    means = df_mean.set_index("cluster")[features]
+    theta = features + features[:1]
+    for cluster in clusters:
+        if cluster not in means.index:
+            continue
+        r = means.loc[cluster].to_numpy()
+        fig.add_trace(go.Scatterpolar(r=np.append(r, r[:1]), theta=theta, opacity=0.6, fill="toself",
+                                      name=f"Cluster {cluster}", fillcolor=colors[cluster % len(colors)],
+                                      line=dict(color="rgba(0,0,0,0)")))
+    fig.update_layout(polar=dict(radialaxis=dict(visible=True, range=[0, means.to_numpy().max(initial=0)])),
+                      showlegend=True)
+    fig.update_layout(height=600, width=800)
+    return fig
+
+
+@metrics.counted("cluster_bar_figure")
+@st.cache_resource(max_entries=FIGURE_CACHE_ENTRIES)
+@metrics.timed("cluster_bar_figure", measure_size=True)
+def cluster_bar_figure(df_mean: pd.DataFrame, columns: list) -> go.Figure:
+    """Grid of bar charts of the mean of each column by cluster, with one grouped trace per column."""
+    colors = pc.qualitative.Plotly
+    num_rows = (len(columns) + 2) // 3
+    clusters = df_mean["cluster"].to_numpy()
+    bar_colors = [colors[cluster % len(colors)] for cluster in clusters]
+    means = df_mean[columns].to_numpy()
+
+    fig = sp.make_subplots(rows=num_rows, cols=3, subplot_titles=columns)
+    for i, column in enumerate(columns):
+        row, col = i // 3 + 1, i % 3 + 1
+        fig.add_trace(go.Bar(x=clusters, y=means[:, i], name=column, marker=dict(color=bar_colors),
+                             hovertext=[f"Cluster {cluster}" for cluster in clusters]), row=row, col=col)
+        fig.update_xaxes(title_text="Cluster", row=row, col=col)
+        fig.update_yaxes(title_text=column, row=row, col=col)
+    fig.update_layout(title_text="Average of Columns by Cluster",
+                      grid=dict(rows=num_rows, columns=3),
+                      height=500 * num_rows,
+                      showlegend=False,
+                      margin=dict(l=20, r=20, t=60, b=50),
+                      width=1000)
+    return fig
+
+
+# MOODS
+@metrics.counted("mood_counts_figure")
+@st.cache_resource(max_entries=FIGURE_CACHE_ENTRIES)
+@metrics.timed("mood_counts_figure", measure_size=True)
+def mood_counts_figure(counts: pd.Series) -> go.Figure:
+    """Bar chart of the number of tracks with each mood."""
+    fig = go.Figure(go.Bar(x=counts.index, y=counts.to_numpy(), marker_color=pc.qualitative.Plotly[0]))
+    fig.update_layout(xaxis=dict(title="Mood", title_font=dict(size=14)),
+                      yaxis=dict(title="Tracks", title_font=dict(size=14)))
+    return fig
+
+
+@metrics.counted("mood_cluster_figure")
+@st.cache_resource(max_entries=FIGURE_CACHE_ENTRIES)
+@metrics.timed("mood_cluster_figure", measure_size=True)
+def mood_cluster_figure(crosstab: pd.DataFrame) -> go.Figure:
+    """Heatmap of the number of tracks with each mood in each cluster, from a cross-tab with one row per mood."""
+    fig = go.Figure(go.Heatmap(x=[f"Cluster {cluster}" for cluster in crosstab.columns], y=crosstab.index,
+                               z=crosstab.to_numpy(), colorscale="Viridis", colorbar=dict(title="Tracks")))
+    fig.update_layout(height=700, xaxis=dict(title="Cluster"), yaxis=dict(title="Mood", autorange="reversed"))
+    return fig
+
+
+# GROUP SUMMARIES
+@metrics.counted("group_summary_figure")
+@st.cache_resource(max_entries=FIGURE_CACHE_ENTRIES)
+@metrics.timed("group_summary_figure", measure_size=True)
+def group_summary_figure(table: pd.DataFrame, feature: str) -> go.Figure:
+    """Bar chart of the mean of a feature in each group of a summary table, with its minimum and maximum as error
+    bars."""
+    mean = table["mean"].to_numpy()
+    fig = go.Figure(go.Bar(x=[str(key) for key in table.index], y=mean, marker_color=pc.qualitative.Plotly[0],
+                           error_y=dict(type="data", symmetric=False, array=table["max"].to_numpy() - mean,
+                                        arrayminus=mean - table["min"].to_numpy()),
+                           customdata=table["tracks"].to_numpy(), hovertemplate="%{x}: %{y} (%{customdata} tracks)"))
+    fig.update_layout(xaxis=dict(title=str(table.index.name).capitalize(), title_font=dict(size=14)),
+                      yaxis=dict(title=f"Mean {feature}", title_font=dict(size=14)))
+    return fig
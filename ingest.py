@@ -0,0 +1,181 @@
+"""
+Ingest (Music Exploration Tool)
+Author: Yvonne Teo
+Description: This script imports a file of Spotify playlists into the master store from the command line, without
+Streamlit, so that large imports can run from cron or a worker instead of the web app.
+
+Usage: python ingest.py playlists.txt [--workers 8] [--playlist-workers 2] [--store ./pickles/master_store]
+Spotify credentials are read from --cid and --secret, or from SPOTIPY_CLIENT_ID and SPOTIPY_CLIENT_SECRET.
+Exit codes: 0 if everything was imported, 1 if some playlists or tracks failed, 2 for bad arguments or
+credentials, and 3 if nothing could be imported.
+"""
+
+# IMPORTS
+import argparse
+import os
+import sys
+import time
+
+from analysis_store import ANALYSIS_STORE_PATH, AnalysisStore
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from core import ANALYSIS_WORKERS, clean_df, make_spotify, open_master_store, stream_create_df
+from fetcher import DEFAULT_RATE, FetchReport, TokenBucket
+from master_store import MASTER_STORE_PATH, MasterStore
+from metrics import metrics
+from spotipy.oauth2 import SpotifyOauthError
+from track_cache import TRACK_CACHE_PATH, TrackCache
+
+# DEFINITIONS
+EXIT_OK = 0
+EXIT_PARTIAL = 1
+EXIT_USAGE = 2
+EXIT_FAILED = 3
+# Playlists imported at the same time, each with its own audio analysis workers
+PLAYLIST_WORKERS = 2
+
+
+def log(message: str):
+    """Write a progress message to stderr, so that stdout only holds the summary."""
+    print(message, file=sys.stderr, flush=True)
+
+
+def read_playlist_ids(path: str) -> list:
+    """Read one playlist id or URL per line, skipping blank lines, comments and repeated playlists.
+    The path `-` reads from stdin."""
+    f = sys.stdin if path == "-" else open(path)
+    with f:
+        lines = [line.split("#", 1)[0].strip() for line in f]
+    return list(dict.fromkeys(line for line in lines if line))
+
+
+def ingest_playlist(sp, playlist_id: str, max_workers: int, bucket: TokenBucket, cache: TrackCache,
+                    analysis_store: AnalysisStore = None, quiet: bool = False) -> tuple:
+    """Fetch one playlist. Returns the cleaned dataframe, or None for an empty playlist, and its fetch report."""
+    fetch_report = FetchReport()
+
+    def show_progress(done, total):
+        if not quiet:
+            log(f"{playlist_id}: fetched {done} of {total} tracks")
+
+    with metrics.timer("stream_create_df"):
+        dataframe = stream_create_df(sp, playlist_id, show_progress, max_workers, fetch_report, bucket, cache,
+                                     analysis_store)
+    if dataframe.empty:
+        return None, fetch_report
+    return clean_df(dataframe), fetch_report
+
+
+def ingest(sp, playlist_ids: list, store: MasterStore, max_workers: int = ANALYSIS_WORKERS,
+           playlist_workers: int = PLAYLIST_WORKERS, bucket: TokenBucket = None, cache: TrackCache = None,
+           analysis_store: AnalysisStore = None, quiet: bool = False) -> dict:
+    """Import playlists into the master store, `playlist_workers` at a time through one shared rate limiter.
+    Each playlist is written to the store as soon as it is fetched, so a failed run keeps the playlists already done.
+    Returns the number of tracks imported, tracks that failed and error of each playlist."""
+    bucket = bucket or TokenBucket()
+    results = {}
+    with ThreadPoolExecutor(max_workers=playlist_workers) as executor:
+        futures = {executor.submit(ingest_playlist, sp, playlist_id, max_workers, bucket, cache, analysis_store,
+                                   quiet): playlist_id
+                   for playlist_id in playlist_ids}
+        for future in as_completed(futures):
+            playlist_id = futures[future]
+            try:
+                dataframe, fetch_report = future.result()
+            except Exception as e:
+                results[playlist_id] = {"tracks": 0, "failed": 0, "error": f"{type(e).__name__}: {e}"}
+                log(f"{playlist_id}: failed ({results[playlist_id]['error']})")
+                continue
+            # The store is only written from this thread
+            if dataframe is not None:
+                with metrics.timer("save_master_df"):
+                    store.upsert(dataframe)
+            report = fetch_report.summary()
+            results[playlist_id] = {"tracks": 0 if dataframe is None else len(dataframe),
+                                    "failed": report["errors"], "error": None}
+            log(f"{playlist_id}: imported {results[playlist_id]['tracks']} tracks, {report['errors']} failed, "
+                f"{report['retries']} rate-limit retries")
+    return results
+
+
+def exit_code(results: dict) -> int:
+    """Get the exit code for the results of an import."""
+    if not results or all(result["error"] is not None for result in results.values()):
+        return EXIT_FAILED
+    if any(result["error"] is not None or result["failed"] for result in results.values()):
+        return EXIT_PARTIAL
+    return EXIT_OK
+
+
+def parse_args(argv: list = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Import Spotify playlists into the master store.")
+    parser.add_argument("playlists", help="file with one playlist id or URL per line, or - for stdin")
+    parser.add_argument("--cid", default=os.environ.get("SPOTIPY_CLIENT_ID"),
+                        help="Spotify client id (default: $SPOTIPY_CLIENT_ID)")
+    parser.add_argument("--secret", default=os.environ.get("SPOTIPY_CLIENT_SECRET"),
+                        help="Spotify client secret (default: $SPOTIPY_CLIENT_SECRET)")
+    parser.add_argument("--store", default=MASTER_STORE_PATH, help="master store directory")
+    parser.add_argument("--workers", type=int, default=ANALYSIS_WORKERS,
+                        help="audio analysis requests in flight per playlist")
+    parser.add_argument("--playlist-workers", type=int, default=PLAYLIST_WORKERS,
+                        help="playlists imported at the same time")
+    parser.add_argument("--rate", type=float, default=DEFAULT_RATE,
+                        help="Spotify API requests per second across every worker")
+    parser.add_argument("--track-cache", default=TRACK_CACHE_PATH, help="track cache file")
+    parser.add_argument("--no-track-cache", action="store_true", help="fetch every track from Spotify API")
+    parser.add_argument("--analysis-store", default=ANALYSIS_STORE_PATH,
+                        help="directory for the bars, beats, segments and tatums of each track")
+    parser.add_argument("--no-analysis-arrays", action="store_true",
+                        help="don't keep the bars, beats, segments and tatums of each track")
+    parser.add_argument("--metrics", help="append timings to this file as JSON lines, "
+                                           "or write them in the Prometheus text format if it ends in .prom")
+    parser.add_argument("--quiet", action="store_true", help="only report finished playlists")
+    args = parser.parse_args(argv)
+    if not args.cid or not args.secret:
+        parser.error("Spotify credentials are missing: pass --cid and --secret, "
+                     "or set SPOTIPY_CLIENT_ID and SPOTIPY_CLIENT_SECRET.")
+    if args.workers < 1 or args.playlist_workers < 1 or args.rate <= 0:
+        parser.error("--workers, --playlist-workers and --rate must be positive.")
+    return args
+
+
+def main(argv: list = None) -> int:
+    args = parse_args(argv)
+    try:
+        playlist_ids = read_playlist_ids(args.playlists)
+    except OSError as e:
+        log(f"Could not read playlists: {e}")
+        return EXIT_USAGE
+    if not playlist_ids:
+        log("No playlists to import.")
+        return EXIT_USAGE
+
+    sp = make_spotify(args.cid, args.secret)
+    try:
+        sp.auth_manager.get_access_token(as_dict=False)
+    except SpotifyOauthError as e:
+        log(f"Spotify rejected the credentials: {e}")
+        return EXIT_USAGE
+    cache = None if args.no_track_cache else TrackCache(args.track_cache)
+    analysis_store = None if args.no_analysis_arrays else AnalysisStore(args.analysis_store)
+    store = open_master_store(args.store)
+    start = time.perf_counter()
+    results = ingest(sp, playlist_ids, store, args.workers, args.playlist_workers,
+                     TokenBucket(rate=args.rate, capacity=max(1, int(args.rate))), cache, analysis_store, args.quiet)
+
+    failed_playlists = [playlist_id for playlist_id, result in results.items() if result["error"] is not None]
+    print(f"Imported {sum(result['tracks'] for result in results.values())} tracks from "
+          f"{len(results) - len(failed_playlists)} of {len(results)} playlists in "
+          f"{time.perf_counter() - start:.1f} s; {sum(result['failed'] for result in results.values())} tracks "
+          f"failed; master store has {store.num_rows} tracks (version {store.version}).")
+    for playlist_id in failed_playlists:
+        print(f"Failed: {playlist_id} ({results[playlist_id]['error']})")
+    if args.metrics:
+        if cache is not None:
+            for kind, stats in cache.stats().items():
+                metrics.set_cache_stats(f"track_cache_{kind}", stats["hits"], stats["misses"])
+        metrics.write(args.metrics)
+    return exit_code(results)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,197 @@
+"""
+Jobs (Music Exploration Tool)
+Author: Yvonne Teo
+Description: This script runs playlist imports as background jobs, so that a long import doesn't block the web app.
+Jobs are checkpointed after every page of the playlist, so an import interrupted by a crash or restart resumes from
+the last page instead of starting over.
+"""
+
+# IMPORTS
+import glob
+import json
+import os
+import queue
+import shutil
+import threading
+import time
+import uuid
+
+import pandas as pd
+
+from analysis_store import AnalysisStore
+from contextlib import closing
+from core import ANALYSIS_WORKERS, build_track_records, clean_df, make_spotify, prefetch_playlist_pages, save_df
+from fetcher import FetchReport, TokenBucket
+from master_store import MasterStore
+from snapshots import SnapshotStore
+from track_cache import TrackCache
+
+# DEFINITIONS
+JOBS_PATH = "./cache/jobs"
+# Jobs run at the same time, each with its own audio analysis workers
+JOB_WORKERS = 1
+# Finished and failed jobs kept on disk, newest first
+MAX_FINISHED_JOBS = 20
+# Job statuses
+QUEUED = "queued"
+RUNNING = "running"
+INTERRUPTED = "interrupted"
+DONE = "done"
+FAILED = "failed"
+
+
+class JobQueue:
+    """Local queue of playlist imports, run by background worker threads.
+    Each job is a directory holding its state as JSON and one pickled chunk of tracks per playlist page.
+    Jobs left queued or running by a previous process are marked interrupted. They resume from their last
+    checkpoint once the credentials for their Spotify CID are given again, since secrets are only kept in memory."""
+
+    def __init__(self, store: MasterStore, cache: TrackCache = None, bucket: TokenBucket = None,
+                 analysis_store: AnalysisStore = None, snapshots: SnapshotStore = None, path: str = JOBS_PATH,
+                 workers: int = JOB_WORKERS, make_client=make_spotify):
+        self.store = store
+        self.cache = cache
+        self.analysis_store = analysis_store
+        self.snapshots = snapshots or SnapshotStore()
+        self.bucket = bucket or TokenBucket()
+        self.path = path
+        self.make_client = make_client
+        self.clients = {}
+        self.pending = queue.Queue()
+        self.lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+        for job in self.jobs():
+            if job["status"] in (QUEUED, RUNNING):
+                job["status"] = INTERRUPTED
+                self._save(job)
+        for _ in range(workers):
+            threading.Thread(target=self._work, daemon=True).start()
+
+    def _job_path(self, job_id: str, name: str = "") -> str:
+        return os.path.join(self.path, job_id, name)
+
+    def _save(self, job: dict):
+        job["updated_at"] = time.time()
+        tmp_path = self._job_path(job["id"], "job.json.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(job, f)
+        os.replace(tmp_path, self._job_path(job["id"], "job.json"))
+
+    def get(self, job_id: str) -> dict:
+        """Get the state of a job, or None if there is no such job."""
+        try:
+            with open(self._job_path(job_id, "job.json")) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def jobs(self) -> list:
+        """Get the state of every job, newest first."""
+        jobs = [self.get(job_id) for job_id in os.listdir(self.path)]
+        return sorted([job for job in jobs if job is not None], key=lambda job: job["created_at"], reverse=True)
+
+    def submit(self, cid: str, secret: str, playlist_id: str, max_workers: int = ANALYSIS_WORKERS) -> str:
+        """Queue the import of a playlist. Returns the id of the job.
+        Interrupted jobs with the same Spotify CID are resumed as well."""
+        self.resume(cid, secret)
+        job_id = uuid.uuid4().hex
+        os.makedirs(self._job_path(job_id))
+        job = {
+            "id": job_id,
+            "cid": cid,
+            "playlist_id": playlist_id,
+            "max_workers": max_workers,
+            "status": QUEUED,
+            "created_at": time.time(),
+            "next_offset": 0,
+            "total": None,
+            "tracks": 0,
+            # Tracks imported from each page by offset, so a page fetched again after a crash isn't counted twice
+            "page_tracks": {},
+            "failed": 0,
+            "retries": 0,
+            "file_path": None,
+            "error": None,
+        }
+        self._save(job)
+        self.pending.put(job_id)
+        return job_id
+
+    def resume(self, cid: str, secret: str) -> list:
+        """Queue the interrupted jobs with the given Spotify CID again. Returns their ids."""
+        with self.lock:
+            self.clients[cid] = self.make_client(cid, secret)
+            resumed = []
+            for job in self.jobs():
+                if job["status"] == INTERRUPTED and job["cid"] == cid:
+                    job["status"] = QUEUED
+                    self._save(job)
+                    self.pending.put(job["id"])
+                    resumed.append(job["id"])
+        return resumed
+
+    def retry(self, job_id: str) -> bool:
+        """Queue a failed job again from its last checkpoint.
+        Returns False if the credentials for its Spotify CID are not known in this process."""
+        with self.lock:
+            job = self.get(job_id)
+            if job is None or job["status"] != FAILED or job["cid"] not in self.clients:
+                return False
+            job["status"] = QUEUED
+            job["error"] = None
+            self._save(job)
+            self.pending.put(job_id)
+        return True
+
+    def _work(self):
+        while True:
+            job = self.get(self.pending.get())
+            if job is None or job["status"] != QUEUED:
+                continue
+            try:
+                self._run(job)
+            except Exception as e:
+                job["status"] = FAILED
+                job["error"] = f"{type(e).__name__}: {e}"
+                self._save(job)
+
+    def _run(self, job: dict):
+        """Import a playlist from the last checkpoint of the job, saving a chunk after every page."""
+        job["status"] = RUNNING
+        self._save(job)
+        sp = self.clients[job["cid"]]
+        fetch_report = FetchReport()
+        failed, retries = job["failed"], job["retries"]
+        page_tracks = job.setdefault("page_tracks", {})
+        with closing(prefetch_playlist_pages(sp, job["playlist_id"], self.bucket, offset=job["next_offset"])) as pages:
+            for page in pages:
+                records = build_track_records(sp, page["items"], job["max_workers"], fetch_report, self.bucket,
+                                              self.cache, self.analysis_store)
+                # Chunks are named by offset, so a page fetched again after a crash overwrites its own chunk
+                chunk_path = self._job_path(job["id"], f"chunk-{page['offset']:08d}.pkl")
+                pd.DataFrame.from_records(records).to_pickle(chunk_path)
+                report = fetch_report.summary()
+                job["next_offset"] = page["offset"] + len(page["items"])
+                job["total"] = page["total"]
+                page_tracks[str(page["offset"])] = len(records)
+                job["tracks"] = sum(page_tracks.values())
+                job["failed"], job["retries"] = failed + report["errors"], retries + report["retries"]
+                self._save(job)
+
+        chunks = [pd.read_pickle(chunk) for chunk in sorted(glob.glob(self._job_path(job["id"], "chunk-*.pkl")))]
+        chunks = [chunk for chunk in chunks if not chunk.empty]
+        if chunks:
+            df_clean = clean_df(pd.concat(chunks, ignore_index=True))
+            job["file_path"] = save_df(df_clean, self.snapshots)
+            self.store.upsert(df_clean)
+        job["status"] = DONE
+        self._save(job)
+        for chunk in glob.glob(self._job_path(job["id"], "chunk-*.pkl")):
+            os.remove(chunk)
+        self._prune()
+
+    def _prune(self):
+        """Delete the oldest finished and failed jobs beyond `MAX_FINISHED_JOBS`."""
+        finished = [job for job in self.jobs() if job["status"] in (DONE, FAILED)]
+        for job in finished[MAX_FINISHED_JOBS:]:
+            shutil.rmtree(self._job_path(job["id"]), ignore_errors=True)
@@ -0,0 +1,144 @@
+"""
+Library (Music Exploration Tool)
+Author: Yvonne Teo
+Description: This script shares one read-only copy of each loaded library between every session of the web app, and
+keeps what a session changes as a lightweight overlay on top of it.
+"""
+
+# IMPORTS
+import numpy as np
+import pandas as pd
+
+from aggregates import FeatureAggregates, aggregate_frame
+from core import apply_track_edits, feature_cols, query_tracks
+from metrics import metrics
+from moods import MOOD_MASK, MoodIndex
+
+# DEFINITIONS
+# Columns whose edits change the aggregates of a session
+AGGREGATED_COLUMNS = {"artist", "cluster", "moods"} | set(feature_cols)
+
+
+def share_df(dataframe: pd.DataFrame) -> pd.DataFrame:
+    """Get a copy of a dataframe to share between sessions, with each column in its own block, so that a session
+    editing one column only copies that column."""
+    return pd.concat([dataframe[[col]] for col in dataframe.columns], axis=1).reset_index(drop=True)
+
+
+class LibraryOverlay:
+    """Changes a session makes to a shared library: edited cells keyed by track id, cluster labels, and the rows
+    selected by its latest search. The shared library is never written to. The dataframe of the session is merged
+    from the library and the overlay the first time it is needed after a change, and shares every column that wasn't
+    edited with the library, so a session costs about as much memory as its edits.
+    `source` is what the library was loaded from, as the arguments of `load_library`, which finds its aggregates."""
+
+    def __init__(self, library: pd.DataFrame, source: tuple = None):
+        self.library = library
+        self.source = source
+        self.edits = {}
+        self.cluster_labels = None
+        self.selection = None
+        self._selection_query = None
+        self._frame = None
+        # Columns of the dataframe that were copied from the library, and so can be edited in place
+        self._owned_columns = set()
+        self._mood_index = None
+        self._aggregates = None
+
+    def __len__(self) -> int:
+        return len(self.library)
+
+    def frame(self) -> pd.DataFrame:
+        """Get the dataframe of the session, with the edits and cluster labels applied."""
+        if self._frame is None:
+            frame = self.library.copy(deep=False)
+            if self.cluster_labels is not None:
+                frame["cluster"] = self.cluster_labels
+            self._frame = frame
+            self._owned_columns = set()
+            self._own_columns(self.edits)
+            apply_track_edits(frame, self.edits)
+        return self._frame
+
+    def _own_columns(self, edits: dict):
+        """Replace the columns of the dataframe that the edits change with copies, the first time each is edited, so
+        that editing them in place leaves the shared library and the cluster labels as they are."""
+        columns = {col for changes in edits.values() for col in changes}
+        if "moods" in columns:
+            columns.add(MOOD_MASK)
+        for col in (columns & set(self._frame.columns)) - self._owned_columns:
+            self._frame[col] = self._frame[col].copy()
+            self._owned_columns.add(col)
+
+    def edit(self, edits: dict):
+        """Add edits keyed by track id, which win over the cluster labels.
+        They are applied straight away if the dataframe was already merged."""
+        for track_id, changes in edits.items():
+            self.edits.setdefault(track_id, {}).update(changes)
+        if self._frame is not None:
+            aggregated = self._aggregates is not None and any(AGGREGATED_COLUMNS & set(changes)
+                                                              for changes in edits.values())
+            if aggregated:
+                rows = np.flatnonzero(self._frame["id"].isin(list(edits)))
+                old_tracks = aggregate_frame(self._frame.iloc[rows], feature_cols)
+            self._own_columns(edits)
+            apply_track_edits(self._frame, edits)
+            if aggregated:
+                self._aggregates.update_tracks(old_tracks, aggregate_frame(self._frame.iloc[rows], feature_cols))
+            if self._mood_index is not None and any("moods" in changes for changes in edits.values()):
+                rows = np.flatnonzero(self._frame["id"].isin(list(edits)))
+                self._mood_index.update(rows, self._frame[MOOD_MASK].to_numpy()[rows])
+        self._selection_query = None
+
+    def set_cluster_labels(self, labels: np.ndarray):
+        """Set the cluster of every track, in the order of the library. Earlier cluster edits are dropped."""
+        self.cluster_labels = np.asarray(labels)
+        for changes in self.edits.values():
+            changes.pop("cluster", None)
+        if self._frame is not None:
+            self._frame["cluster"] = self.cluster_labels
+            self._owned_columns.discard("cluster")
+            if self._aggregates is not None:
+                self._aggregates.rebuild("cluster", aggregate_frame(self._frame, feature_cols))
+        self._selection_query = None
+
+    def mood_index(self) -> MoodIndex:
+        """Get the index of the tracks with each mood in the dataframe of the session. It is built the first time it
+        is needed, and kept up to date with edited moods."""
+        if self._mood_index is None:
+            with metrics.timer("mood_index"):
+                self._mood_index = MoodIndex(self.frame()[MOOD_MASK])
+        return self._mood_index
+
+    def aggregates(self, get_library_aggregates) -> FeatureAggregates:
+        """Get the aggregates of the dataframe of the session, as a layer on top of the aggregates of the shared
+        library, which `get_library_aggregates` gets from the source of the library. The layer takes away the library
+        values of edited tracks and adds their edited values, and is kept up to date with later edits."""
+        if self._aggregates is None:
+            frame = self.frame()
+            if self.source is not None:
+                base = get_library_aggregates(*self.source)
+            else:
+                base = FeatureAggregates.from_frame(self.library, feature_cols)
+            aggregates = FeatureAggregates(feature_cols, base)
+            if self.edits:
+                library_rows = np.flatnonzero(self.library["id"].isin(list(self.edits)))
+                frame_rows = np.flatnonzero(frame["id"].isin(list(self.edits)))
+                aggregates.update_tracks(aggregate_frame(self.library.iloc[library_rows], feature_cols),
+                                         aggregate_frame(frame.iloc[frame_rows], feature_cols))
+            if self.cluster_labels is not None:
+                aggregates.rebuild("cluster", aggregate_frame(frame, feature_cols))
+            self._aggregates = aggregates
+        return self._aggregates
+
+    def select(self, search: str = "", moods: list = None, sort_by: str = None, ascending: bool = True,
+               match_all: bool = True) -> np.ndarray:
+        """Get the row positions of the tracks matching a search, sorted by a column, as in `query_tracks`.
+        The selection is kept until the search or the dataframe changes."""
+        query = (search, tuple(moods or []), sort_by, ascending, match_all)
+        if self._selection_query != query:
+            with metrics.timer("query_tracks"):
+                self.selection = query_tracks(self.frame(), search, moods, sort_by, ascending, match_all,
+                                              self.mood_index() if moods else None)
+            self._selection_query = query
+        return self.selection
@@ -0,0 +1,151 @@
+"""
+Master store (Music Exploration Tool)
+Author: Yvonne Teo
+Description: This script keeps the master dataset as append-only columnar segments keyed by track id, so that saving
+a playlist only writes the playlist and loading can read just the columns that are needed.
+"""
+
+# IMPORTS
+import json
+import os
+import shutil
+
+import pandas as pd
+
+from locks import FileLock
+
+# DEFINITIONS
+MASTER_STORE_PATH = "./pickles/master_store"
+MANIFEST = "manifest.json"
+# Segments are merged into one once there are more than this
+MAX_SEGMENTS = 16
+# Columns the user fills in, where an empty value only replaces an existing one when it clears it, see `upsert`
+USER_COLUMNS = ["moods", "notes", "cluster"]
+
+
+class MasterStore:
+    """Master dataset stored as a list of segments, each a directory with one pickled column per file.
+    Upserting writes a new segment; on load, each track id takes the latest non-missing value
+    of every column across segments. `version` increases with every write, so data derived
+    from the store can tell when it is out of date. Reads and writes hold a lock on the store directory, and read the
+    manifest again under it, so that other processes, like the command-line importer, can write to a store that
+    sessions are reading."""
+
+    def __init__(self, path: str = MASTER_STORE_PATH):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.manifest = {"version": 0, "next_segment": 0, "segments": []}
+        self._manifest_stat = None
+        self.lock = FileLock(path)
+        self._read_manifest()
+
+    def _read_manifest(self) -> dict:
+        """Read the manifest again if another process or store replaced it since it was last read. Manifests are
+        replaced in one step, so this doesn't need the lock, but writers hold it so that their changes are current."""
+        manifest_path = os.path.join(self.path, MANIFEST)
+        try:
+            stat = os.stat(manifest_path)
+        except FileNotFoundError:
+            return self.manifest
+        if (stat.st_ino, stat.st_mtime_ns, stat.st_size) != self._manifest_stat:
+            with open(manifest_path) as f:
+                self.manifest = json.load(f)
+            self._manifest_stat = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        return self.manifest
+
+    @property
+    def version(self) -> int:
+        return self._read_manifest()["version"]
+
+    @property
+    def num_rows(self) -> int:
+        """Number of stored rows, which counts a track once per segment it appears in."""
+        return sum(segment["rows"] for segment in self._read_manifest()["segments"])
+
+    def is_empty(self) -> bool:
+        return not self._read_manifest()["segments"]
+
+    def columns(self) -> list:
+        """Get every column in the store, in the order they were first written."""
+        columns = {}
+        for segment in self._read_manifest()["segments"]:
+            columns.update(dict.fromkeys(segment["columns"]))
+        return list(columns)
+
+    def _write_manifest(self):
+        tmp_path = os.path.join(self.path, MANIFEST + ".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(self.manifest, f)
+        os.replace(tmp_path, os.path.join(self.path, MANIFEST))
+        stat = os.stat(os.path.join(self.path, MANIFEST))
+        self._manifest_stat = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    def _write_segment(self, dataframe: pd.DataFrame) -> dict:
+        name = f"segment-{self.manifest['next_segment']:06d}"
+        self.manifest["next_segment"] += 1
+        # A segment left behind by a write that was interrupted before its manifest was written is overwritten
+        os.makedirs(os.path.join(self.path, name), exist_ok=True)
+        files = {}
+        for i, column in enumerate(dataframe.columns):
+            files[column] = f"{i}.pkl"
+            dataframe[column].reset_index(drop=True).to_pickle(os.path.join(self.path, name, files[column]))
+        return {"name": name, "rows": len(dataframe), "columns": files}
+
+    def _read_segment(self, segment: dict, columns: list) -> pd.DataFrame:
+        data = {}
+        for column in columns:
+            if column in segment["columns"]:
+                data[column] = pd.read_pickle(os.path.join(self.path, segment["name"], segment["columns"][column]))
+        return pd.DataFrame(data, index=pd.RangeIndex(segment["rows"]))
+
+    def upsert(self, dataframe: pd.DataFrame, clear_empty: bool = False):
+        """Add or update rows keyed on the `id` column by writing them as a new segment.
+        Missing values keep any existing value. Empty values in the user columns, which imported tracks have, are
+        stored as missing too, unless `clear_empty` is set for edits made by the user, where they clear the value."""
+        dataframe = dataframe.drop_duplicates("id", keep="last").copy()
+        for column in USER_COLUMNS:
+            if column in dataframe.columns and not clear_empty:
+                dataframe[column] = dataframe[column].mask(dataframe[column].astype(str) == "")
+        with self.lock:
+            self._read_manifest()
+            self.manifest["segments"].append(self._write_segment(dataframe))
+            self.manifest["version"] += 1
+            self._write_manifest()
+            if len(self.manifest["segments"]) > MAX_SEGMENTS:
+                self.compact()
+
+    def load(self, columns: list = None) -> pd.DataFrame:
+        """Load the master dataset with one row per track id.
+        Only the given columns are read from disk when `columns` is set."""
+        with self.lock:
+            self._read_manifest()
+            all_columns = self.columns()
+            wanted = all_columns if columns is None else [column for column in columns if column in all_columns]
+            read = wanted if "id" in wanted else ["id"] + wanted
+            segments = [self._read_segment(segment, read) for segment in self.manifest["segments"]]
+        if not segments:
+            return pd.DataFrame(columns=wanted)
+        # Columns with no values in a segment, like the user columns of an import, are left out of it, since they
+        # never replace a value and pandas is changing how it sets the dtypes of columns concatenated with them
+        segments = [segment[[column for column in segment.columns if column == "id" or segment[column].notna().any()]]
+                    for segment in segments]
+        dataframe = pd.concat(segments, ignore_index=True).reindex(columns=read)
+        if dataframe["id"].duplicated().any():
+            # Later segments win, but a missing value never replaces an existing one
+            dataframe = dataframe.groupby("id", sort=False).last().reset_index()
+        for column in USER_COLUMNS:
+            if column in dataframe.columns:
+                dataframe[column] = dataframe[column].astype(object).where(dataframe[column].notna(), "")
+        return dataframe[wanted]
+
+    def compact(self):
+        """Merge every segment into a single segment with one row per track id."""
+        with self.lock:
+            if len(self._read_manifest()["segments"]) <= 1:
+                return
+            old_segments = self.manifest["segments"]
+            self.manifest["segments"] = [self._write_segment(self.load())]
+            self.manifest["version"] += 1
+            self._write_manifest()
+        for segment in old_segments:
+            shutil.rmtree(os.path.join(self.path, segment["name"]), ignore_errors=True)
@@ -1,182 +1,327 @@
 """
 Methods (Music Exploration Tool)
 Author: Yvonne Teo
-Description: This script includes methods used in the music exploration tool.
+Description: This script includes methods used in the music exploration tool. The data methods themselves are in
+core.py, and are cached here for the web app.
 """
 
 # IMPORTS
-import pickle
-import spotipy
-import time
+import core
+import os
+import threading
 
+import numpy as np
 import pandas as pd
 import streamlit as st
 
-from flatten_json import flatten
-from os.path import exists
-from spotipy.oauth2 import SpotifyClientCredentials
-
-# DEFINITIONS
-# Define features that are relevant
-df_columns = [
-    "name",
-    "id",
-    "artist",
-    "tempo",
-    "time_signature",
-    "danceability",
-    "energy",
-    "key",
-    "loudness",
-    "mode",
-    "speechiness",
-    "acousticness",
-    "instrumentalness",
-    "liveness",
-    "valence",
-    "track_num_samples",
-    "track_duration",
-    "track_end_of_fade_in",
-    "track_start_of_fade_out",
-    "track_tempo_confidence",
-    "track_time_signature_confidence",
-    "track_key_confidence",
-    "track_mode_confidence",
-    "duration_ms",
-    "track_href",
-    "analysis_url"
-]
-
-track_moods = [
-    "anxious",
-    "bittersweet",
-    "boisterous",
-    "bright",
-    "cheerful",
-    "chill",
-    "dangerous",
-    "dark",
-    "elegant",
-    "epic",
-    "furious",
-    "heavy",
-    "hopeful",
-    "intense",
-    "laidback",
-    "melancholy",
-    "relaxed",
-    "romantic",
-    "sad/sorrowful",
-    "sombre",
-    "suspenseful",
-    "tense",
-    "warm",
-    "wistful"
-]
-
-visual_cols = [
-    "danceability",
-    "energy",
-    "speechiness",
-    "acousticness",
-    "instrumentalness",
-    "liveness",
-    "valence",
-    "track_tempo_confidence",
-    "track_time_signature_confidence",
-    "track_key_confidence",
-    "track_mode_confidence",
-]
-
-feature_cols = [
-    "tempo",
-    "time_signature",
-    "danceability",
-    "energy",
-    "speechiness",
-    "acousticness",
-    "instrumentalness",
-    "liveness",
-    "loudness",
-    "valence",
-    "track_num_samples",
-    "track_duration",
-    "track_tempo_confidence",
-    "track_time_signature_confidence",
-    "track_key_confidence",
-    "track_mode_confidence",
-    "duration_ms",
-]
+from aggregates import ALL_TRACKS, FeatureAggregates, aggregate_frame, upsert_tracks
+from analysis_store import ANALYSIS_STORE_PATH, AnalysisStore, analysis_cols
+from clustering import ClusterCache, feature_ranges, scale_features
+# Definitions and methods that need no caching are re-exported from core for the pages
+from core import (ANALYSIS_WORKERS, FEATURES_BATCH_SIZE, LEGACY_MASTER_PATH, PREAGGREGATE_MIN_ROWS, PREFETCH_PAGES,
+                  add_track_urls, apply_track_edits, chunk_ids, compact_dtypes, df_columns, edits_by_id, edits_df,
+                  feature_cols, flatten_analysis, get_artists, iter_playlist_pages, prefetch_playlist_pages,
+                  query_tracks, set_track_value, url_templates, visual_cols)
+from feature_matrix import (FEATURE_MATRIX_PATH, FeatureMatrix, build_feature_matrix, build_projection,
+                            load_feature_matrix, load_projection, to_float32)
+from fetcher import FetchReport, TokenBucket
+from jobs import JobQueue
+from library import LibraryOverlay, share_df
+from master_store import MASTER_STORE_PATH, MasterStore
+from metrics import metrics
+from moods import MOOD_MASK, MoodIndex, add_mood_masks, first_moods, has_moods, track_moods
+from similarity import SimilarityIndex
+from snapshots import SNAPSHOTS_PATH, SnapshotStore
+from summaries import box_summary, histogram_summary
+from track_cache import TrackCache
 
 
 # HELPER METHODS
 # GETTING DATA
-@st.cache_data
+@metrics.timed("save_df")
 def save_df(dataframe: pd.DataFrame) -> str:
-    """Save a dataframe so that it doesn't need to be imported over and over again."""
-    now = time.time()
-    with open(f"./pickles/spotify_df{now}.pkl", "wb") as f:
-        pickle.dump(dataframe, f)
-    file_path = f"./pickles/spotify_df{now}.pkl"
-    return file_path
+    """Save a dataframe so that it doesn't need to be imported over and over again.
+    Only the rows changed since the last save are written, so it isn't cached."""
+    return core.save_df(dataframe.drop(columns=[MOOD_MASK], errors="ignore"), get_snapshot_store())
+
+
+# Libraries are loaded once and shared read-only by every session, which keeps its changes in an overlay
+@metrics.counted("load_library")
+@st.cache_resource(max_entries=4)
+@metrics.timed("load_library", measure_size=True)
+def load_library(file_path: str, version: int = None, compact_schema: bool = False) -> tuple:
+    """Load a dataframe - default is the master store.
+    This can be changed to a saved dataframe or another filepath.
+    `version` is the master store version, so that a cached master store is reloaded after every write.
+    Returns the library, in the compact schema if chosen and with the bitmask of each track's moods, and the number
+    of bytes the compact schema saved."""
+    dataframe = core.load_df(file_path, get_snapshot_store())
+    bytes_saved = 0
+    if compact_schema:
+        dataframe, bytes_saved = core.compact_df(dataframe)
+    return share_df(add_mood_masks(dataframe)), bytes_saved
+
+
+def session_df() -> pd.DataFrame:
+    """Get the dataframe of this session, merged from the shared library and the changes of the session."""
+    return st.session_state.library.frame()
+
+
+# Snapshots and edit journal shared by every session
+@st.cache_resource
+def get_snapshot_store() -> SnapshotStore:
+    """Get the store of saved dataframes and the journal of edited moods, notes and clusters."""
+    return SnapshotStore(SNAPSHOTS_PATH)
+
+
+# Master store shared by every session
+@st.cache_resource
+def get_master_store() -> MasterStore:
+    """Get the master store, importing the legacy master dataframe pickle into it the first time."""
+    return core.open_master_store(MASTER_STORE_PATH)
+
+
+@metrics.counted("load_master_df")
+@st.cache_resource(max_entries=8)
+@metrics.timed("load_master_df", measure_size=True)
+def load_master_df(columns: tuple = None, version: int = None) -> pd.DataFrame:
+    """Load the master dataframe, reading only the given columns. It is shared by every session, so it is read-only.
+    The bitmask of each track's moods is added when its moods are read.
+    `version` is the store version, so that the cached result is dropped after every write."""
+    return share_df(add_mood_masks(get_master_store().load(list(columns) if columns is not None else None)))
+
+
+@st.cache_resource(max_entries=1)
+def get_master_mood_index(version: int) -> MoodIndex:
+    """Get the index of the tracks with each mood in the master dataframe, in the row order of `load_master_df`."""
+    with metrics.timer("mood_index"):
+        return MoodIndex(load_master_df(version=version)[MOOD_MASK])
+
+
+@metrics.timed("save_master_df")
+def save_master_df(dataframe: pd.DataFrame, clear_empty: bool = False):
+    """Save a dataframe into the master store.
+    Rows are upserted by track id, so this only writes the rows of the given dataframe. Empty moods, notes and
+    clusters keep the saved ones unless `clear_empty` is set, as it is for edits. Mood bitmasks aren't saved,
+    since they are derived from the moods on load. The aggregates of the master store are updated with the same rows."""
+    store = get_master_store()
+    holder = get_master_aggregates_holder()
+    # No other write can come in between, so the aggregates are current after the upsert if they were before it
+    with holder["lock"], store.lock:
+        current = holder["version"] == store.version
+        store.upsert(dataframe.drop(columns=[MOOD_MASK], errors="ignore"), clear_empty)
+        if current:
+            with metrics.timer("update_aggregates"):
+                holder["aggregates"], holder["tracks"] = upsert_tracks(holder["aggregates"], holder["tracks"],
+                                                                       dataframe, clear_empty)
+            holder["version"] = store.version
+
+
+# Aggregates of the master store shared by every session
+@st.cache_resource
+def get_master_aggregates_holder() -> dict:
+    """Get the holder of the aggregates of the master store, which are updated by `save_master_df`."""
+    return {"aggregates": None, "tracks": None, "version": None, "lock": threading.Lock()}
+
+
+def get_master_aggregates() -> FeatureAggregates:
+    """Get the aggregates of `feature_cols` per cluster, artist and mood in the master store.
+    They are built from the master store when it was written to without `save_master_df`, like by an import job."""
+    store = get_master_store()
+    holder = get_master_aggregates_holder()
+    with holder["lock"]:
+        if holder["version"] != store.version:
+            with metrics.timer("build_aggregates"), store.lock:
+                columns = ["id", "artist", "moods", "cluster"] + feature_cols
+                dataframe = pd.DataFrame({"id": []}) if store.is_empty() else store.load(columns)
+                holder["tracks"] = aggregate_frame(dataframe, feature_cols)
+                holder["aggregates"] = FeatureAggregates(feature_cols)
+                holder["aggregates"].add_tracks(holder["tracks"])
+                holder["version"] = store.version
+        return holder["aggregates"]
+
+
+@st.cache_resource(max_entries=4)
+def get_library_aggregates(file_path: str, version: int = None, compact_schema: bool = False) -> FeatureAggregates:
+    """Get the aggregates of a library loaded with `load_library`. A library loaded from the latest version of the
+    master store shares its aggregates."""
+    store = get_master_store()
+    if (version is not None and version == store.version
+            and os.path.realpath(file_path) == os.path.realpath(store.path)):
+        return get_master_aggregates()
+    with metrics.timer("build_aggregates"):
+        return FeatureAggregates.from_frame(load_library(file_path, version, compact_schema)[0], feature_cols)
+
+
+def session_aggregates() -> FeatureAggregates:
+    """Get the aggregates of the dataframe of this session, as a layer with its changes on the aggregates of its
+    library."""
+    return st.session_state.library.aggregates(get_library_aggregates)
+
+
+# Feature matrix shared by every session
+@st.cache_resource(max_entries=1)
+def get_feature_matrix(version: int) -> FeatureMatrix:
+    """Get the memory-mapped float32 matrix of `feature_cols` for the given master store version.
+    The matrix is rebuilt from the master store when it was built from an older version."""
+    matrix = load_feature_matrix(FEATURE_MATRIX_PATH)
+    if matrix is None or matrix.version != version or matrix.columns != feature_cols:
+        with metrics.timer("build_feature_matrix"):
+            build_feature_matrix(get_master_store().load(["id"] + feature_cols), feature_cols, version,
+                                 FEATURE_MATRIX_PATH)
+        matrix = load_feature_matrix(FEATURE_MATRIX_PATH)
+    return matrix
+
 
+# 2-D projection of the library shared by every session
+@st.cache_resource(max_entries=1)
+def get_projection(version: int) -> np.ndarray:
+    """Get the 2-D PCA projection of the feature matrix, with rows in the same order.
+    The projection is computed once per master store version and saved next to the feature matrix."""
+    projection = load_projection(version, FEATURE_MATRIX_PATH)
+    if projection is None:
+        projection = build_projection(get_feature_matrix(version), FEATURE_MATRIX_PATH)
+    return projection
 
+
+def feature_matrix_for(dataframe: pd.DataFrame, columns: list) -> np.ndarray:
+    """Get the given feature columns of a dataframe as a float32 matrix.
+    Rows are taken from the shared feature matrix when every track is in the master store,
+    without copying when the dataframe is the whole master dataset and every feature is selected."""
+    matrix = get_feature_matrix(get_master_store().version)
+    if set(columns) <= set(matrix.columns) and dataframe["id"].isin(matrix.row_index).all():
+        return matrix.select(columns, dataframe["id"].to_numpy())
+    return to_float32(dataframe, columns)
+
+
+# Summaries of feature values for plots, cached per feature
 @st.cache_data
-def load_df(file_path: str) -> pd.DataFrame:
-    """Load a dataframe - default is the dataframe saved.
-    This can be changed to the master dataframe or another filepath."""
-    dataframe = pd.read_pickle(file_path)
-    return dataframe
+def get_histogram_summary(values: np.ndarray) -> dict:
+    """Get the histogram bins and counts of the values of one feature."""
+    return histogram_summary(values)
 
 
 @st.cache_data
-def save_master_df(dataframe: pd.DataFrame):
-    """Save a master dataframe."""
-    path = "./pickles/spotify_master_df.pkl"
-    if exists(path):
-        df_master = pd.read_pickle(path)
-        df_master = pd.concat([df_master, dataframe])
-        df_master = df_master.drop_duplicates()
-        with open(path, "wb") as f:
-            pickle.dump(df_master, f)
-    else:
-        with open(path, "wb") as f:
-            pickle.dump(dataframe, f)
+def get_box_summary(values: np.ndarray) -> dict:
+    """Get the box plot statistics and sampled outliers of the values of one feature."""
+    return box_summary(values)
+
+
+# Similarity index shared by every session
+@st.cache_resource
+def get_similarity_holder() -> dict:
+    """Get the holder of the similarity index, which is updated in place as the master store grows."""
+    return {"index": None, "lock": threading.Lock()}
+
+
+def get_similarity_index() -> SimilarityIndex:
+    """Get the similarity index over `feature_cols` of the master store.
+    When the master store has changed, only the new tracks and the tracks whose features were edited are added to the
+    existing index."""
+    matrix = get_feature_matrix(get_master_store().version)
+    holder = get_similarity_holder()
+    with holder["lock"]:
+        index = holder["index"]
+        if index is None:
+            index = SimilarityIndex(matrix.ids, matrix.matrix, matrix.version)
+        elif index.version != matrix.version:
+            changed = index.changed(matrix.ids, matrix.matrix)
+            index.add(matrix.ids[changed], matrix.matrix[changed], matrix.version)
+        holder["index"] = index
+    return index
+
+
+@metrics.timed("similar_tracks")
+def similar_tracks(track_id: str, k: int = 10) -> pd.DataFrame:
+    """Get the `k` tracks in the master dataset most similar to a track, most similar first, with their names and
+    artists. Returns None if the track isn't in the master dataset yet."""
+    index = get_similarity_index()
+    if track_id not in index.row_index:
+        return None
+    similar = index.query(track_id, k)
+    # Look up names and artists, reading only those columns from the master store
+    track_info = load_master_df(("id", "name", "artist"), get_master_store().version)
+    return similar.merge(track_info, on="id", how="left")[["name", "artist", "similarity", "id"]]
+
+
+# Clustering results shared by every session
+@st.cache_resource
+def get_cluster_cache() -> ClusterCache:
+    """Get the cache of clustering results, keyed by the input features and clustering parameters."""
+    return ClusterCache()
+
+
+def clustering_features(dataframe: pd.DataFrame, columns: list, ranges: pd.DataFrame = None) -> tuple:
+    """Get the features used for clustering as float32, with features outside 0 to 1 scaled to that range, or by the
+    minimums and maximums in `ranges` when given, so that tracks are scaled like those an earlier clustering was fitted
+    to. Features derived from audio analysis arrays are filled with their average for tracks without stored arrays.
+    Returns the features and the minimum and maximum of each scaled feature, with rows "min" and "max"."""
+    track_columns = [col for col in columns if col not in analysis_cols]
+    derived_columns = [col for col in columns if col in analysis_cols]
+    features = np.empty((len(dataframe), len(columns)), dtype=np.float32)
+    if track_columns:
+        features[:, [columns.index(col) for col in track_columns]] = feature_matrix_for(dataframe, track_columns)
+    if derived_columns:
+        derived = get_analysis_store().derived(dataframe["id"].to_numpy(), derived_columns)
+        known = ~np.isnan(derived)
+        means = np.divide(np.nansum(derived, axis=0), known.sum(axis=0),
+                          out=np.zeros(len(derived_columns), dtype=np.float32), where=known.any(axis=0))
+        features[:, [columns.index(col) for col in derived_columns]] = np.where(np.isnan(derived), means, derived)
+    scaled_columns = [col for col in columns if col not in visual_cols]
+    scaled_positions = [columns.index(col) for col in scaled_columns]
+    if ranges is None or list(ranges.columns) != scaled_columns:
+        ranges = pd.DataFrame(feature_ranges(features, scaled_positions), index=["min", "max"], columns=scaled_columns)
+    return scale_features(features, scaled_positions, ranges.to_numpy()), ranges
 
 
 # Spotipy (Spotify API) Configuration
 @st.cache_resource
 def get_spotipy_info(user_cid, user_secret):
     """Get information for Spotipy (Spotify API for Python)."""
-    cid = user_cid
-    secret = user_secret
-    client_credentials_manager = SpotifyClientCredentials(
-        client_id=cid, client_secret=secret)
-    my_spotipy = spotipy.Spotify(client_credentials_manager=client_credentials_manager,
-                                 requests_timeout=10,
-                                 retries=10)
-    return my_spotipy
+    return core.make_spotify(user_cid, user_secret)
+
+
+# Rate limiter shared by every request made to the Spotify API
+@st.cache_resource
+def get_rate_limiter() -> TokenBucket:
+    """Get the token bucket shared by every session and worker thread."""
+    return TokenBucket()
+
+
+# Persistent cache of Spotify API responses shared by every session
+@st.cache_resource
+def get_track_cache() -> TrackCache:
+    """Get the on-disk cache of audio features and audio analysis keyed by track id."""
+    return TrackCache()
+
+
+# Audio analysis arrays shared by every session
+@st.cache_resource
+def get_analysis_store() -> AnalysisStore:
+    """Get the store of bars, beats, segments and tatums of each track, and the features derived from them."""
+    return AnalysisStore(ANALYSIS_STORE_PATH)
+
+
+# Background import jobs shared by every session
+@st.cache_resource
+def get_job_queue() -> JobQueue:
+    """Get the queue of background playlist imports, which writes to the shared master store."""
+    return JobQueue(get_master_store(), get_track_cache(), get_rate_limiter(), get_analysis_store(),
+                    get_snapshot_store())
 
 
 # Get Spotify playlist data
 @st.cache_data
 def get_playlist(_sp, playlist_id) -> dict:
-    """Get the playlist items as a nested dictionary."""
-    playlist_items = _sp.playlist_items(playlist_id=playlist_id)
+    """Get all the playlist items as a nested dictionary."""
+    pages = iter_playlist_pages(_sp, playlist_id, get_rate_limiter())
+    playlist_items = next(pages)
+    for page in pages:
+        playlist_items["items"].extend(page["items"])
+    playlist_items["next"] = None
     return playlist_items
 
 
-# Get Spotify playlist dataframe
-@st.cache_data
-def get_artists(track_artist: list) -> str:
-    """Get artists as a string from nested structure."""
-    track_artists = []
-    for artist_list in track_artist:
-        track_artists.append(artist_list["name"])
-    artist = ", ".join(track_artists)
-    return artist
-
-
 # Get audio features from track id through Spotify API
 @st.cache_data
 def get_audio_features(_sp, track_id) -> pd.DataFrame:
@@ -186,44 +331,82 @@ def get_audio_features(_sp, track_id) -> pd.DataFrame:
     return df_features
 
 
-# Get audio features from track id through Spotify API
+# Get audio features for many track ids through Spotify API
+def get_audio_features_batch(_sp, track_ids: list) -> dict:
+    """Get audio features of many tracks from Spotify API, keyed by track id, through the shared rate limiter."""
+    return core.get_audio_features_batch(_sp, track_ids, get_rate_limiter())
+
+
+# Get audio analysis from track id through Spotify API
+@st.cache_data
+def get_audio_analysis_record(_sp, track_id) -> dict:
+    """Get audio analysis of the track from Spotify API as a flat dictionary."""
+    analysis = _sp.audio_analysis(track_id=track_id)
+    return flatten_analysis(analysis)
+
+
+# Get audio analysis from track id through Spotify API
 @st.cache_data
 def get_audio_analysis(_sp, track_id) -> pd.DataFrame:
     """Get audio analysis of the track from Spotify API."""
-    analysis = _sp.audio_analysis(track_id=track_id)
-    remove_keys = ["bars", "beats", "segments", "tatums", "meta"]
-    for key in remove_keys:
-        analysis.pop(key, None)
-    analysis_dict = flatten(analysis)
+    analysis_dict = get_audio_analysis_record(_sp, track_id)
     df_analysis = pd.DataFrame.from_dict(analysis_dict, orient="index")
     df_analysis = df_analysis.transpose()
     return df_analysis
 
 
+# Create records from Spotify playlist items
+def build_track_records(_sp, items: list, max_workers: int = ANALYSIS_WORKERS,
+                        fetch_report: FetchReport = None) -> list:
+    """Build one flat record per track from playlist items, through the shared rate limiter and track cache.
+    Audio analysis arrays are kept in the shared analysis store."""
+    return core.build_track_records(_sp, items, max_workers, fetch_report, get_rate_limiter(), get_track_cache(),
+                                    get_analysis_store())
+
+
 # Create a dataframe from Spotify playlist
+@metrics.counted("create_df")
 @st.cache_data
+@metrics.timed("create_df", measure_size=True)
 def create_df(_sp, sp_playlist) -> pd.DataFrame:
-    """Create a dataframe from the Spotify playlist."""
-    dataframe = pd.DataFrame()
-    for item in sp_playlist["items"]:
-        track_id = item["track"]["id"]
-        df_features = get_audio_features(_sp, track_id)
-        df_analysis = get_audio_analysis(_sp, track_id)
-        df_full = pd.concat([df_features, df_analysis], axis=1)
-        track_artist = item["track"]["artists"]
-        df_full["artist"] = get_artists(track_artist)
-        df_full["name"] = item["track"]["name"]
-        dataframe = pd.concat([dataframe, df_full], ignore_index=True)
+    """Create a dataframe from the Spotify playlist.
+    Rows are collected as records, so the dataframe is only built once at the end."""
+    records = build_track_records(_sp, sp_playlist["items"])
+    dataframe = pd.DataFrame.from_records(records)
     return dataframe
 
 
+# Create a dataframe from Spotify playlist while its pages are still loading
+@metrics.timed("stream_create_df", measure_size=True)
+def stream_create_df(sp, playlist_id, progress_callback=None, max_workers: int = ANALYSIS_WORKERS,
+                     fetch_report: FetchReport = None) -> pd.DataFrame:
+    """Create a dataframe from every page of the Spotify playlist, through the shared rate limiter and track cache.
+    `progress_callback(done, total)` is called after each page."""
+    return core.stream_create_df(sp, playlist_id, progress_callback, max_workers, fetch_report,
+                                 get_rate_limiter(), get_track_cache(), get_analysis_store())
+
+
 # Clean dataframe to only take the columns we want
 @st.cache_data
 def clean_df(dataframe: pd.DataFrame) -> pd.DataFrame:
     """Clean dataframe to only take relevant columns and add relevant columns."""
-    dataframe = dataframe[df_columns]
-    new_columns = ["moods", "notes", "cluster"]
-    for col in new_columns:
-        if col not in dataframe.columns:
-            dataframe[col] = ""
-    return dataframe
+    return core.clean_df(dataframe)
+
+
+
+# INSTRUMENTATION
+def show_metrics_panel():
+    """Show the timings, cache hit rates and payload sizes recorded in this process in a collapsible sidebar panel,
+    with downloads as JSON lines and in the Prometheus text format."""
+    for kind, stats in get_track_cache().stats().items():
+        metrics.set_cache_stats(f"track_cache_{kind}", stats["hits"], stats["misses"])
+    cluster_cache = get_cluster_cache()
+    metrics.set_cache_stats("cluster_cache", cluster_cache.hits, cluster_cache.misses)
+    with st.sidebar.expander("Performance metrics"):
+        st.dataframe(metrics.summary().set_index("name"), use_container_width=True)
+        st.download_button("Download as JSON lines", metrics.to_jsonl(), file_name="metrics.jsonl",
+                           mime="application/x-ndjson")
+        st.download_button("Download as Prometheus text", metrics.to_prometheus(), file_name="metrics.prom",
+                           mime="text/plain")
+        if st.button("Reset metrics"):
+            metrics.reset()
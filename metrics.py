@@ -0,0 +1,205 @@
+"""
+Metrics (Music Exploration Tool)
+Author: Yvonne Teo
+Description: This script records how long the hot paths of the tool take, how often cached results are reused and
+how large the payloads are, and exports them as JSON lines or in the Prometheus text format.
+"""
+
+# IMPORTS
+import functools
+import json
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+from collections import deque
+from contextlib import contextmanager
+
+# DEFINITIONS
+# Most recent durations kept per timer, to compute percentiles
+MAX_SAMPLES = 1024
+PROMETHEUS_PREFIX = "music_exploration"
+
+
+def payload_bytes(value) -> int:
+    """Estimate the size of a dataframe, array or figure in bytes, or get None for anything else.
+    Sizes are measured on every run, so they are kept cheap: dataframes and arrays count the bytes of their arrays
+    without following the strings they point to, and figures count the arrays and lists held by their traces
+    instead of being serialised."""
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(deep=False).sum())
+    if isinstance(value, np.ndarray):
+        return int(value.nbytes)
+    if hasattr(value, "data") and hasattr(value, "to_json"):
+        nbytes = 0
+        for trace in value.data:
+            for prop in trace:
+                prop_value = trace[prop]
+                if isinstance(prop_value, np.ndarray):
+                    nbytes += prop_value.nbytes
+                elif isinstance(prop_value, (list, tuple)):
+                    nbytes += 8 * len(prop_value)
+        return nbytes
+    return None
+
+
+class Metrics:
+    """Process-wide registry of timers, call counts, cache statistics and payload sizes, keyed by name.
+    For a cached function, `counted` wraps the cache and counts every call, while `timed` wraps the function
+    inside the cache and only runs on a miss, so the hit rate is 1 minus the runs per call."""
+
+    def __init__(self, max_samples: int = MAX_SAMPLES):
+        self.max_samples = max_samples
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.timers = {}
+            self.calls = {}
+            self.caches = {}
+            self.sizes = {}
+
+    def observe(self, name: str, seconds: float):
+        """Record one duration of a timer."""
+        with self.lock:
+            timer = self.timers.get(name)
+            if timer is None:
+                timer = self.timers[name] = {"count": 0, "total": 0.0, "max": 0.0,
+                                             "samples": deque(maxlen=self.max_samples)}
+            timer["count"] += 1
+            timer["total"] += seconds
+            timer["max"] = max(timer["max"], seconds)
+            timer["samples"].append(seconds)
+
+    def count_call(self, name: str):
+        with self.lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+
+    def record_size(self, name: str, nbytes: int):
+        """Record the size of the latest payload of a metric."""
+        with self.lock:
+            size = self.sizes.setdefault(name, {"last": 0, "max": 0})
+            size["last"] = nbytes
+            size["max"] = max(size["max"], nbytes)
+
+    def set_cache_stats(self, name: str, hits: int, misses: int):
+        """Record the hits and misses of a cache that counts them itself."""
+        with self.lock:
+            self.caches[name] = {"hits": hits, "misses": misses}
+
+    @contextmanager
+    def timer(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def timed(self, name: str, measure_size: bool = False):
+        """Decorator that times every run of a function, and records the size of its result if `measure_size`."""
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.timer(name):
+                    result = func(*args, **kwargs)
+                if measure_size:
+                    nbytes = payload_bytes(result[0] if isinstance(result, tuple) else result)
+                    if nbytes is not None:
+                        self.record_size(name, nbytes)
+                return result
+            return wrapper
+        return decorator
+
+    def counted(self, name: str):
+        """Decorator that counts every call of a function, for the hit rate of a cache it wraps."""
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                self.count_call(name)
+                return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def rows(self) -> list:
+        """Get one dictionary per metric with its runs, calls, cache hit rate, durations and payload size."""
+        with self.lock:
+            names = sorted(set(self.timers) | set(self.calls) | set(self.caches) | set(self.sizes))
+            rows = []
+            for name in names:
+                timer = self.timers.get(name)
+                samples = np.array(timer["samples"]) * 1000 if timer else np.empty(0)
+                runs = timer["count"] if timer else 0
+                calls = self.calls.get(name)
+                hit_rate = None
+                if name in self.caches:
+                    hits, misses = self.caches[name]["hits"], self.caches[name]["misses"]
+                    hit_rate = hits / (hits + misses) if hits + misses else None
+                elif calls:
+                    hit_rate = max(0.0, 1 - runs / calls)
+                rows.append({
+                    "name": name,
+                    "runs": runs,
+                    "calls": calls,
+                    "hit_rate": hit_rate,
+                    "total_s": timer["total"] if timer else None,
+                    "mean_ms": timer["total"] / runs * 1000 if runs else None,
+                    "p50_ms": float(np.percentile(samples, 50)) if len(samples) else None,
+                    "p95_ms": float(np.percentile(samples, 95)) if len(samples) else None,
+                    "max_ms": timer["max"] * 1000 if timer else None,
+                    "last_bytes": self.sizes[name]["last"] if name in self.sizes else None,
+                    "max_bytes": self.sizes[name]["max"] if name in self.sizes else None,
+                })
+        return rows
+
+    def summary(self) -> pd.DataFrame:
+        """Get the metrics as a dataframe, one row per metric."""
+        return pd.DataFrame(self.rows(), columns=["name", "runs", "calls", "hit_rate", "total_s", "mean_ms", "p50_ms",
+                                                  "p95_ms", "max_ms", "last_bytes", "max_bytes"])
+
+    def to_jsonl(self) -> str:
+        """Export the metrics as JSON lines, one metric per line, stamped with the current time."""
+        now = time.time()
+        return "".join(json.dumps({"timestamp": now, **row}) + "\n" for row in self.rows())
+
+    def to_prometheus(self, prefix: str = PROMETHEUS_PREFIX) -> str:
+        """Export the metrics in the Prometheus text exposition format."""
+        rows = self.rows()
+        lines = [f"# HELP {prefix}_duration_seconds Duration of instrumented runs.",
+                 f"# TYPE {prefix}_duration_seconds summary"]
+        with self.lock:
+            for name, timer in sorted(self.timers.items()):
+                samples = np.array(timer["samples"])
+                for quantile in (0.5, 0.95):
+                    lines.append(f'{prefix}_duration_seconds{{name="{name}",quantile="{quantile}"}} '
+                                 f'{np.quantile(samples, quantile):.6f}')
+                lines.append(f'{prefix}_duration_seconds_sum{{name="{name}"}} {timer["total"]:.6f}')
+                lines.append(f'{prefix}_duration_seconds_count{{name="{name}"}} {timer["count"]}')
+            lines += [f"# HELP {prefix}_calls_total Calls of instrumented cached functions, hits included.",
+                      f"# TYPE {prefix}_calls_total counter"]
+            lines += [f'{prefix}_calls_total{{name="{name}"}} {calls}' for name, calls in sorted(self.calls.items())]
+            lines += [f"# HELP {prefix}_payload_bytes Size of the latest payload.",
+                      f"# TYPE {prefix}_payload_bytes gauge"]
+            lines += [f'{prefix}_payload_bytes{{name="{name}"}} {size["last"]}'
+                      for name, size in sorted(self.sizes.items())]
+        lines += [f"# HELP {prefix}_cache_hit_ratio Share of calls answered from a cache.",
+                  f"# TYPE {prefix}_cache_hit_ratio gauge"]
+        lines += [f'{prefix}_cache_hit_ratio{{name="{row["name"]}"}} {row["hit_rate"]:.6f}'
+                  for row in rows if row["hit_rate"] is not None]
+        return "\n".join(lines) + "\n"
+
+    def write(self, path: str):
+        """Write the metrics to a file, in the Prometheus text format if it ends in .prom and as JSON lines otherwise.
+        JSON lines are appended, so that a file collects the metrics of every run."""
+        if path.endswith(".prom"):
+            with open(path, "w") as f:
+                f.write(self.to_prometheus())
+        else:
+            with open(path, "a") as f:
+                f.write(self.to_jsonl())
+
+
+# Registry shared by everything in the process
+metrics = Metrics()
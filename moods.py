@@ -0,0 +1,151 @@
+"""
+Moods (Music Exploration Tool)
+Author: Yvonne Teo
+Description: This script keeps the moods of each track as a bitmask with one bit per mood, and an inverted index from
+each mood to its tracks, so that tracks can be filtered and counted by mood without parsing their mood strings.
+"""
+
+# IMPORTS
+import numpy as np
+import pandas as pd
+
+# DEFINITIONS
+track_moods = [
+    "anxious",
+    "bittersweet",
+    "boisterous",
+    "bright",
+    "cheerful",
+    "chill",
+    "dangerous",
+    "dark",
+    "elegant",
+    "epic",
+    "furious",
+    "heavy",
+    "hopeful",
+    "intense",
+    "laidback",
+    "melancholy",
+    "relaxed",
+    "romantic",
+    "sad/sorrowful",
+    "sombre",
+    "suspenseful",
+    "tense",
+    "warm",
+    "wistful"
+]
+
+# Column of the bitmask of each track's moods. It is derived from the moods when a library is loaded, so it is never
+# saved
+MOOD_MASK = "mood_mask"
+MOOD_BITS = {mood: 1 << i for i, mood in enumerate(track_moods)}
+
+
+def mood_mask(moods) -> int:
+    """Get the bitmask of a comma-separated string or a list of moods. Moods that aren't in `track_moods` are left
+    out."""
+    if isinstance(moods, str):
+        moods = moods.split(",")
+    mask = 0
+    for mood in moods:
+        mask |= MOOD_BITS.get(str(mood).strip(), 0)
+    return mask
+
+
+def moods_to_masks(moods: pd.Series) -> np.ndarray:
+    """Get the bitmask of the moods of every track, parsing each distinct moods string once."""
+    codes, uniques = pd.factorize(moods)
+    # Missing moods have the code -1, which takes the empty mask at the end
+    masks = np.array([mood_mask(value) for value in uniques] + [0], dtype=np.uint32)
+    return masks[codes]
+
+
+def add_mood_masks(dataframe: pd.DataFrame) -> pd.DataFrame:
+    """Get a dataframe with the bitmask of each track's moods, if it has moods."""
+    if "moods" not in dataframe.columns:
+        return dataframe
+    return dataframe.assign(**{MOOD_MASK: moods_to_masks(dataframe["moods"])})
+
+
+def has_moods(masks: np.ndarray, moods: list, match_all: bool = True) -> np.ndarray:
+    """Find the tracks with all of the given moods, or any of them if not `match_all`, from their bitmasks."""
+    masks = np.asarray(masks, dtype=np.uint32)
+    query = np.uint32(mood_mask(moods))
+    return (masks & query) == query if match_all else (masks & query) != 0
+
+
+def first_moods(masks: np.ndarray) -> np.ndarray:
+    """Get the first mood of each track in the order of `track_moods`, or "" for tracks without moods."""
+    masks = np.asarray(masks, dtype=np.int64)
+    lowest = masks & -masks
+    bits = np.round(np.log2(np.maximum(lowest, 1))).astype(np.int64)
+    return np.array([""] + track_moods, dtype=object)[np.where(lowest > 0, bits + 1, 0)]
+
+
+class MoodIndex:
+    """Inverted index from each mood to the sorted row positions of the tracks with it, built from their bitmasks.
+    Filtering costs as much as the tracks with the rarest of the given moods, and counting tracks per mood is free.
+    Edited tracks are updated in place, so the index is only built once per library."""
+
+    def __init__(self, masks: np.ndarray):
+        self.masks = np.array(masks, dtype=np.uint32)
+        self.postings = {mood: np.flatnonzero(self.masks & bit) for mood, bit in MOOD_BITS.items()}
+
+    def __len__(self) -> int:
+        return len(self.masks)
+
+    def positions(self, moods: list, match_all: bool = True) -> np.ndarray:
+        """Get the sorted row positions of the tracks with all of the given moods, or any of them if not
+        `match_all`. Every track matches when no moods are given."""
+        if not moods:
+            return np.arange(len(self.masks))
+        postings = sorted((self.postings[mood] for mood in moods if mood in self.postings), key=len)
+        if not postings:
+            return np.empty(0, dtype=np.int64)
+        if not match_all:
+            return np.unique(np.concatenate(postings))
+        positions = postings[0]
+        for other in postings[1:]:
+            positions = np.intersect1d(positions, other, assume_unique=True)
+        return positions
+
+    def matches(self, moods: list, match_all: bool = True) -> np.ndarray:
+        """Find the tracks with all of the given moods, or any of them if not `match_all`, as a boolean array."""
+        keep = np.zeros(len(self.masks), dtype=bool)
+        keep[self.positions(moods, match_all)] = True
+        return keep
+
+    def counts(self) -> pd.Series:
+        """Count the tracks with each mood."""
+        return pd.Series({mood: len(positions) for mood, positions in self.postings.items()}, name="tracks",
+                         dtype=np.int64).rename_axis("mood")
+
+    def crosstab(self, groups: np.ndarray) -> pd.DataFrame:
+        """Count the tracks with each mood in each group, such as the cluster of each track, with one row per mood and
+        one column per group. Tracks without a group are left out."""
+        codes, uniques = pd.factorize(pd.Series(groups), sort=True)
+        table = np.zeros((len(self.postings), len(uniques)), dtype=np.int64)
+        for i, positions in enumerate(self.postings.values()):
+            group_codes = codes[positions]
+            table[i] = np.bincount(group_codes[group_codes >= 0], minlength=len(uniques))
+        return pd.DataFrame(table, index=pd.Index(list(self.postings), name="mood"), columns=uniques)
+
+    def update(self, positions: np.ndarray, masks: np.ndarray):
+        """Set the bitmasks of the tracks at the given row positions. Only the postings of the moods that were added
+        to or removed from those tracks are changed."""
+        positions, first = np.unique(np.asarray(positions, dtype=np.int64), return_index=True)
+        masks = np.asarray(masks, dtype=np.uint32)[first]
+        changed = np.bitwise_or.reduce(self.masks[positions] ^ masks) if len(positions) else 0
+        self.masks[positions] = masks
+        for mood, bit in MOOD_BITS.items():
+            if changed & bit:
+                # Postings stay sorted, so the tracks are found and inserted by binary search
+                postings = self.postings[mood]
+                found = np.searchsorted(postings, positions)
+                in_postings = found < len(postings)
+                in_postings[in_postings] = postings[found[in_postings]] == positions[in_postings]
+                postings = np.delete(postings, found[in_postings])
+                added = positions[(masks & bit) != 0]
+                self.postings[mood] = np.insert(postings, np.searchsorted(postings, added), added)
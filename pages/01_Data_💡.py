@@ -5,50 +5,181 @@ Description: This script deals with imported data.
 """
 
 # IMPORTS
+import math
+
+import numpy as np
+import pandas as pd
 import streamlit as st
 
-from methods import save_df, track_moods
+from methods import (MOOD_MASK, LibraryOverlay, apply_track_edits, edits_by_id, edits_df, get_master_mood_index,
+                     get_master_store, get_snapshot_store, load_library, load_master_df, metrics, query_tracks, save_df,
+                     save_master_df, session_df, show_metrics_panel, track_moods, url_templates)
+from snapshots import KEEP_SNAPSHOTS, SNAPSHOT_PREFIX
+
+# DEFINITIONS
+PAGE_SIZES = [50, 100, 250, 500]
+SOURCES = ["Imported data", "Master dataset"]
+
+
+def keep_edits(edits: dict) -> dict:
+    """Keep edits keyed by track id to be saved to the master store. Returns the edits that weren't kept yet,
+    since the data editor reports its edits on every rerun."""
+    pending = st.session_state.setdefault("pending_edits", {})
+    new_edits = {}
+    for track_id, changes in edits.items():
+        kept = pending.get(track_id, {})
+        new_changes = {col: value for col, value in changes.items() if col not in kept or kept[col] != value}
+        if new_changes:
+            new_edits[track_id] = new_changes
+    for track_id, changes in new_edits.items():
+        pending.setdefault(track_id, {}).update(changes)
+    return new_edits
+
+
+def record_edits(edits: dict):
+    """Apply edits keyed by track id to this session's data, and keep them to be saved to the master store."""
+    new_edits = keep_edits(edits)
+    if new_edits:
+        st.session_state.library.edit(new_edits)
+
 
 # Page and app config
 st.set_page_config(page_title="Music Exploration Tool - Data", page_icon="🎵",  layout="wide")
 st.title("Spotify Data")
 
 # Get data
-df = st.session_state.df
+df = session_df()
+store = get_master_store()
+source = st.radio(label="Show:", options=SOURCES, horizontal=True)
+show_master = source == "Master dataset" and not store.is_empty()
+table = load_master_df(version=store.version) if show_master else df
 
 # Show data in table form
 st.markdown("#### The Data")
-st.write(f"Dataframe dimensions: {df.shape[0]} rows x {df.shape[1]} columns")
+# Mood bitmasks are only used to filter by mood, so they aren't shown
+shown_columns = [col for col in table.columns if col != MOOD_MASK]
+st.write(f"Dataframe dimensions: {table.shape[0]} rows x {len(shown_columns)} columns")
 st.write("*You can edit fields in this dataframe, so play around with it, but be careful!*")
-edited_df = st.experimental_data_editor(df)
+
+# Filtering, sorting and paging happen here, so only the rows of one page are sent to the browser
+filter_cols = st.columns([3, 3, 1, 2, 1])
+search = filter_cols[0].text_input(label="Search name or artist:")
+selected_moods = filter_cols[1].multiselect(label="With moods:", options=track_moods)
+match_all = filter_cols[2].radio(label="Match:", options=["All moods", "Any mood"]) == "All moods"
+sort_by = filter_cols[3].selectbox(label="Sort by:", options=[None] + shown_columns,
+                                   format_func=lambda col: "Imported order" if col is None else col)
+ascending = filter_cols[4].radio(label="Order:", options=["Ascending", "Descending"]) == "Ascending"
+
+if show_master:
+    query = (store.version, search, tuple(selected_moods), sort_by, ascending, match_all)
+    if st.session_state.get("master_query", {}).get("query") != query:
+        mood_index = get_master_mood_index(store.version) if selected_moods else None
+        with metrics.timer("query_tracks"):
+            positions = query_tracks(table, search, selected_moods, sort_by, ascending, match_all, mood_index)
+        st.session_state.master_query = {"query": query, "positions": positions}
+    positions = st.session_state.master_query["positions"]
+else:
+    # The selection is kept with the other changes of this session, until the search or the data changes
+    positions = st.session_state.library.select(search, selected_moods, sort_by, ascending, match_all)
+
+page_cols = st.columns([1, 1, 4])
+page_size = page_cols[0].selectbox(label="Rows per page:", options=PAGE_SIZES)
+n_pages = max(1, math.ceil(len(positions) / page_size))
+page_number = page_cols[1].number_input(label=f"Page (of {n_pages}):", min_value=1, max_value=n_pages, value=1)
+page = table.iloc[positions[(page_number - 1) * page_size:page_number * page_size]].reset_index(drop=True)
+# Edits not saved yet are shown on every page they appear in
+apply_track_edits(page, st.session_state.get("pending_edits", {}))
+page_cols[2].write(f"{len(positions)} matching tracks")
+
+# The editor starts afresh after edits are saved
+editor_key = f"data_editor_{st.session_state.get('editor_generation', 0)}"
+st.data_editor(page, key=editor_key, hide_index=True, column_order=shown_columns,
+               disabled=["id"] + [col for col in url_templates if col in page.columns])
+# Only the cells that were changed are applied, by track id
+record_edits(edits_by_id(page, st.session_state[editor_key]["edited_rows"]))
+
 st.write("")
 reload_button = st.button("Reload data")
 if reload_button:
-    df = st.session_state.df
+    df = session_df()
     st.success("Reloaded!")
 save_button = st.button("Save data")
 if save_button:
-    fp = save_df(st.session_state.df)
-    st.success("File has been successfully saved!")
+    fp = save_df(session_df())
+    st.success(f"File has been successfully saved as {fp}!")
 add_cluster_button = st.button("Add clusters")
 if add_cluster_button:
     if "cluster_labels" not in st.session_state:
         st.error("*You need to run clustering first!*")
     else:
-        df["cluster"] = st.session_state.cluster_labels
+        # Only the tracks whose cluster changed are edited, so that only they are journaled
+        labels = np.asarray(st.session_state.cluster_labels)
+        changed = df["cluster"].astype(str).to_numpy() != labels.astype(str)
+        keep_edits({track_id: {"cluster": label} for track_id, label in zip(df["id"][changed], labels[changed])})
+        st.session_state.library.set_cluster_labels(labels)
         st.success("Added! Click the Add clusters button again or the Reload data button to see the updated dataframe.")
 
 # Add notes and/or moods to dataframe
 st.markdown("#### Add moods to dataframe")
 with st.form("Add moods"):
     st.write("*You can also add these directly in through the dataframe above, but this helps with choosing moods!*")
-    selected_row = st.selectbox(label="Select a track:",
-                                options=df["name"])
+    selected_row = st.selectbox(label="Select a track from this page:",
+                                options=range(len(page)),
+                                format_func=lambda i: page["name"].iloc[i])
     user_moods = st.multiselect("Choose moods:",
                                 options=track_moods)
     user_notes = st.text_input("Enter your notes:")
     submitted_new_df = st.form_submit_button("Add mood and/or notes!")
-    if submitted_new_df:
-        df.loc[df["name"] == selected_row, "moods"] = ", ".join(user_moods)
-        df.loc[df["name"] == selected_row, "notes"] = user_notes
+    if submitted_new_df and selected_row is not None:
+        # Only what was filled in is changed, since empty values clear the saved ones
+        changes = {}
+        if user_moods:
+            changes["moods"] = ", ".join(user_moods)
+        if user_notes:
+            changes["notes"] = user_notes
+        record_edits({page["id"].iloc[selected_row]: changes})
         st.success("Added successfully!")
+
+# Save the edits made on this page, which are kept per track id until then
+st.markdown("#### Save edits")
+pending_edits = st.session_state.get("pending_edits", {})
+save_edits_button = st.button(f"Save {len(pending_edits)} edited tracks to master dataset",
+                              disabled=not pending_edits)
+if save_edits_button and st.session_state.pending_edits:
+    # Edited cells left empty clear the saved value, and cells that weren't edited keep it
+    save_master_df(edits_df(st.session_state.pending_edits), clear_empty=True)
+    get_snapshot_store().record(st.session_state.pending_edits)
+    st.session_state.pending_edits = {}
+    st.session_state.editor_generation = st.session_state.get("editor_generation", 0) + 1
+    st.success("Edits have been saved to the master dataset!")
+
+# Restore an earlier save, optionally with the edits journaled after it
+st.markdown("#### Saved versions")
+snapshot_store = get_snapshot_store()
+snapshots = snapshot_store.snapshots()
+with st.expander(f"{len(snapshots)} saved versions, {snapshot_store.journal_seq} journaled edits"):
+    if snapshots:
+        versions = pd.DataFrame(snapshots[::-1])
+        versions["created_at"] = pd.to_datetime(versions["created_at"], unit="s")
+        st.dataframe(versions[["id", "created_at", "rows", "changed_rows", "journal_seq"]].rename(columns={
+            "id": "version", "created_at": "saved at", "rows": "tracks", "changed_rows": "rows written",
+            "journal_seq": "journaled edits"}), hide_index=True)
+        with st.form("Restore version"):
+            snapshot_id = st.selectbox("Version:", options=[snapshot["id"] for snapshot in reversed(snapshots)])
+            journal_seq = st.number_input("Replay journaled edits up to (0 for none):", min_value=0,
+                                          max_value=snapshot_store.journal_seq, value=0)
+            if st.form_submit_button("Restore version"):
+                reference = f"{SNAPSHOT_PREFIX}{snapshot_id}"
+                if journal_seq > snapshot_store.get(snapshot_id)["journal_seq"]:
+                    reference += f"@{journal_seq}"
+                st.session_state.library = LibraryOverlay(load_library(reference)[0], (reference,))
+                st.session_state.pending_edits = {}
+                st.session_state.editor_generation = st.session_state.get("editor_generation", 0) + 1
+                st.success(f"Restored {reference}! Click the Reload data button to see it.")
+        keep = st.number_input("Versions to keep:", min_value=1, value=KEEP_SNAPSHOTS)
+        if st.button("Compact saved versions"):
+            snapshot_store.compact(keep)
+            st.success(f"Kept the latest {keep} versions and the edits journaled after the oldest of them.")
+
+# PERFORMANCE METRICS
+show_metrics_panel()
@@ -6,112 +6,131 @@ Description: This script deals with the visualisations of the data.
 
 # IMPORTS
 import streamlit as st
-import plotly.colors as pc
-import plotly.graph_objects as go
 
-from methods import feature_cols, visual_cols
+from figures import (MAX_RADAR_TRACES, box_figure, group_summary_figure, histogram_figure, mood_counts_figure,
+                     show_figure, track_radar_figure)
+from methods import (ALL_TRACKS, PREAGGREGATE_MIN_ROWS, feature_cols, feature_matrix_for, session_aggregates,
+                     session_df, show_metrics_panel, track_moods, visual_cols)
 
+# DEFINITIONS
+# Groups listed in the group summaries at most, in decreasing order of tracks
+MAX_GROUP_ROWS = 1000
 
 # Page and app config
 st.set_page_config(page_title="Music Exploration Tool - Data Visualisations", page_icon="🎵",  layout="wide")
 st.title("Visualisations of Spotify Playlist")
-tab1, tab2, tab3 = st.tabs(["Line Polar Plot of Features", "Histogram Distribution Plots", "Box Plots of Features"])
+tab1, tab2, tab3, tab4, tab5 = st.tabs(["Line Polar Plot of Features", "Histogram Distribution Plots",
+                                        "Box Plots of Features", "Moods", "Group Summaries"])
 
 # Define data
-df = st.session_state.df
+df = session_df()
+
+# Summarise values on the server for large datasets, so that only the summaries are sent to the browser
+preaggregate = st.sidebar.checkbox(label="Summarise plots on the server",
+                                   value=len(df) >= PREAGGREGATE_MIN_ROWS,
+                                   help="Histograms and box plots are computed here and only the bins and box "
+                                        "statistics are sent to the browser, which keeps large datasets responsive.")
+
+# Only plot the tracks with the chosen moods, found in the mood index of this session
+mood_index = st.session_state.library.mood_index()
+filter_moods = st.sidebar.multiselect(label="Only plot tracks with moods:", options=track_moods)
+match_all = st.sidebar.radio(label="Match:", options=["All moods", "Any mood"], horizontal=True) == "All moods"
+plot_df = df.iloc[mood_index.positions(filter_moods, match_all)] if filter_moods else df
+if filter_moods:
+    st.sidebar.caption(f"{len(plot_df)} of {len(df)} tracks have these moods.")
+
+# Summaries of every track, or of the tracks with one mood, are read from the aggregates of the session instead
+aggregate_group = None
+if preaggregate and len(filter_moods) <= 1:
+    aggregate_group = ("mood", filter_moods[0]) if filter_moods else ("all", ALL_TRACKS)
 
 # TAB1
 # LINE POLAR PLOT OF FEATURES
 with tab1:
     st.write("### Line Polar Plot of Features")
-    df_1 = df[visual_cols + ["name"]]
     # Filter the dataframe for the selected rows
     selected_rows = st.multiselect(label="Select tracks to include:",
-                                   options=df_1["name"].tolist(),
-                                   default=df_1["name"].tolist()[0])
-    filtered_rows = df_1[df_1["name"].isin(selected_rows)]
+                                   options=plot_df["name"].tolist(),
+                                   default=plot_df["name"].tolist()[:1])
+    filtered_rows = plot_df[plot_df["name"].isin(selected_rows)]
 
     # Filter the dataframe for the selected features
     selected_features = st.multiselect(label="Select features to include:",
                                        options=visual_cols,
                                        default=visual_cols)
-    filtered_rows = filtered_rows[selected_features + ["name"]]
-
-    # Create a list of traces for each selected row
-    traces = []
-    for _, row in filtered_rows.iterrows():
-        feature_names = filtered_rows.columns[1:]
-        feature_values = row.values[1:]
-        feature_values = list(feature_values) + [feature_values[0]]
-        trace = go.Scatterpolar(
-            r=feature_values,
-            theta=feature_names,
-            fill='toself',
-            opacity=0.5,
-            hovertext=[row["name"]] * len(feature_names)
-        )
-        traces.append(trace)
-
-    fig = go.Figure(data=traces)
-    fig.update_layout(polar=dict(radialaxis=dict(visible=True, range=[0, 1])), showlegend=False)
-    fig.update_layout(height=600, width=800)
-    st.plotly_chart(fig, use_container_width=True)
+    if len(filtered_rows) > MAX_RADAR_TRACES:
+        st.warning(f"Only the first {MAX_RADAR_TRACES} selected tracks are plotted.")
+
+    fig = track_radar_figure(filtered_rows["name"].tolist(),
+                             feature_matrix_for(filtered_rows, selected_features),
+                             selected_features)
+    show_figure(fig, use_container_width=True)
 
 
 # TAB2
 # HISTOGRAM DISTRIBUTION PLOTS
 with tab2:
     st.write("### Histogram")
-    df_2 = df[feature_cols]
     # Select columns to include in the plot
     selected_columns = st.multiselect(label="Select columns to include:",
                                       options=feature_cols,
                                       default=visual_cols,
                                       key="data_v_tab_2")
-    # Filter the DataFrame for the selected columns
-    filtered_df = df_2[selected_columns]
-    # Create traces for each selected column
-    traces = []
-    for column in filtered_df.columns:
-        # Create the histogram trace for the current column
-        trace = go.Histogram(x=filtered_df[column], opacity=0.7, name=column)
-        traces.append(trace)
-
-    fig = go.Figure(data=traces)
-    fig.update_layout(barmode='overlay',
-                      bargap=0.1,
-                      xaxis=dict(title='Value', title_font=dict(size=14)),
-                      yaxis=dict(title='Frequency', title_font=dict(size=14))
-                      )
-    st.plotly_chart(fig, use_container_width=True)
+    if aggregate_group is not None:
+        aggregates = session_aggregates()
+        fig = histogram_figure(None, selected_columns, preaggregate,
+                               [aggregates.histogram(*aggregate_group, column) for column in selected_columns])
+    else:
+        # Take the selected columns as float32, from the shared feature matrix where possible
+        fig = histogram_figure(feature_matrix_for(plot_df, selected_columns), selected_columns, preaggregate)
+    show_figure(fig, use_container_width=True)
 
 # TAB3
 # BOX PLOTS
 with tab3:
     st.write("### Box Plot of Features")
-    df_3 = df[feature_cols]
     # Select columns to include in the plot
     selected_features = st.multiselect(label="Select columns to include:",
                                        options=feature_cols,
                                        default=visual_cols[:10],
                                        max_selections=10,
                                        key="data_v_tab_3")
-    # Filter the DataFrame for the selected columns
-    filtered_data = df_3[selected_features]
-
-    # Create the box plots
-    fig = go.Figure()
-    colors = pc.qualitative.Plotly[:len(selected_features)]
-
-    for i, feature in enumerate(filtered_data[selected_features]):
-        fig.add_trace(go.Box(y=filtered_data[feature],
-                             name=feature,
-                             boxpoints="all",
-                             jitter=0.3,
-                             marker_color=colors[i]))
-    fig.update_layout(title="Box Plots of Selected Features",
-                      yaxis_title="Feature",
-                      xaxis_title="Value",
-                      violinmode="group",
-                      showlegend=True)
-    st.plotly_chart(fig, use_container_width=True)
+    if aggregate_group is not None:
+        aggregates = session_aggregates()
+        fig = box_figure(None, selected_features, preaggregate,
+                         [aggregates.box(*aggregate_group, feature) for feature in selected_features])
+    else:
+        # Take the selected columns as float32, from the shared feature matrix where possible
+        fig = box_figure(feature_matrix_for(plot_df, selected_features), selected_features, preaggregate)
+    show_figure(fig, use_container_width=True)
+
+# TAB4
+# MOOD COUNTS
+with tab4:
+    st.write("### Tracks with each Mood")
+    # Counted from the mood index, without reading the moods of every track
+    fig = mood_counts_figure(mood_index.counts())
+    show_figure(fig, use_container_width=True)
+
+# TAB5
+# GROUP SUMMARIES
+with tab5:
+    st.write("### Features of each Cluster, Artist and Mood")
+    st.write("*These are read from aggregates that are kept up to date as tracks are edited and saved, "
+             "so they don't go through every track. Medians are estimated to within 1%.*")
+    group_cols = st.columns(2)
+    grouping = group_cols[0].radio(label="Group by:", options=["cluster", "artist", "mood"], horizontal=True)
+    feature = group_cols[1].selectbox(label="Feature:", options=feature_cols)
+    table = session_aggregates().table(grouping, feature)
+    if table.empty:
+        st.info(f"No tracks have a {grouping} yet.")
+    elif grouping == "artist":
+        st.write(f"{len(table)} artists, the {min(len(table), MAX_GROUP_ROWS)} with the most tracks are listed.")
+        st.dataframe(table.sort_values("tracks", ascending=False).head(MAX_GROUP_ROWS), use_container_width=True)
+    else:
+        table = table.sort_index()
+        show_figure(group_summary_figure(table, feature), use_container_width=True)
+        st.dataframe(table, use_container_width=True)
+
+# PERFORMANCE METRICS
+show_metrics_panel()
@@ -6,14 +6,15 @@ Description: This script deals with the clustering of the data.
 
 # IMPORTS
 import pandas as pd
-import plotly.colors as pc
 import plotly.graph_objects as go
 import plotly.subplots as sp
 import streamlit as st
 
-from sklearn.cluster import KMeans
-from sklearn.preprocessing import minmax_scale
-from methods import feature_cols, visual_cols
+from clustering import (SWEEP_CLUSTERS, ClusterCache, assign_clusters, clustering_result, fingerprint, fit_incremental,
+                        fit_kmeans, sweep_kmeans)
+from figures import cluster_bar_figure, cluster_radar_figure, mood_cluster_figure, show_figure
+from methods import (analysis_cols, clustering_features, feature_cols, get_analysis_store, get_cluster_cache,
+                     session_df, show_metrics_panel, visual_cols)
 
 
 # Page and app config
@@ -22,7 +23,7 @@ st.title("Clustering of Spotify Playlist Tracks")
 tab1, tab2, tab3 = st.tabs(["Clustering", "Radar Plot of Clusters", "Other Plots"])
 
 # Define data
-df = st.session_state.df
+df = session_df()
 
 # TAB1
 # CLUSTERING
@@ -31,38 +32,110 @@ with tab1:
         # User defined-features and number of clusters
         st.write("Please choose at least 5 features.")
         cluster_features = st.multiselect(label="Select features to use in clustering:",
-                                          options=feature_cols,
-                                          default=visual_cols)
-        df = df[cluster_features]
+                                          options=feature_cols + analysis_cols,
+                                          default=visual_cols,
+                                          help="Timbre, chroma and beat regularity features are derived from "
+                                               "the segments and beats of the audio analysis of each track.")
         n_clusters = st.select_slider(label="Select number of clusters:",
                                       options=range(3, 10),
                                       value=5)
+        cluster_mode = st.radio(label="Clustering mode:",
+                                options=["Full refit",
+                                         "Incremental (continue from the last clustering)",
+                                         "Assign tracks to the last clustering without refitting"],
+                                help="Incremental and assign modes reuse the centroids of the last clustering, "
+                                     "which is much faster for large or growing libraries.")
         submitted_cluster = st.form_submit_button("Go!")
         df_centroids = pd.DataFrame()
         if submitted_cluster:
-            # Perform K-means clustering
-            # Scale any features if necessary
-            for feature in cluster_features:
-                if feature not in visual_cols:
-                    df[feature] = minmax_scale(df[[feature]])
-
-            kmeans = KMeans(n_clusters=n_clusters, random_state=42)
-            kmeans.fit(df)
-            cluster_labels = kmeans.labels_
-            df_clustered = df
-            df_clustered["cluster"] = cluster_labels
+            # Centroids of the last clustering, if it used the same features
+            previous_centroids = st.session_state.get("df_centroids")
+            if previous_centroids is not None and list(previous_centroids.columns) != cluster_features:
+                previous_centroids = None
+
+            if set(cluster_features) & set(analysis_cols):
+                missing_arrays = get_analysis_store().missing(list(df["id"]))
+                if missing_arrays:
+                    st.info(f"{len(missing_arrays)} of {len(df)} tracks have no stored audio analysis, so their "
+                            "timbre, chroma and beat regularity are filled with the average. "
+                            "Import their playlists again to fetch it.")
 
-            # Calculate the centroid values for each cluster
-            centroids = kmeans.cluster_centers_
-            df_centroids = pd.DataFrame(centroids, columns=df.columns[:-1])
+            # Perform K-means clustering
+            # Take the features as float32 and scale any features if necessary. Clusterings that reuse the last
+            # centroids also reuse its scaling, since the centroids were fitted to tracks scaled that way
+            reuse_centroids = previous_centroids is not None and (
+                cluster_mode.startswith("Assign")
+                or (cluster_mode.startswith("Incremental") and len(previous_centroids) == n_clusters))
+            features, feature_ranges = clustering_features(
+                df, cluster_features, st.session_state.get("feature_ranges") if reuse_centroids else None)
+            features_fingerprint = fingerprint(features)
+            cluster_cache = get_cluster_cache()
+
+            if cluster_mode.startswith("Assign") and previous_centroids is not None:
+                init_centroids = previous_centroids.to_numpy()
+                n_clusters = len(init_centroids)
+                key = ClusterCache.key(features_fingerprint, cluster_features, n_clusters, "assign",
+                                       init_centroids=init_centroids)
+                result = cluster_cache.get(key)
+                if result is None:
+                    result = clustering_result(features, assign_clusters(features, init_centroids), init_centroids)
+            elif cluster_mode.startswith("Incremental"):
+                warm_start = previous_centroids is not None and len(previous_centroids) == n_clusters
+                init_centroids = previous_centroids.to_numpy() if warm_start else None
+                key = ClusterCache.key(features_fingerprint, cluster_features, n_clusters, "incremental",
+                                       init_centroids=init_centroids)
+                result = cluster_cache.get(key)
+                if result is None:
+                    result = clustering_result(features, *fit_incremental(features, n_clusters, init_centroids))
+            else:
+                if not cluster_mode.startswith("Full"):
+                    st.info("There is no earlier clustering with these features, so clustering was refitted.")
+                key = ClusterCache.key(features_fingerprint, cluster_features, n_clusters)
+                result = cluster_cache.get(key)
+                if result is None:
+                    result = clustering_result(features, *fit_kmeans(features, n_clusters))
+            cluster_cache.put(key, result)
+
+            # Centroid values and mean feature values of each cluster
+            df_centroids = pd.DataFrame(result["centroids"], columns=cluster_features)
+            df_mean = pd.DataFrame(result["means"], columns=cluster_features)
+            df_mean.insert(0, "cluster", range(len(df_mean)))
+            df_mean = df_mean[result["counts"] > 0].reset_index(drop=True)
 
             # Add clustering results to session state
-            st.session_state.cluster_labels = cluster_labels
+            st.session_state.cluster_labels = result["labels"]
             st.session_state.df_centroids = df_centroids
-            st.session_state.df_clustered = df_clustered
+            st.session_state.feature_ranges = feature_ranges
+            st.session_state.df_mean = df_mean
 
             st.success("Clustering done!")
 
+    # Fit every number of clusters at once to compare them
+    st.markdown("#### Compare numbers of clusters")
+    st.write("*This fits every number of clusters in parallel with the features selected above. "
+             "Afterwards, full refits with these features are instant.*")
+    if st.button("Sweep all numbers of clusters"):
+        with st.spinner("Fitting every number of clusters..."):
+            features, _ = clustering_features(df, cluster_features)
+            sweep_results = sweep_kmeans(features, SWEEP_CLUSTERS)
+        # Cache every fitted model, so that full refits with any of these numbers of clusters are instant
+        features_fingerprint = fingerprint(features)
+        for k, sweep_result in sweep_results.items():
+            get_cluster_cache().put(ClusterCache.key(features_fingerprint, cluster_features, k),
+                                    clustering_result(features, sweep_result["labels"], sweep_result["centroids"]))
+        st.session_state.sweep = sweep_results
+    if "sweep" in st.session_state:
+        sweep_results = st.session_state.sweep
+        fig = sp.make_subplots(rows=1, cols=2, subplot_titles=["Inertia (lower is tighter)",
+                                                               "Silhouette score (higher is better separated)"])
+        fig.add_trace(go.Scatter(x=list(sweep_results), y=[r["inertia"] for r in sweep_results.values()],
+                                 mode="lines+markers", name="Inertia"), row=1, col=1)
+        fig.add_trace(go.Scatter(x=list(sweep_results), y=[r["silhouette"] for r in sweep_results.values()],
+                                 mode="lines+markers", name="Silhouette"), row=1, col=2)
+        fig.update_xaxes(title_text="Number of clusters")
+        fig.update_layout(showlegend=False, height=400)
+        show_figure(fig, use_container_width=True)
+
 # TAB2
 # RADAR PLOT OF FEATURES IN CLUSTER
 with tab2:
@@ -74,33 +147,10 @@ with tab2:
     selected_features = st.multiselect(label="Select features to plot:",
                                        options=cluster_features,
                                        default=cluster_features[0:5])
-    if "df_clustered" in st.session_state:
-        df_clustered = st.session_state.df_clustered
-        df_mean = df_clustered.groupby("cluster").mean().reset_index()
-
-        fig = go.Figure()
-        cluster_colors = pc.qualitative.Plotly[:n_clusters]
-        max_value = df_mean[selected_features].max().max()  # Calculate the maximum value across selected features
-
-        for i in selected_clusters:
-            centroid_values = df_mean[df_mean["cluster"] == i][selected_features].values.flatten().tolist()
-            fig.add_trace(go.Scatterpolar(
-                r=centroid_values + [centroid_values[0]],
-                theta=selected_features + [selected_features[0]],
-                opacity=0.6,
-                fill="toself",
-                name=f"Cluster {i}",
-                fillcolor=cluster_colors[i],
-                line=dict(color='rgba(0,0,0,0)')
-            ))
-
-        fig.update_layout(
-            polar=dict(radialaxis=dict(visible=True, range=[0, max_value])),
-            showlegend=True
-        )
-        fig.update_layout(height=600, width=800)
+    if "df_mean" in st.session_state:
+        fig = cluster_radar_figure(st.session_state.df_mean, selected_clusters, selected_features)
         # Plotly chart
-        st.plotly_chart(fig)
+        show_figure(fig)
     else:
         st.error("Please run or re-run clustering again.")
 
@@ -110,46 +160,19 @@ with tab3:
     selected_columns = st.multiselect(label="Select columns to plot:",
                                       options=cluster_features,
                                       default=cluster_features)
-    if "df_clustered" in st.session_state:
-        df_clustered = st.session_state.df_clustered
-        df_mean = df_clustered.groupby("cluster").mean().reset_index()
-
-        # Define the color palette and facet grids for subplots
-        colors = pc.qualitative.Plotly
-        num_plots = len(selected_columns)
-        num_rows = (num_plots + 2) // 3
-
-        fig = sp.make_subplots(rows=num_rows, cols=3, subplot_titles=selected_columns)
-
-        for i, column in enumerate(selected_columns):
-            row = i // 3 + 1
-            col = i % 3 + 1
-
-            for _, row_data in df_mean.iterrows():
-                cluster = int(row_data['cluster'])
-                fig.add_trace(go.Bar(
-                    x=[cluster],
-                    y=[row_data[column]],
-                    name=f'Cluster {cluster}',
-                    marker=dict(color=colors[cluster])
-                ), row=row, col=col)
-
-        fig.update_layout(
-            title_text="Average of Columns by Cluster",
-            grid=dict(rows=num_rows, columns=3),
-            height=500 * num_rows,
-            showlegend=False,
-            margin=dict(l=20, r=20, t=60, b=50),
-            width=1000
-        )
-        fig.update_xaxes(title_text="Cluster", row=num_rows, col=1)
-        for i, column in enumerate(selected_columns):
-            row = i // 3 + 1
-            col = i % 3 + 1
-
-            fig.update_xaxes(title_text="Cluster", row=row, col=col)
-            fig.update_yaxes(title_text=column, row=row, col=col)
-
-        st.plotly_chart(fig)
+    if "df_mean" in st.session_state:
+        fig = cluster_bar_figure(st.session_state.df_mean, selected_columns)
+        show_figure(fig)
     else:
         st.error("Please run or re-run clustering again.")
+
+    # Tracks with each mood per cluster, counted from the mood index of this session
+    st.subheader("Moods in each cluster")
+    if "cluster_labels" in st.session_state and len(st.session_state.cluster_labels) == len(df):
+        crosstab = st.session_state.library.mood_index().crosstab(st.session_state.cluster_labels)
+        show_figure(mood_cluster_figure(crosstab), use_container_width=True)
+    else:
+        st.error("Please run or re-run clustering again.")
+
+# PERFORMANCE METRICS
+show_metrics_panel()
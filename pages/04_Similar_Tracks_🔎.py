@@ -0,0 +1,43 @@
+"""
+Similar Tracks (Music Exploration Tool)
+Author: Yvonne Teo
+Description: This script finds tracks in the master dataset that sound similar to a selected track.
+"""
+
+# IMPORTS
+import time
+
+import streamlit as st
+
+from methods import get_similarity_index, session_df, show_metrics_panel, similar_tracks
+
+
+# Page and app config
+st.set_page_config(page_title="Music Exploration Tool - Similar Tracks", page_icon="🎵",  layout="wide")
+st.title("Find Similar Tracks")
+
+# Define data
+df = session_df()
+index = get_similarity_index()
+
+st.write(f"*Tracks are compared by all their features across the {len(index)} tracks in the master dataset.*")
+track_labels = df["name"].astype(str) + " - " + df["artist"].astype(str)
+selected_row = st.selectbox(label="Select a track:",
+                            options=range(len(df)),
+                            format_func=lambda i: track_labels.iloc[i])
+n_similar = st.slider(label="Number of similar tracks:",
+                      min_value=1,
+                      max_value=50,
+                      value=10)
+
+start = time.perf_counter()
+similar = similar_tracks(df["id"].iloc[selected_row], n_similar)
+elapsed = time.perf_counter() - start
+if similar is None:
+    st.error("This track is not in the master dataset yet. Please import it again.")
+else:
+    st.dataframe(similar, use_container_width=True, hide_index=True)
+    st.caption(f"Found in {elapsed * 1000:.1f} ms.")
+
+# PERFORMANCE METRICS
+show_metrics_panel()
@@ -0,0 +1,91 @@
+"""
+Library Map (Music Exploration Tool)
+Author: Yvonne Teo
+Description: This script shows every track in the master dataset on a 2-D map of their features.
+"""
+
+# IMPORTS
+import numpy as np
+import pandas as pd
+import plotly.colors as pc
+import plotly.graph_objects as go
+import streamlit as st
+
+from figures import show_figure
+from methods import (MOOD_MASK, first_moods, get_feature_matrix, get_master_store, get_projection, has_moods,
+                     load_master_df, session_df, show_metrics_panel, track_moods)
+
+# DEFINITIONS
+# Beyond this many tracks, the map shows the density of tracks instead of each track
+MAP_MAX_POINTS = 200_000
+DENSITY_BINS = 200
+
+
+# Page and app config
+st.set_page_config(page_title="Music Exploration Tool - Library Map", page_icon="🎵",  layout="wide")
+st.title("Map of the Library")
+st.write("*Every track in the master dataset, placed so that tracks with similar features are close together. "
+         "The axes are the two main directions in which features vary across the library.*")
+
+# Define data
+df = session_df()
+version = get_master_store().version
+matrix = get_feature_matrix(version)
+projection = get_projection(version)
+track_info = load_master_df(("id", "name", "artist", "moods"), version).set_index("id").reindex(matrix.ids)
+masks = track_info[MOOD_MASK].fillna(0).to_numpy(dtype=np.uint32)
+
+color_by = st.radio(label="Colour tracks by:",
+                    options=["Nothing", "Cluster (from the last clustering)", "Mood (first in the list of moods)"],
+                    horizontal=True)
+# Only show the tracks with the chosen moods, from the bitmasks of their moods
+filter_cols = st.columns([3, 1])
+filter_moods = filter_cols[0].multiselect(label="Only show tracks with moods:", options=track_moods)
+match_all = filter_cols[1].radio(label="Match:", options=["All moods", "Any mood"], horizontal=True) == "All moods"
+shown = has_moods(masks, filter_moods, match_all) if filter_moods else np.ones(len(masks), dtype=bool)
+if color_by.startswith("Cluster"):
+    if "cluster_labels" in st.session_state and len(st.session_state.cluster_labels) == len(df):
+        # Labels are per row of the session's library, so they are matched to the tracks of the map by id
+        labels = pd.Series(np.asarray(st.session_state.cluster_labels).astype(str), index=df["id"].to_numpy())
+        labels = labels[~labels.index.duplicated(keep="last")].reindex(matrix.ids)
+        groups = ("Cluster " + labels).fillna("Not clustered").to_numpy(dtype=str)
+    else:
+        st.error("*You need to run clustering on this library first!*")
+        groups = np.full(len(matrix.ids), "All tracks")
+elif color_by.startswith("Mood"):
+    moods = first_moods(masks)
+    groups = np.where(moods == "", "No mood", moods).astype(str)
+else:
+    groups = np.full(len(matrix.ids), "All tracks")
+
+if filter_moods:
+    st.caption(f"{shown.sum()} of {len(shown)} tracks have these moods.")
+if shown.sum() > MAP_MAX_POINTS:
+    # Too many tracks to draw one by one, so bin them on the server and show the density
+    st.caption(f"Showing the density of {shown.sum()} tracks. Colours are not available at this size.")
+    counts, x_edges, y_edges = np.histogram2d(projection[shown, 0], projection[shown, 1], bins=DENSITY_BINS)
+    fig = go.Figure(go.Heatmap(x=(x_edges[:-1] + x_edges[1:]) / 2,
+                               y=(y_edges[:-1] + y_edges[1:]) / 2,
+                               z=np.log1p(counts.T),
+                               colorscale="Viridis",
+                               colorbar=dict(title="log(1 + tracks)")))
+else:
+    fig = go.Figure()
+    colors = pc.qualitative.Plotly
+    hover = (track_info["name"].astype(str) + " - " + track_info["artist"].astype(str)).to_numpy()
+    for i, group in enumerate(np.unique(groups[shown])):
+        in_group = (groups == group) & shown
+        fig.add_trace(go.Scattergl(x=projection[in_group, 0],
+                                   y=projection[in_group, 1],
+                                   mode="markers",
+                                   name=group,
+                                   hovertext=hover[in_group],
+                                   hoverinfo="text",
+                                   marker=dict(size=4, opacity=0.7, color=colors[i % len(colors)])))
+fig.update_layout(height=700,
+                  xaxis=dict(title="First principal component"),
+                  yaxis=dict(title="Second principal component"))
+show_figure(fig, use_container_width=True)
+
+# PERFORMANCE METRICS
+show_metrics_panel()
@@ -0,0 +1,120 @@
+"""
+Similarity (Music Exploration Tool)
+Author: Yvonne Teo
+Description: This script includes the nearest-neighbour index used to find tracks that sound similar to a track.
+"""
+
+# IMPORTS
+import threading
+
+import numpy as np
+import pandas as pd
+
+from sklearn.neighbors import KDTree
+
+# DEFINITIONS
+# Rows scored at a time by the brute-force search
+BLOCK_ROWS = 262_144
+# Libraries at least this large are searched with a KD-tree instead of brute force
+TREE_MIN_ROWS = 200_000
+# The KD-tree is rebuilt once this share of rows was added since it was built
+TREE_REBUILD_SHARE = 0.1
+
+
+class SimilarityIndex:
+    """Cosine similarity index over standardised feature vectors.
+    Vectors are standardised with the mean and standard deviation of the library the index was
+    built from, then normalised to unit length. Small libraries are searched by blocked brute force.
+    Large libraries are searched with a KD-tree, since on unit vectors the nearest by Euclidean distance
+    are the most similar by cosine. Rows added after the tree was built are searched by brute force
+    until enough have been added to rebuild it. The index is shared by every session, so adding tracks replaces its
+    arrays instead of changing them, and a query searches the arrays and tree it found when it started."""
+
+    def __init__(self, ids, features: np.ndarray, version: int = None):
+        features = np.asarray(features, dtype=np.float32)
+        self.mean = np.nanmean(features, axis=0)
+        std = np.nanstd(features, axis=0)
+        self.std = np.where(std > 0, std, 1).astype(np.float32)
+        self.ids = np.asarray(ids, dtype=object)
+        self.vectors = self._normalise(features)
+        self.row_index = pd.Index(self.ids)
+        self.version = version
+        self.tree = None
+        self.tree_rows = 0
+        self.lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def _normalise(self, features: np.ndarray) -> np.ndarray:
+        vectors = np.nan_to_num((np.asarray(features, dtype=np.float32) - self.mean) / self.std)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.where(norms > 0, norms, 1)
+
+    def add(self, ids, features: np.ndarray, version: int = None):
+        """Add tracks to the index, replacing the vectors of tracks that are already in it."""
+        ids = np.asarray(ids, dtype=object)
+        vectors = self._normalise(features)
+        with self.lock:
+            existing = self.row_index.get_indexer(ids)
+            updated = existing >= 0
+            all_ids = np.concatenate([self.ids, ids[~updated]])
+            all_vectors = np.concatenate([self.vectors, vectors[~updated]])
+            all_vectors[existing[updated]] = vectors[updated]
+            if updated.any():
+                # Replaced rows may be in the tree, so it has to be rebuilt
+                self.tree = None
+            self.ids, self.vectors, self.row_index = all_ids, all_vectors, pd.Index(all_ids)
+            self.version = version
+
+    def changed(self, ids, features: np.ndarray) -> np.ndarray:
+        """Get which of the given tracks are new to the index or have different vectors, as a boolean mask."""
+        vectors = self._normalise(features)
+        with self.lock:
+            positions = self.row_index.get_indexer(np.asarray(ids, dtype=object))
+            stored = self.vectors
+        changed = positions < 0
+        changed[~changed] = (vectors[~changed] != stored[positions[~changed]]).any(axis=1)
+        return changed
+
+    @staticmethod
+    def _search_brute(vectors: np.ndarray, vector: np.ndarray, k: int, start: int = 0) -> tuple:
+        """Get the rows with the highest cosine similarity from `start` onwards, scoring one block at a time."""
+        best_rows = np.empty(0, dtype=np.int64)
+        best_scores = np.empty(0, dtype=np.float32)
+        for block_start in range(start, len(vectors), BLOCK_ROWS):
+            scores = vectors[block_start:block_start + BLOCK_ROWS] @ vector
+            top = np.argpartition(-scores, min(k, len(scores)) - 1)[:k]
+            best_rows = np.concatenate([best_rows, top + block_start])
+            best_scores = np.concatenate([best_scores, scores[top]])
+        return best_rows, best_scores
+
+    @classmethod
+    def _search_tree(cls, vectors: np.ndarray, tree: KDTree, tree_rows: int, vector: np.ndarray, k: int) -> tuple:
+        """Get the nearest rows in the tree, and the best rows added after it was built by brute force."""
+        distances, rows = tree.query(vector[None, :], k=min(k, tree_rows))
+        # For unit vectors, cosine similarity is 1 - half the squared Euclidean distance
+        tree_rows_found, tree_scores = rows[0], (1 - distances[0] ** 2 / 2).astype(np.float32)
+        new_rows, new_scores = cls._search_brute(vectors, vector, k, start=tree_rows)
+        return np.concatenate([tree_rows_found, new_rows]), np.concatenate([tree_scores, new_scores])
+
+    def query(self, track_id: str, k: int = 10) -> pd.DataFrame:
+        """Get the `k` tracks most similar to a track in the index, most similar first."""
+        with self.lock:
+            ids, vectors, row = self.ids, self.vectors, self.row_index.get_loc(track_id)
+            # The tree is rebuilt by the first query that needs it, while the others wait for it
+            use_tree = len(vectors) >= TREE_MIN_ROWS
+            if use_tree and (self.tree is None or len(vectors) - self.tree_rows > TREE_REBUILD_SHARE * self.tree_rows):
+                self.tree = KDTree(vectors)
+                self.tree_rows = len(vectors)
+            tree, tree_rows = self.tree, self.tree_rows
+        vector = vectors[row]
+        # One extra result, since the track itself is always the most similar
+        if use_tree:
+            rows, scores = self._search_tree(vectors, tree, tree_rows, vector, k + 1)
+        else:
+            rows, scores = self._search_brute(vectors, vector, k + 1)
+        keep = rows != row
+        rows, scores = rows[keep], scores[keep]
+        order = np.argsort(-scores, kind="stable")[:k]
+        return pd.DataFrame({"id": ids[rows[order]], "similarity": scores[order]})
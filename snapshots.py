@@ -0,0 +1,281 @@
+"""
+Snapshots (Music Exploration Tool)
+Author: Yvonne Teo
+Description: This script saves dataframes as snapshots that only store the rows that changed since the last snapshot,
+and keeps an append-only journal of the moods, notes and clusters edited per track, so that saving costs as much as
+what changed and any earlier version can be restored.
+"""
+
+# IMPORTS
+import hashlib
+import json
+import os
+import pickle
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+# DEFINITIONS
+SNAPSHOTS_PATH = "./pickles/snapshots"
+MANIFEST = "manifest.json"
+JOURNAL = "journal.jsonl"
+# Saved dataframes are referred to as "snapshot:<id>", or "snapshot:<id>@<journal entry>" with later edits replayed
+SNAPSHOT_PREFIX = "snapshot:"
+# Columns whose edits are kept in the journal
+JOURNAL_COLUMNS = ["moods", "notes", "cluster"]
+# Snapshots kept by default when the history is compacted
+KEEP_SNAPSHOTS = 10
+
+
+def is_snapshot_reference(file_path: str) -> bool:
+    return str(file_path).startswith(SNAPSHOT_PREFIX)
+
+
+def parse_snapshot_reference(reference: str) -> tuple:
+    """Get the snapshot id and journal entry, or None for none, of a reference like "snapshot:3@120"."""
+    snapshot_id, _, journal_seq = reference[len(SNAPSHOT_PREFIX):].partition("@")
+    return int(snapshot_id), int(journal_seq) if journal_seq else None
+
+
+def row_hashes(dataframe: pd.DataFrame) -> np.ndarray:
+    """Hash every row of a dataframe, so that changed rows can be found without comparing values."""
+    return pd.util.hash_pandas_object(dataframe, index=False, categorize=False).to_numpy()
+
+
+def column_dtypes(dataframe: pd.DataFrame) -> dict:
+    """Describe the dtype of every column of a dataframe in a form that can be saved as JSON, including the
+    categories of categorical columns."""
+    dtypes = {}
+    for col, dtype in dataframe.dtypes.items():
+        if isinstance(dtype, pd.CategoricalDtype):
+            dtypes[col] = {"dtype": "category", "categories": dtype.categories.tolist(), "ordered": dtype.ordered}
+        else:
+            dtypes[col] = {"dtype": str(dtype)}
+    return dtypes
+
+
+def apply_dtypes(dataframe: pd.DataFrame, dtypes: dict) -> pd.DataFrame:
+    """Convert the columns of a dataframe back to the dtypes described by `column_dtypes`."""
+    converted = {}
+    for col, dtype in dtypes.items():
+        if col not in dataframe.columns:
+            continue
+        if dtype["dtype"] == "category":
+            dtype = pd.CategoricalDtype(dtype["categories"], ordered=dtype["ordered"])
+        else:
+            dtype = dtype["dtype"]
+        if dataframe[col].dtype != dtype:
+            converted[col] = dataframe[col].astype(dtype)
+    return dataframe.assign(**converted) if converted else dataframe
+
+
+class SnapshotStore:
+    """Snapshots of dataframes, stored as a chain of content-addressed pickles of rows keyed by track id.
+    Every snapshot adds the rows that are new or changed to the end of the chain, so a snapshot is the first
+    `depth` objects of the chain, where the latest row of each track wins, in the order of its track ids.
+    Objects are named by the hash of their contents, so saving the same rows twice stores them once.
+    Edits of `JOURNAL_COLUMNS` are appended to a journal, which can be replayed on top of a snapshot."""
+
+    def __init__(self, path: str = SNAPSHOTS_PATH):
+        self.path = path
+        os.makedirs(os.path.join(path, "objects"), exist_ok=True)
+        manifest_path = os.path.join(path, MANIFEST)
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                self.manifest = json.load(f)
+        else:
+            self.manifest = {"next_snapshot": 0, "chain": [], "snapshots": []}
+        self.lock = threading.RLock()
+        self.journal_seq = self._read_journal_seq()
+        # Latest row of every track in the whole chain, to find the changed rows of the next snapshot,
+        # and the hashes of those rows for the columns of the latest snapshot
+        self._rows = None
+        self._hashes = None
+        self._hash_columns = None
+
+    def _object_path(self, digest: str) -> str:
+        return os.path.join(self.path, "objects", f"{digest}.pkl")
+
+    def _write_object(self, value) -> str:
+        data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        digest = hashlib.sha256(data).hexdigest()
+        if not os.path.exists(self._object_path(digest)):
+            tmp_path = self._object_path(digest) + ".tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, self._object_path(digest))
+        return digest
+
+    def _read_object(self, digest: str):
+        return pd.read_pickle(self._object_path(digest))
+
+    def _write_manifest(self):
+        tmp_path = os.path.join(self.path, MANIFEST + ".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(self.manifest, f)
+        os.replace(tmp_path, os.path.join(self.path, MANIFEST))
+
+    def _read_journal_seq(self) -> int:
+        journal_seq = self.manifest.get("journal_start", 0)
+        if os.path.exists(os.path.join(self.path, JOURNAL)):
+            with open(os.path.join(self.path, JOURNAL)) as f:
+                for line in f:
+                    if line.strip():
+                        journal_seq = json.loads(line)["seq"]
+        return journal_seq
+
+    def _chain_rows(self, depth: int) -> pd.DataFrame:
+        """Get the latest row of every track in the first `depth` objects of the chain, indexed by track id."""
+        parts = [self._read_object(digest) for digest in self.manifest["chain"][:depth]]
+        if not parts:
+            return pd.DataFrame(index=pd.Index([], name="id"))
+        rows = pd.concat(parts, ignore_index=True)
+        return rows.drop_duplicates("id", keep="last").set_index("id")
+
+    def snapshots(self) -> list:
+        """Get every snapshot, oldest first."""
+        return list(self.manifest["snapshots"])
+
+    def get(self, snapshot_id: int) -> dict:
+        """Get a snapshot, or None if there is no such snapshot."""
+        return next((snapshot for snapshot in self.manifest["snapshots"] if snapshot["id"] == snapshot_id), None)
+
+    def _stored_hashes(self, columns: list) -> pd.Series:
+        """Get the hashes of the stored rows for the given columns, indexed by track id.
+        Returns None if some of the columns are not stored, in which case every row counts as changed."""
+        if self._hash_columns != columns:
+            if not set(columns) - {"id"} <= set(self._rows.columns):
+                return None
+            self._hashes = pd.Series(row_hashes(self._rows.reset_index()[columns]), index=self._rows.index)
+            self._hash_columns = columns
+        return self._hashes
+
+    def save(self, dataframe: pd.DataFrame) -> dict:
+        """Save a dataframe with an `id` column as a new snapshot, storing only the rows that are new or changed.
+        Returns the snapshot, or the latest snapshot if nothing changed since it."""
+        dataframe = dataframe.reset_index(drop=True)
+        with self.lock:
+            if self._rows is None:
+                self._rows = self._chain_rows(len(self.manifest["chain"]))
+            unique = dataframe.drop_duplicates("id", keep="last")
+            hashes = row_hashes(unique)
+            stored_hashes = self._stored_hashes(list(unique.columns))
+            changed = np.ones(len(unique), dtype=bool)
+            if stored_hashes is not None:
+                positions = stored_hashes.index.get_indexer(unique["id"])
+                found = positions >= 0
+                changed[found] = stored_hashes.to_numpy()[positions[found]] != hashes[found]
+            ids_digest = self._write_object(dataframe["id"].to_numpy(dtype=object))
+            latest = self.manifest["snapshots"][-1] if self.manifest["snapshots"] else None
+            if (not changed.any() and latest is not None and latest["ids"] == ids_digest
+                    and latest["columns"] == list(dataframe.columns)
+                    and latest.get("dtypes") == column_dtypes(dataframe)
+                    and latest["depth"] == len(self.manifest["chain"])):
+                return latest
+            if changed.any():
+                changed_rows = unique[changed]
+                self.manifest["chain"].append(self._write_object(changed_rows))
+                kept = ~self._rows.index.isin(changed_rows["id"])
+                self._rows = pd.concat([self._rows[kept], changed_rows.set_index("id")])
+                if stored_hashes is None:
+                    self._hashes = self._hash_columns = None
+                else:
+                    self._hashes = pd.concat([stored_hashes[kept],
+                                              pd.Series(hashes[changed], index=changed_rows["id"])])
+            snapshot = {
+                "id": self.manifest["next_snapshot"],
+                "created_at": time.time(),
+                "depth": len(self.manifest["chain"]),
+                "ids": ids_digest,
+                "columns": list(dataframe.columns),
+                "dtypes": column_dtypes(dataframe),
+                "rows": len(dataframe),
+                "changed_rows": int(changed.sum()),
+                "journal_seq": self.journal_seq,
+            }
+            self.manifest["next_snapshot"] += 1
+            self.manifest["snapshots"].append(snapshot)
+            self._write_manifest()
+        return snapshot
+
+    def restore(self, snapshot_id: int) -> pd.DataFrame:
+        """Load the dataframe saved as a snapshot, without the journal entries made after it."""
+        with self.lock:
+            snapshot = self.get(snapshot_id)
+            if snapshot is None:
+                raise KeyError(f"There is no snapshot {snapshot_id}.")
+            rows = self._chain_rows(snapshot["depth"])
+            track_ids = self._read_object(snapshot["ids"])
+        dataframe = rows.reindex(track_ids).rename_axis("id").reset_index()[snapshot["columns"]]
+        # Concatenating the chain and adding missing rows loses categorical and integer dtypes, so they are put back
+        return apply_dtypes(dataframe, snapshot.get("dtypes", {}))
+
+    def record(self, edits: dict) -> int:
+        """Append the edits of `JOURNAL_COLUMNS`, as changed values keyed by track id, to the journal.
+        Returns the number of the latest journal entry."""
+        now = time.time()
+        with self.lock:
+            lines = []
+            for track_id, changes in edits.items():
+                for col, value in changes.items():
+                    if col in JOURNAL_COLUMNS:
+                        self.journal_seq += 1
+                        lines.append(json.dumps({"seq": self.journal_seq, "time": now, "id": track_id,
+                                                 "column": col, "value": value}, default=lambda v: v.item()) + "\n")
+            if lines:
+                with open(os.path.join(self.path, JOURNAL), "a") as f:
+                    f.writelines(lines)
+            return self.journal_seq
+
+    def journal_edits(self, after: int = 0, until: int = None) -> dict:
+        """Get the journal entries after entry `after`, up to and including entry `until`, as edits keyed by track
+        id. Later entries for the same track and column replace earlier ones."""
+        edits = {}
+        journal_path = os.path.join(self.path, JOURNAL)
+        if not os.path.exists(journal_path):
+            return edits
+        with self.lock, open(journal_path) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                if entry["seq"] <= after:
+                    continue
+                if until is not None and entry["seq"] > until:
+                    break
+                edits.setdefault(entry["id"], {})[entry["column"]] = entry["value"]
+        return edits
+
+    def compact(self, keep: int = KEEP_SNAPSHOTS):
+        """Drop all but the latest `keep` snapshots and the journal entries before them, and merge the start of the
+        chain that the oldest kept snapshot is made of into one object. Objects no longer used are deleted."""
+        with self.lock:
+            snapshots = self.manifest["snapshots"]
+            if not snapshots:
+                return
+            kept = snapshots[-max(1, keep):]
+            oldest = kept[0]
+            if oldest["depth"] > 1:
+                base = self._chain_rows(oldest["depth"]).reset_index()
+                chain = [self._write_object(base)] + self.manifest["chain"][oldest["depth"]:]
+                for snapshot in kept:
+                    snapshot["depth"] -= oldest["depth"] - 1
+                self.manifest["chain"] = chain
+            self.manifest["snapshots"] = kept
+
+            journal_path = os.path.join(self.path, JOURNAL)
+            if os.path.exists(journal_path):
+                with open(journal_path) as f:
+                    lines = [line for line in f if line.strip() and json.loads(line)["seq"] > oldest["journal_seq"]]
+                with open(journal_path + ".tmp", "w") as f:
+                    f.writelines(lines)
+                os.replace(journal_path + ".tmp", journal_path)
+            self.manifest["journal_start"] = oldest["journal_seq"]
+            self._write_manifest()
+
+            used = set(self.manifest["chain"]) | {snapshot["ids"] for snapshot in kept}
+            for name in os.listdir(os.path.join(self.path, "objects")):
+                if name.endswith(".pkl") and name[:-len(".pkl")] not in used:
+                    os.remove(os.path.join(self.path, "objects", name))
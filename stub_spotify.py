@@ -0,0 +1,243 @@
+"""
+Stub Spotify client (Music Exploration Tool)
+Author: Yvonne Teo
+Description: This script provides an offline stand-in for spotipy.Spotify, which serves synthetic playlists, audio
+features and audio analysis so that the tool can be run and timed without a Spotify developer account.
+"""
+
+# IMPORTS
+import random
+import string
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+from spotipy import SpotifyException
+
+# DEFINITIONS
+BASE62 = string.digits + string.ascii_letters
+PAGE_SIZE = 100
+
+
+def make_track_id(number: int) -> str:
+    """Make a 22 character base62 track id, like the ones Spotify uses, from a number."""
+    chars = []
+    for _ in range(22):
+        number, remainder = divmod(number, 62)
+        chars.append(BASE62[remainder])
+    return "".join(reversed(chars))
+
+
+def make_track_ids(start: int, count: int) -> np.ndarray:
+    """Make the track ids of `make_track_id` for a range of numbers at once."""
+    numbers = np.arange(start, start + count, dtype=np.int64)
+    digits = np.empty((count, 22), dtype=np.int64)
+    for position in range(21, -1, -1):
+        numbers, digits[:, position] = np.divmod(numbers, 62)
+    codes = np.frombuffer(BASE62.encode(), dtype=np.uint8)[digits]
+    return codes.view("S22").ravel().astype(str)
+
+
+def synthetic_library(n_tracks: int, seed: int = 42) -> pd.DataFrame:
+    """Make a cleaned library of `n_tracks` synthetic tracks at once, with the columns of a cleaned dataframe.
+    Values follow the same ranges as `make_audio_features`, so libraries of any size can be made without the stub."""
+    rng = np.random.default_rng(seed)
+    track_ids = make_track_ids(0, n_tracks)
+    duration_ms = rng.integers(60_000, 420_000, n_tracks)
+    duration = duration_ms / 1000
+    tempo = rng.uniform(50, 200, n_tracks)
+    loudness = -rng.uniform(2, 35, n_tracks)
+    return pd.DataFrame({
+        "name": [f"Track {track_id[-6:]}" for track_id in track_ids],
+        "id": track_ids,
+        "artist": [f"Artist {artist}" for artist in rng.integers(0, 1000, n_tracks)],
+        "tempo": tempo,
+        "time_signature": rng.choice([3, 4, 4, 4, 5], n_tracks),
+        "danceability": rng.random(n_tracks),
+        "energy": rng.random(n_tracks),
+        "key": rng.integers(0, 12, n_tracks),
+        "loudness": loudness,
+        "mode": rng.integers(0, 2, n_tracks),
+        "speechiness": rng.random(n_tracks) * 0.3,
+        "acousticness": rng.random(n_tracks),
+        "instrumentalness": rng.random(n_tracks),
+        "liveness": rng.random(n_tracks) * 0.6,
+        "valence": rng.random(n_tracks),
+        "track_num_samples": (duration * 22050).astype(np.int64),
+        "track_duration": duration,
+        "track_end_of_fade_in": rng.random(n_tracks),
+        "track_start_of_fade_out": duration - rng.uniform(0, 5, n_tracks),
+        "track_tempo_confidence": rng.random(n_tracks),
+        "track_time_signature_confidence": rng.random(n_tracks),
+        "track_key_confidence": rng.random(n_tracks),
+        "track_mode_confidence": rng.random(n_tracks),
+        "duration_ms": duration_ms,
+        "track_href": [f"https://api.spotify.com/v1/tracks/{track_id}" for track_id in track_ids],
+        "analysis_url": [f"https://api.spotify.com/v1/audio-analysis/{track_id}" for track_id in track_ids],
+        "moods": "",
+        "notes": "",
+        "cluster": "",
+    })
+
+
+def make_audio_features(track_id: str) -> dict:
+    """Make synthetic audio features with the same keys and ranges as the Spotify API."""
+    rng = random.Random(track_id)
+    duration_ms = rng.randint(60_000, 420_000)
+    return {
+        "danceability": rng.random(),
+        "energy": rng.random(),
+        "key": rng.randint(0, 11),
+        "loudness": -rng.uniform(2, 35),
+        "mode": rng.randint(0, 1),
+        "speechiness": rng.random() * 0.3,
+        "acousticness": rng.random(),
+        "instrumentalness": rng.random(),
+        "liveness": rng.random() * 0.6,
+        "valence": rng.random(),
+        "tempo": rng.uniform(50, 200),
+        "type": "audio_features",
+        "id": track_id,
+        "uri": f"spotify:track:{track_id}",
+        "track_href": f"https://api.spotify.com/v1/tracks/{track_id}",
+        "analysis_url": f"https://api.spotify.com/v1/audio-analysis/{track_id}",
+        "duration_ms": duration_ms,
+        "time_signature": rng.choice([3, 4, 4, 4, 5]),
+    }
+
+
+def make_audio_analysis(track_id: str, segments_per_second: float = 4.0) -> dict:
+    """Make a synthetic audio analysis with the same structure as the Spotify API."""
+    features = make_audio_features(track_id)
+    rng = random.Random(track_id[::-1])
+    duration = features["duration_ms"] / 1000
+    beat = 60 / features["tempo"]
+
+    def intervals(step):
+        count = max(1, int(duration / step))
+        return [{"start": i * step, "duration": step, "confidence": rng.random()} for i in range(count)]
+
+    segments = []
+    step = 1 / segments_per_second
+    for i in range(max(1, int(duration * segments_per_second))):
+        segments.append({
+            "start": i * step,
+            "duration": step,
+            "confidence": rng.random(),
+            "loudness_start": -rng.uniform(10, 40),
+            "loudness_max": -rng.uniform(0, 20),
+            "loudness_max_time": rng.random() * step,
+            "loudness_end": 0.0,
+            "pitches": [rng.random() for _ in range(12)],
+            "timbre": [rng.gauss(0, 50) for _ in range(12)],
+        })
+    return {
+        "meta": {"analyzer_version": "stub", "platform": "stub", "status_code": 0, "timestamp": 0},
+        "track": {
+            "num_samples": int(duration * 22050),
+            "duration": duration,
+            "sample_md5": "",
+            "offset_seconds": 0,
+            "window_seconds": 0,
+            "analysis_sample_rate": 22050,
+            "analysis_channels": 1,
+            "end_of_fade_in": rng.random(),
+            "start_of_fade_out": duration - rng.uniform(0, 5),
+            "loudness": features["loudness"],
+            "tempo": features["tempo"],
+            "tempo_confidence": rng.random(),
+            "time_signature": features["time_signature"],
+            "time_signature_confidence": rng.random(),
+            "key": features["key"],
+            "key_confidence": rng.random(),
+            "mode": features["mode"],
+            "mode_confidence": rng.random(),
+            "codestring": "",
+            "code_version": 3.15,
+            "echoprintstring": "",
+            "echoprint_version": 4.12,
+            "synchstring": "",
+            "synch_version": 1.0,
+            "rhythmstring": "",
+            "rhythm_version": 1.0,
+        },
+        "bars": intervals(beat * features["time_signature"]),
+        "beats": intervals(beat),
+        "sections": intervals(30.0),
+        "segments": segments,
+        "tatums": intervals(beat / 2),
+    }
+
+
+# STUB CLIENT
+class StubSpotify:
+    """Offline stand-in for the spotipy.Spotify client returned by get_spotipy_info.
+    Every playlist holds `n_tracks` synthetic tracks unless it is listed in `playlists`.
+    Each call sleeps for `latency` seconds, and every `rate_limit_every`-th call is
+    answered with a 429 carrying a Retry-After of `retry_after` seconds."""
+
+    def __init__(self, n_tracks: int = 100, playlists: dict = None, latency: float = 0.0,
+                 rate_limit_every: int = 0, retry_after: float = 1.0, segments_per_second: float = 4.0):
+        self.n_tracks = n_tracks
+        self.playlists = playlists or {}
+        self.latency = latency
+        self.rate_limit_every = rate_limit_every
+        self.retry_after = retry_after
+        self.segments_per_second = segments_per_second
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def _call(self):
+        """Count the call, simulate network latency and answer with a 429 when it is due."""
+        with self.lock:
+            self.calls += 1
+            calls = self.calls
+        if self.latency:
+            time.sleep(self.latency)
+        if self.rate_limit_every and calls % self.rate_limit_every == 0:
+            raise SpotifyException(429, -1, "stub: rate limited",
+                                   headers={"Retry-After": str(self.retry_after)})
+
+    def _playlist_track_ids(self, playlist_id) -> list:
+        if playlist_id in self.playlists:
+            return self.playlists[playlist_id]
+        return [make_track_id(i) for i in range(self.n_tracks)]
+
+    def _playlist_page(self, playlist_id, offset: int, limit: int) -> dict:
+        track_ids = self._playlist_track_ids(playlist_id)
+        items = []
+        for track_id in track_ids[offset:offset + limit]:
+            rng = random.Random(track_id)
+            items.append({"track": {
+                "id": track_id,
+                "name": f"Track {track_id[-6:]}",
+                "artists": [{"name": f"Artist {rng.randint(0, 999)}"}],
+            }})
+        has_next = offset + limit < len(track_ids)
+        return {
+            "items": items,
+            "total": len(track_ids),
+            "offset": offset,
+            "limit": limit,
+            "next": {"playlist_id": playlist_id, "offset": offset + limit, "limit": limit} if has_next else None,
+        }
+
+    def playlist_items(self, playlist_id, fields=None, limit: int = PAGE_SIZE, offset: int = 0, **kwargs) -> dict:
+        self._call()
+        return self._playlist_page(playlist_id, offset, limit)
+
+    def next(self, result: dict):
+        if not result.get("next"):
+            return None
+        self._call()
+        return self._playlist_page(**result["next"])
+
+    def audio_features(self, tracks=None) -> list:
+        self._call()
+        return [make_audio_features(track_id) for track_id in tracks]
+
+    def audio_analysis(self, track_id) -> dict:
+        self._call()
+        return make_audio_analysis(track_id, self.segments_per_second)
@@ -0,0 +1,48 @@
+"""
+Summaries (Music Exploration Tool)
+Author: Yvonne Teo
+Description: This script summarises feature values on the server, so that plots only have to send the summaries to
+the browser instead of every value.
+"""
+
+# IMPORTS
+import numpy as np
+
+# DEFINITIONS
+HISTOGRAM_BINS = 50
+# Outliers drawn on a box plot at most
+MAX_OUTLIERS = 200
+
+
+def histogram_summary(values: np.ndarray, bins: int = HISTOGRAM_BINS) -> dict:
+    """Count the values in equal-width bins. Missing values are left out."""
+    values = np.asarray(values, dtype=np.float64)
+    counts, edges = np.histogram(values[np.isfinite(values)], bins=bins)
+    return {"counts": counts, "edges": edges}
+
+
+def box_summary(values: np.ndarray, max_outliers: int = MAX_OUTLIERS, random_state: int = 42) -> dict:
+    """Get the quartiles, whiskers and mean of the values, and a sample of the outliers.
+    Whiskers reach the furthest values within 1.5 times the interquartile range of the box."""
+    values = np.asarray(values, dtype=np.float64)
+    values = values[np.isfinite(values)]
+    if len(values) == 0:
+        return {"q1": np.nan, "median": np.nan, "q3": np.nan, "lowerfence": np.nan, "upperfence": np.nan,
+                "mean": np.nan, "outliers": np.empty(0), "n_outliers": 0}
+    q1, median, q3 = np.percentile(values, [25, 50, 75])
+    iqr = q3 - q1
+    inside = values[(values >= q1 - 1.5 * iqr) & (values <= q3 + 1.5 * iqr)]
+    outliers = values[(values < q1 - 1.5 * iqr) | (values > q3 + 1.5 * iqr)]
+    n_outliers = len(outliers)
+    if n_outliers > max_outliers:
+        outliers = np.random.default_rng(random_state).choice(outliers, max_outliers, replace=False)
+    return {
+        "q1": q1,
+        "median": median,
+        "q3": q3,
+        "lowerfence": inside.min(),
+        "upperfence": inside.max(),
+        "mean": values.mean(),
+        "outliers": outliers,
+        "n_outliers": n_outliers,
+    }
@@ -0,0 +1,105 @@
+"""
+Aggregates tests (Music Exploration Tool)
+Author: Yvonne Teo
+Description: These tests check the sketch quantiles against exact ones, and that aggregates updated incrementally by
+upserts and session layers match aggregates built from scratch from the master store.
+"""
+
+# IMPORTS
+import numpy as np
+import pandas as pd
+import pytest
+
+from aggregates import (ALL_TRACKS, MAX_DEPTH, MIN_MAGNITUDE, RELATIVE_ACCURACY, SKETCH_BINS, FeatureAggregates,
+                        aggregate_frame, sketch_bins, sketch_quantiles, upsert_tracks)
+from core import feature_cols
+from master_store import MasterStore
+from moods import track_moods
+from stub_spotify import synthetic_library
+
+# DEFINITIONS
+FEATURES = ["energy", "tempo", "loudness"]
+
+
+def random_moods(rng, size: int) -> list:
+    return [", ".join(rng.choice(track_moods, rng.integers(0, 3), replace=False)) for _ in range(size)]
+
+
+def random_library(rng, size: int, prefix: str = "") -> pd.DataFrame:
+    library = synthetic_library(size, seed=int(rng.integers(1 << 16)))
+    if prefix:
+        library["id"] = [f"{prefix}{i}" for i in range(size)]
+    library["artist"] = rng.choice([f"artist {i}" for i in range(10)], size)
+    library["moods"] = random_moods(rng, size)
+    library["cluster"] = rng.integers(0, 4, size).astype(str)
+    library.loc[::5, "cluster"] = ""
+    return library
+
+
+def assert_same_tables(aggregates: FeatureAggregates, expected: FeatureAggregates):
+    for grouping in ["all", "cluster", "artist", "mood"]:
+        for feature in FEATURES:
+            table = aggregates.table(grouping, feature).sort_index()
+            expected_table = expected.table(grouping, feature).sort_index()
+            assert table.index.equals(expected_table.index), (grouping, feature)
+            for column in ["tracks", "values"]:
+                assert (table[column].to_numpy() == expected_table[column].to_numpy()).all(), (grouping, feature)
+            assert np.allclose(table["mean"], expected_table["mean"], rtol=1e-4, equal_nan=True), (grouping, feature)
+            # Bounds of groups that tracks were taken away from are narrowed to a sketch bin, so they are as accurate
+            # as the sketch
+            for column in expected_table.columns.intersection(["min", "max", "median"]):
+                assert np.allclose(table[column], expected_table[column], rtol=2 * RELATIVE_ACCURACY,
+                                   atol=MIN_MAGNITUDE, equal_nan=True), (grouping, feature, column)
+
+
+@pytest.mark.parametrize("quantile", [0.0, 0.05, 0.25, 0.5, 0.75, 0.95, 1.0])
+def test_sketch_quantiles_are_within_the_relative_accuracy(quantile):
+    values = np.random.default_rng(0).normal(-5, 20, 20_000).astype(np.float32)
+    sketch = np.bincount(sketch_bins(values), minlength=SKETCH_BINS)
+    estimate = sketch_quantiles(sketch, [quantile], values.min(), values.max())[0]
+    # The value at the lower rank of the quantile, whose bin the sketch reads
+    exact = np.sort(values)[int(quantile * (len(values) - 1))]
+    assert abs(estimate - exact) <= RELATIVE_ACCURACY * abs(exact) + 1e-6
+
+
+def test_incremental_upserts_match_a_full_rebuild(tmp_path):
+    rng = np.random.default_rng(1)
+    store = MasterStore(str(tmp_path / "master_store"))
+    library = random_library(rng, 500)
+    store.upsert(library)
+    aggregates = FeatureAggregates.from_frame(store.load(), feature_cols)
+    tracks = aggregate_frame(store.load(), feature_cols)
+    for step in range(MAX_DEPTH + 4):
+        clear_empty = step % 3 == 2
+        edits = library.sample(60, random_state=step)[["id"]].copy()
+        edits["moods"] = random_moods(rng, len(edits))
+        edits["cluster"] = rng.integers(0, 6, len(edits)).astype(str)
+        edits.loc[edits.index[:10], ["moods", "cluster"]] = ""
+        edits["energy"] = np.where(rng.random(len(edits)) < 0.5, rng.random(len(edits)), np.nan)
+        added = random_library(rng, 20, prefix=f"new-{step}-")
+        upserted = pd.concat([edits, added], ignore_index=True)
+        store.upsert(upserted, clear_empty=clear_empty)
+        aggregates, tracks = upsert_tracks(aggregates, tracks, upserted, clear_empty=clear_empty)
+        assert aggregates.depth <= MAX_DEPTH
+        assert_same_tables(aggregates, FeatureAggregates.from_frame(store.load(), feature_cols))
+
+
+def test_session_layers_match_a_full_rebuild_and_flatten():
+    rng = np.random.default_rng(2)
+    library = random_library(rng, 400)
+    layer = FeatureAggregates(feature_cols, base=FeatureAggregates.from_frame(library, feature_cols))
+    edited = library.sample(50, random_state=0)
+    changed = edited.assign(moods="chill", energy=0.5, artist="artist 0")
+    layer.update_tracks(aggregate_frame(edited, feature_cols), aggregate_frame(changed, feature_cols))
+    library = library.set_index("id")
+    library.loc[changed["id"], ["moods", "energy", "artist"]] = changed.set_index("id")[["moods", "energy", "artist"]]
+    library = library.reset_index()
+    assert_same_tables(layer, FeatureAggregates.from_frame(library, feature_cols))
+
+    library["cluster"] = rng.integers(0, 3, len(library)).astype(str)
+    layer.rebuild("cluster", aggregate_frame(library, feature_cols))
+    expected = FeatureAggregates.from_frame(library, feature_cols)
+    assert_same_tables(layer, expected)
+    assert_same_tables(layer.flatten(), expected)
+    assert layer.flatten().depth == 0
+    assert layer.histogram("all", ALL_TRACKS, "energy")["counts"].sum() == len(library)
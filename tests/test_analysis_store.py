@@ -0,0 +1,79 @@
+"""
+Analysis store tests (Music Exploration Tool)
+Author: Yvonne Teo
+Description: These tests check that the arrays and derived features of stored audio analyses read back as they were
+written, from the same process or another, before and after chunks are merged.
+"""
+
+# IMPORTS
+import os
+
+import numpy as np
+
+from analysis_store import ARRAY_FIELDS, MAX_CHUNKS, AnalysisStore, analysis_arrays, analysis_cols
+from stub_spotify import StubSpotify, make_track_id
+
+# DEFINITIONS
+N_TRACKS = 40
+
+
+def stub_analyses(n_tracks: int = N_TRACKS, seed: int = 0) -> dict:
+    sp = StubSpotify(n_tracks=n_tracks)
+    analyses = {}
+    for i in range(n_tracks):
+        analysis = sp.audio_analysis(make_track_id(i))
+        # Analyses differ between seeds, so that rewriting a track changes its arrays
+        for segment in analysis["segments"]:
+            segment["loudness_max"] += seed
+        analyses[make_track_id(i)] = analysis_arrays(analysis)
+    return analyses
+
+
+def assert_same_arrays(store: AnalysisStore, analyses: dict):
+    for track_id, arrays in analyses.items():
+        stored = store.get(track_id)
+        for kind in ARRAY_FIELDS:
+            np.testing.assert_array_equal(stored[kind], arrays[kind])
+
+
+def test_put_and_get_round_trip(tmp_path):
+    analyses = stub_analyses()
+    store = AnalysisStore(str(tmp_path))
+    store.put_many(analyses)
+    assert_same_arrays(store, analyses)
+    assert_same_arrays(AnalysisStore(str(tmp_path)), analyses)
+    assert store.get("not-stored") is None
+    assert store.missing(["not-stored", make_track_id(0)]) == ["not-stored"]
+    derived = store.derived([make_track_id(0), "not-stored"])
+    assert derived.shape == (2, len(analysis_cols))
+    assert np.isfinite(derived[0]).all() and np.isnan(derived[1]).all()
+
+
+def test_compaction_keeps_the_latest_arrays_of_every_track(tmp_path):
+    old, new = stub_analyses(seed=0), stub_analyses(seed=100)
+    store = AnalysisStore(str(tmp_path))
+    # Overlapping pages, so that tracks are written again with newer arrays
+    pages = [list(old)[i:i + 4] for i in range(0, N_TRACKS, 2)]
+    for page_number, page in enumerate(pages):
+        analyses = new if page_number % 2 else old
+        store.put_many({track_id: analyses[track_id] for track_id in page})
+    assert len(pages) > MAX_CHUNKS
+    assert len(store.manifest["chunks"]) <= MAX_CHUNKS
+    # Only the chunks in the manifest are left on disk
+    chunks = sorted(name for name in os.listdir(tmp_path) if name.startswith("chunk-"))
+    assert chunks == sorted(store.manifest["chunks"])
+
+    latest = {}
+    for page_number, page in enumerate(pages):
+        for track_id in page:
+            latest[track_id] = (new if page_number % 2 else old)[track_id]
+    assert_same_arrays(store, latest)
+
+    reference = AnalysisStore(str(tmp_path / "reference"))
+    reference.put_many(latest)
+    reopened = AnalysisStore(str(tmp_path))
+    assert_same_arrays(reopened, latest)
+    np.testing.assert_allclose(reopened.derived(list(latest)), reference.derived(list(latest)), equal_nan=True)
+    reopened.compact()
+    assert len(reopened.manifest["chunks"]) == 1
+    assert_same_arrays(AnalysisStore(str(tmp_path)), latest)
@@ -0,0 +1,102 @@
+"""
+Fetcher tests (Music Exploration Tool)
+Author: Yvonne Teo
+Description: These tests drive concurrent fetching through the stub Spotify client and a local HTTP server, to check
+that 429 responses pause the shared token bucket and that rate-limited tracks are retried rather than dropped.
+"""
+
+# IMPORTS
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from spotipy import SpotifyException
+
+from core import make_spotify
+from fetcher import FetchReport, TokenBucket, fetch_concurrently
+from stub_spotify import StubSpotify, make_track_id
+
+
+# DEFINITIONS
+class RateLimitedHandler(BaseHTTPRequestHandler):
+    """Answers every request with a 429 and a Retry-After header, counting the requests."""
+
+    def do_GET(self):
+        self.server.requests += 1
+        self.send_response(429)
+        self.send_header("Retry-After", "30")
+        self.send_header("Content-Type", "application/json")
+        self.end_headers()
+        self.wfile.write(b'{"error": {"status": 429, "message": "API rate limit exceeded"}}')
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def rate_limited_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), RateLimitedHandler)
+    server.requests = 0
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_rate_limited_ids_are_retried_not_dropped():
+    sp = StubSpotify(rate_limit_every=3, retry_after=0.01)
+    track_ids = [make_track_id(i) for i in range(30)]
+    report = FetchReport()
+    results = fetch_concurrently(sp.audio_analysis, track_ids, max_workers=4,
+                                 bucket=TokenBucket(rate=1000, capacity=10), report=report)
+    assert sorted(results) == sorted(track_ids)
+    assert all(results[track_id] is not None for track_id in track_ids)
+    assert report.retries == sp.calls - len(track_ids) > 0
+    assert not report.errors
+
+
+def test_429_pauses_the_shared_bucket():
+    retry_after = 0.3
+    sp = StubSpotify(rate_limit_every=5, retry_after=retry_after)
+    bucket = TokenBucket(rate=1000, capacity=10)
+    report = FetchReport()
+    start = time.monotonic()
+    results = fetch_concurrently(lambda track_id: sp.audio_features([track_id]), [make_track_id(i) for i in range(8)],
+                                 max_workers=4, bucket=bucket, report=report)
+    elapsed = time.monotonic() - start
+    # Every worker waits for the bucket after the 429, rather than only the worker that got it
+    assert report.retries == 1
+    assert len(results) == 8
+    assert elapsed >= retry_after
+    assert bucket.updated >= start + retry_after
+
+
+def test_spotify_client_raises_429_instead_of_sleeping(rate_limited_server, monkeypatch):
+    sp = make_spotify("cid", "secret")
+    monkeypatch.setattr(sp.auth_manager, "get_access_token", lambda *args, **kwargs: "token")
+    sp.prefix = f"http://127.0.0.1:{rate_limited_server.server_port}/"
+    start = time.monotonic()
+    with pytest.raises(SpotifyException) as error:
+        sp.track(make_track_id(0))
+    assert error.value.http_status == 429
+    assert error.value.headers["Retry-After"] == "30"
+    assert rate_limited_server.requests == 1
+    assert time.monotonic() - start < 5
+
+
+def test_shared_report_does_not_drop_ids_that_failed_before():
+    report = FetchReport()
+    failing = {"a"}
+
+    def fetch(key):
+        if key in failing:
+            raise ValueError(key)
+        return key.upper()
+
+    assert fetch_concurrently(fetch, ["a", "b"], max_workers=2, report=report) == {"b": "B"}
+    failing.clear()
+    assert fetch_concurrently(fetch, ["a", "b"], max_workers=2, report=report) == {"a": "A", "b": "B"}
+    assert "a" in report.errors
@@ -0,0 +1,91 @@
+"""
+Snapshots tests (Music Exploration Tool)
+Author: Yvonne Teo
+Description: These tests check that saved snapshots restore to the dataframes they were saved from, dtypes included,
+with or without the journaled edits, and that compacting the history keeps the latest snapshots restorable.
+"""
+
+# IMPORTS
+import os
+
+import pandas as pd
+import pytest
+
+from core import restore_df
+from snapshots import SnapshotStore
+
+# DEFINITIONS
+def library(size: int = 20) -> pd.DataFrame:
+    return pd.DataFrame({
+        "id": [f"track-{i}" for i in range(size)],
+        "artist": pd.Categorical([f"artist {i % 4}" for i in range(size)]),
+        "energy": [i / size for i in range(size)],
+        "key": pd.array([i % 12 if i % 5 else None for i in range(size)], dtype="Int8"),
+        "moods": pd.Categorical(["chill" if i % 2 else "" for i in range(size)]),
+        "notes": [""] * size,
+    })
+
+
+def test_snapshots_restore_with_their_dtypes(tmp_path):
+    store = SnapshotStore(str(tmp_path))
+    first = library()
+    second = first.copy()
+    second["moods"] = second["moods"].cat.add_categories(["dark"])
+    second.loc[:2, "moods"] = "dark"
+    second.loc[3, "energy"] = 0.99
+    third = pd.concat([second.iloc[5:], library(25).iloc[20:]], ignore_index=True)
+    saved = [store.save(dataframe) for dataframe in (first, second, third)]
+    # Only the rows that changed are stored again
+    assert saved[1]["changed_rows"] == 4
+    assert saved[2]["changed_rows"] == 5
+
+    reopened = SnapshotStore(str(tmp_path))
+    for snapshot, dataframe in zip(saved, (first, second, third)):
+        pd.testing.assert_frame_equal(reopened.restore(snapshot["id"]), dataframe)
+
+
+def test_saving_the_same_dataframe_twice_keeps_one_snapshot(tmp_path):
+    store = SnapshotStore(str(tmp_path))
+    first = store.save(library())
+    assert store.save(library()) == first
+    assert len(store.snapshots()) == 1
+
+
+def test_journaled_edits_are_replayed_up_to_an_entry(tmp_path):
+    store = SnapshotStore(str(tmp_path))
+    snapshot = store.save(library())
+    first_seq = store.record({"track-1": {"moods": "dark", "energy": 0.5}, "track-2": {"notes": "loud"}})
+    store.record({"track-1": {"moods": "warm"}})
+
+    pd.testing.assert_frame_equal(restore_df(f"snapshot:{snapshot['id']}", store), library())
+    edited = restore_df(f"snapshot:{snapshot['id']}@{first_seq}", store).set_index("id")
+    assert edited.loc["track-1", "moods"] == "dark"
+    assert edited.loc["track-2", "notes"] == "loud"
+    # Only moods, notes and clusters are journaled
+    assert edited.loc["track-1", "energy"] == library().set_index("id").loc["track-1", "energy"]
+    latest = restore_df(f"snapshot:{snapshot['id']}@{first_seq + 1}", store).set_index("id")
+    assert latest.loc["track-1", "moods"] == "warm"
+
+
+def test_compact_keeps_the_latest_snapshots_and_deletes_unused_objects(tmp_path):
+    store = SnapshotStore(str(tmp_path))
+    dataframes, snapshots = [], []
+    for step in range(5):
+        dataframe = library()
+        dataframe.loc[step, "energy"] = 10.0 + step
+        dataframes.append(dataframe)
+        snapshots.append(store.save(dataframe))
+        store.record({f"track-{step}": {"notes": f"edit {step}"}})
+    objects_before = len(os.listdir(tmp_path / "objects"))
+
+    store.compact(keep=2)
+    reopened = SnapshotStore(str(tmp_path))
+    assert [snapshot["id"] for snapshot in reopened.snapshots()] == [snapshots[3]["id"], snapshots[4]["id"]]
+    assert len(os.listdir(tmp_path / "objects")) < objects_before
+    for snapshot, dataframe in zip(snapshots[3:], dataframes[3:]):
+        pd.testing.assert_frame_equal(reopened.restore(snapshot["id"]), dataframe)
+    with pytest.raises(KeyError):
+        reopened.restore(snapshots[0]["id"])
+    # Edits journaled after the oldest kept snapshot are kept
+    assert reopened.journal_edits(snapshots[3]["journal_seq"]) == {"track-3": {"notes": "edit 3"},
+                                                                   "track-4": {"notes": "edit 4"}}
@@ -0,0 +1,123 @@
+"""
+Track cache (Music Exploration Tool)
+Author: Yvonne Teo
+Description: This script keeps a persistent on-disk cache of Spotify API responses keyed by track id, so that a
+track is only fetched once across playlists, sessions and restarts.
+"""
+
+# IMPORTS
+import json
+import os
+import sqlite3
+import threading
+import time
+
+# DEFINITIONS
+TRACK_CACHE_PATH = "./cache/track_cache.sqlite3"
+# Entries older than this are fetched again
+DEFAULT_TTL = 30 * 24 * 60 * 60
+# Least recently used entries beyond this are evicted
+DEFAULT_MAX_ROWS = 2_000_000
+# Expired entries are removed at most this often, in seconds, unless there are too many entries
+EVICT_INTERVAL = 60 * 60
+# Number of ids per query, kept below SQLite's limit on query parameters
+QUERY_CHUNK = 500
+
+
+class TrackCache:
+    """SQLite cache of JSON payloads keyed by kind (e.g. "features" or "analysis") and track id.
+    Entries expire after `ttl` seconds, and the least recently used entries are evicted
+    once there are more than `max_rows`. Eviction runs every `EVICT_INTERVAL` seconds, or sooner once the entries
+    counted at the last eviction plus those stored since could be more than `max_rows`.
+    Hits and misses are counted per kind."""
+
+    def __init__(self, path: str = TRACK_CACHE_PATH, ttl: float = DEFAULT_TTL, max_rows: int = DEFAULT_MAX_ROWS):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.ttl = ttl
+        self.max_rows = max_rows
+        self.hits = {}
+        self.misses = {}
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS tracks ("
+                              "kind TEXT NOT NULL, id TEXT NOT NULL, payload TEXT NOT NULL, "
+                              "fetched_at REAL NOT NULL, accessed_at REAL NOT NULL, PRIMARY KEY (kind, id))")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS tracks_accessed ON tracks (accessed_at)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS tracks_fetched ON tracks (fetched_at)")
+        # At most the number of entries, since replaced entries are counted again
+        self.num_rows = 0
+        self.evicted_at = 0.0
+        self.evict()
+
+    def _select(self, kind: str, track_ids: list, columns: str) -> list:
+        rows = []
+        oldest = time.time() - self.ttl
+        for i in range(0, len(track_ids), QUERY_CHUNK):
+            chunk = track_ids[i:i + QUERY_CHUNK]
+            placeholders = ", ".join("?" * len(chunk))
+            rows.extend(self.conn.execute(
+                f"SELECT {columns} FROM tracks WHERE kind = ? AND fetched_at >= ? AND id IN ({placeholders})",
+                [kind, oldest, *chunk]).fetchall())
+        return rows
+
+    def get_many(self, kind: str, track_ids: list) -> dict:
+        """Get the cached payloads for the given track ids, keyed by track id. Missing ids are left out."""
+        track_ids = list(dict.fromkeys(track_ids))
+        with self.lock:
+            rows = self._select(kind, track_ids, "id, payload")
+            with self.conn:
+                now = time.time()
+                self.conn.executemany("UPDATE tracks SET accessed_at = ? WHERE kind = ? AND id = ?",
+                                      [(now, kind, track_id) for track_id, _ in rows])
+            self.hits[kind] = self.hits.get(kind, 0) + len(rows)
+            self.misses[kind] = self.misses.get(kind, 0) + len(track_ids) - len(rows)
+        return {track_id: json.loads(payload) for track_id, payload in rows}
+
+    def put_many(self, kind: str, payloads: dict):
+        """Store payloads keyed by track id, replacing any existing entries."""
+        if not payloads:
+            return
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO tracks VALUES (?, ?, ?, ?, ?)",
+                                  [(kind, track_id, json.dumps(payload), now, now)
+                                   for track_id, payload in payloads.items()])
+            self.num_rows += len(payloads)
+            due = self.num_rows > self.max_rows or time.monotonic() - self.evicted_at >= EVICT_INTERVAL
+        if due:
+            self.evict()
+
+    def evict(self) -> int:
+        """Remove expired entries, then the least recently used entries beyond `max_rows`.
+        Returns the number of entries removed."""
+        with self.lock, self.conn:
+            removed = self.conn.execute("DELETE FROM tracks WHERE fetched_at < ?",
+                                        [time.time() - self.ttl]).rowcount
+            num_rows = self.conn.execute("SELECT COUNT(*) FROM tracks").fetchone()[0]
+            if num_rows > self.max_rows:
+                removed += self.conn.execute(
+                    "DELETE FROM tracks WHERE rowid IN (SELECT rowid FROM tracks ORDER BY accessed_at LIMIT ?)",
+                    [num_rows - self.max_rows]).rowcount
+            self.num_rows = min(num_rows, self.max_rows)
+            self.evicted_at = time.monotonic()
+        return removed
+
+    def stats(self) -> dict:
+        """Get the number of entries, and the hits, misses and hit rate of each kind."""
+        with self.lock:
+            rows = dict(self.conn.execute("SELECT kind, COUNT(*) FROM tracks GROUP BY kind").fetchall())
+            stats = {}
+            for kind in sorted(set(self.hits) | set(self.misses) | set(rows)):
+                hits = self.hits.get(kind, 0)
+                misses = self.misses.get(kind, 0)
+                stats[kind] = {
+                    "entries": rows.get(kind, 0),
+                    "hits": hits,
+                    "misses": misses,
+                    "hit_rate": hits / (hits + misses) if hits + misses else 0.0,
+                }
+        return stats